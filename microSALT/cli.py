@@ -13,10 +13,13 @@ import yaml
 
 from pkg_resources import iter_entry_points
 from microSALT import __version__, preset_config, logger, wd
+from microSALT.utils import compression
+from microSALT.utils.cache import Artifact_Cache
 from microSALT.utils.scraper import Scraper
 from microSALT.utils.job_creator import Job_Creator
 from microSALT.utils.reporter import Reporter
 from microSALT.utils.referencer import Referencer
+from microSALT.utils.snpdistance import snp_distances
 
 default_sampleinfo = {
     "CG_ID_project": "XXX0000",
@@ -132,9 +135,106 @@ def root(ctx):
     default=False,
     is_flag=True,
 )
+@click.option(
+    "--compress",
+    type=click.Choice(["gzip", "zstd"]),
+    default=None,
+    help="Compresses BLAST and alignment statistics outputs",
+)
+@click.option(
+    "--preflight",
+    help="Counts reads and qualities of the input before creating jobs",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--stream_lanes",
+    help="Streams lanes into trimming, or links single lanes, instead of concatenating them",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--array", help="Submits all samples as one SLURM job array", default=False, is_flag=True
+)
+@click.option(
+    "--array_limit",
+    help="Maximum number of array samples running at once. 0 for no limit",
+    default=0,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--steps",
+    help="Splits each sample into step jobs with their own SLURM resources",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--parallel",
+    help="Runs alignment and assembly side by side within each sample job",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--incremental",
+    help="Each sample job ingests its own results, the project job only reports",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--sizing",
+    help="Sizes threads, time and memory of each sample from its expected depth",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--executor",
+    help="Runs jobs through SLURM or in a process pool on this machine",
+    default="slurm",
+    type=click.Choice(["slurm", "local"]),
+)
+@click.option(
+    "--workers",
+    help="Jobs run at once by the local executor",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--cache",
+    help="Links trimmed reads, alignments and assemblies of identical earlier runs",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--scratch",
+    help="Runs each sample in node-local scratch and copies back its deliverables",
+    default=False,
+    is_flag=True,
+)
 @click.pass_context
 def analyse(
-    ctx, sampleinfo_file, input, config, dry, email, skip_update, force_update, untrimmed, uncareful
+    ctx,
+    sampleinfo_file,
+    input,
+    config,
+    dry,
+    email,
+    skip_update,
+    force_update,
+    untrimmed,
+    uncareful,
+    compress,
+    preflight,
+    stream_lanes,
+    array,
+    array_limit,
+    steps,
+    parallel,
+    incremental,
+    sizing,
+    executor,
+    workers,
+    cache,
+    scratch,
 ):
     """Sequence analysis, typing and resistance identification"""
     # Run section
@@ -147,6 +247,15 @@ def analyse(
     if not os.path.isdir(input):
         click.echo("ERROR - Sequence data folder {} does not exist.".format(input))
         ctx.abort()
+    if compress == "zstd" and compression.zstandard is None:
+        click.echo("ERROR - --compress zstd needs the zstandard package to read results back.")
+        ctx.abort()
+    if steps and array:
+        click.echo("ERROR - --steps submits jobs per sample and step, it cannot be combined with --array.")
+        ctx.abort()
+    if sizing and array:
+        click.echo("ERROR - --sizing sets resources per sample, it cannot be combined with --array.")
+        ctx.abort()
     for subfolder in os.listdir(input):
         if os.path.isdir("{}/{}".format(input, subfolder)):
             pool.append(subfolder)
@@ -159,6 +268,19 @@ def analyse(
         "trimmed": not untrimmed,
         "careful": not uncareful,
         "pool": pool,
+        "compress": compress,
+        "preflight": preflight,
+        "stream_lanes": stream_lanes,
+        "array": array,
+        "array_limit": array_limit,
+        "steps": steps,
+        "parallel": parallel,
+        "incremental": incremental,
+        "sizing": sizing,
+        "executor": executor,
+        "workers": workers,
+        "cache": cache,
+        "scratch": scratch,
     }
 
     # Samples section
@@ -239,9 +361,45 @@ def refer(ctx):
     ),
 )
 @click.option("--output", help="Report output folder", default="")
+@click.option(
+    "--workers",
+    help="Number of processes parsing samples in parallel",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--force",
+    help="Re-scrapes samples whose results are unchanged since the last scrape",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--samples",
+    help="Comma separated samples to re-scrape, e.g. A1,A2. Other samples are left as is",
+    default="",
+)
+@click.option(
+    "--scrape_only",
+    help="Stores results in the database without producing reports",
+    default=False,
+    is_flag=True,
+)
 @click.pass_context
 def finish(
-    ctx, sampleinfo_file, input, track, config, dry, email, skip_update, report, output
+    ctx,
+    sampleinfo_file,
+    input,
+    track,
+    config,
+    dry,
+    email,
+    skip_update,
+    report,
+    output,
+    workers,
+    force,
+    samples,
+    scrape_only,
 ):
     """Sequence analysis, typing and resistance identification"""
     # Run section
@@ -286,20 +444,25 @@ def finish(
         config=ctx.obj["config"], log=ctx.obj["log"], sampleinfo=sampleinfo, input=input
     )
     if isinstance(sampleinfo, list) and len(sampleinfo) > 1:
-        res_scraper.scrape_project()
+        res_scraper.scrape_project(
+            workers=workers,
+            force=force,
+            samples=[sample for sample in samples.split(",") if sample],
+        )
         # for subfolder in pool:
         #  res_scraper.scrape_sample()
     else:
-        res_scraper.scrape_sample()
+        res_scraper.scrape_sample(force=force)
 
-    codemonkey = Reporter(
-        config=ctx.obj["config"],
-        log=ctx.obj["log"],
-        sampleinfo=sampleinfo,
-        output=output,
-        collection=True,
-    )
-    codemonkey.report(report)
+    if not scrape_only:
+        codemonkey = Reporter(
+            config=ctx.obj["config"],
+            log=ctx.obj["log"],
+            sampleinfo=sampleinfo,
+            output=output,
+            collection=True,
+        )
+        codemonkey.report(report)
     done()
 
 
@@ -371,6 +534,89 @@ def view(ctx):
     codemonkey = Reporter(config=ctx.obj["config"], log=ctx.obj["log"])
     codemonkey.start_web()
 
+@utils.command()
+@click.argument("sampleinfo_file")
+@click.argument("folders", nargs=-1, required=True)
+@click.option("--config", help="microSALT config to override default", default="")
+@click.option(
+    "--dry",
+    help="Builds instance without posting to SLURM",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--array",
+    help="Submits variant calling of all samples as one SLURM job array",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--array_limit",
+    help="Maximum number of array samples running at once. 0 for no limit",
+    default=0,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--shards",
+    help="Reference regions called side by side per sample, for large genomes",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--executor",
+    help="Runs jobs through SLURM or in a process pool on this machine",
+    default="slurm",
+    type=click.Choice(["slurm", "local"]),
+)
+@click.option(
+    "--workers",
+    help="Jobs run at once by the local executor",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.pass_context
+def snp(ctx, sampleinfo_file, folders, config, dry, array, array_limit, shards, executor, workers):
+    """SNP calling per sample, followed by pair-wise distances of all samples.
+    Takes the analysis folders of the samples, called against the reference of the first sample"""
+    set_cli_config(config)
+    ctx.obj["config"]["dry"] = dry
+    for folder in folders:
+        if not os.path.isdir(folder):
+            click.echo("ERROR - Analysis folder {} does not exist.".format(folder))
+            ctx.abort()
+    run_settings = {
+        "input": ["{}/".format(os.path.abspath(folder)) for folder in folders],
+        "dry": dry,
+        "array": array,
+        "array_limit": array_limit,
+        "shards": shards,
+        "executor": executor,
+        "workers": workers,
+    }
+    sampleinfo = review_sampleinfo(sampleinfo_file)
+    run_creator = Job_Creator(
+        config=ctx.obj["config"],
+        log=ctx.obj["log"],
+        sampleinfo=sampleinfo,
+        run_settings=run_settings,
+    )
+    run_creator.snp_job()
+    done()
+
+
+@utils.command()
+@click.argument("sitefiles", nargs=-1, required=True)
+@click.option("--output", help="Full path to output folder", default=os.getcwd())
+@click.pass_context
+def snpdistance(ctx, sitefiles, output):
+    """Pair-wise SNP distances between samples, from their filtered SNP calls"""
+    names, distances = snp_distances(list(sitefiles), output)
+    ctx.obj["log"].info(
+        "Compared {} pairs of {} samples".format(len(names) * (len(names) - 1) // 2, len(names))
+    )
+    done()
+
+
 @utils.command()
 @click.option("--input", help="Full path to project folder", default=os.getcwd())
 @click.pass_context
@@ -403,6 +649,54 @@ def generate(ctx, input):
     done()
 
 
+@utils.group()
+@click.pass_context
+def cache(ctx):
+    """Manages cached trimmed reads, alignments and assemblies"""
+
+
+@cache.command(name="report")
+@click.pass_context
+def cache_report(ctx):
+    """Shows the hit rate of every cached artifact"""
+    codemonkey = Artifact_Cache(config=ctx.obj["config"], log=ctx.obj["log"])
+    entries = codemonkey.entries()
+    click.echo(
+        "INFO - {} entries, {} bytes in {}".format(
+            len(entries), sum(size for used, size, path in entries), codemonkey.folder
+        )
+    )
+    for kind, (hits, lookups) in sorted(codemonkey.report().items()):
+        click.echo(
+            "INFO - {}: {} of {} lookups hit ({:.1f}%)".format(
+                kind, hits, lookups, 100.0 * hits / lookups
+            )
+        )
+    done()
+
+
+@cache.command()
+@click.option(
+    "--max_age_days",
+    help="Removes entries unused for longer",
+    default=preset_config.get("cache", {}).get("max_age_days", 90),
+    type=click.FloatRange(min=0),
+)
+@click.option(
+    "--max_size_gb",
+    help="Removes the least recently used entries until the cache fits",
+    default=preset_config.get("cache", {}).get("max_size_gb", 2000),
+    type=click.FloatRange(min=0),
+)
+@click.pass_context
+def evict(ctx, max_age_days, max_size_gb):
+    """Evicts cache entries by age and total size"""
+    codemonkey = Artifact_Cache(config=ctx.obj["config"], log=ctx.obj["log"])
+    removed = codemonkey.evict(max_age_days=max_age_days, max_size_gb=max_size_gb)
+    click.echo("INFO - Evicted {} cache entries".format(len(removed)))
+    done()
+
+
 @utils.group()
 @click.pass_context
 def resync(ctx):
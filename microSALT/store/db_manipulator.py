@@ -8,6 +8,7 @@ import sys
 import warnings
 
 from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from sqlalchemy import *
 from sqlalchemy.orm import sessionmaker
@@ -22,6 +23,7 @@ from microSALT.store.orm_models import (
     app,
     Collections,
     Expacs,
+    Manifests,
     Projects,
     Reports,
     Resistances,
@@ -31,6 +33,20 @@ from microSALT.store.orm_models import (
 )
 from microSALT.store.models import Profiles, Novel
 
+# Columns added to existing tables after their creation, per table name
+ADDED_COLUMNS = {
+    "samples": [
+        "median_coverage",
+        "coverage_p10",
+        "coverage_p90",
+        "fold_80",
+        "coverage_depths",
+        "input_reads",
+        "input_bases",
+        "input_mean_quality",
+        "input_q30",
+    ],
+}
 
 class DB_Manipulator:
     def __init__(self, config, log):
@@ -41,6 +57,8 @@ class DB_Manipulator:
         )
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
+        # Set while transaction() groups writes into one commit
+        self.batched = False
         self.metadata = MetaData(self.engine)
         self.profiles = Profiles(self.metadata, self.config, self.logger).tables
         self.novel = Novel(self.metadata, self.config, self.logger).tables
@@ -75,6 +93,10 @@ class DB_Manipulator:
         if not self.engine.dialect.has_table(self.engine, "expacs"):
             Expacs.__table__.create(self.engine)
             self.logger.info("Created ExPEC table")
+        if not self.engine.dialect.has_table(self.engine, "manifests"):
+            Manifests.__table__.create(self.engine)
+            self.logger.info("Created manifests table")
+        self.add_columns()
         for k, v in self.profiles.items():
             if not self.engine.dialect.has_table(self.engine, "profile_{}".format(k)):
                 self.profiles[k].create()
@@ -95,6 +117,42 @@ class DB_Manipulator:
                 )
                 self.logger.info("Profile table novel_{} initialized".format(k))
 
+    def add_columns(self):
+        """Adds columns introduced after table creation to tables of older databases"""
+        for name, columns in ADDED_COLUMNS.items():
+            table = Samples.__table__.metadata.tables[name]
+            existing = [column["name"] for column in inspect(self.engine).get_columns(name)]
+            for column in columns:
+                if column in existing:
+                    continue
+                self.engine.execute(
+                    "ALTER TABLE {} ADD COLUMN {} {}".format(
+                        name, column, table.c[column].type.compile(dialect=self.engine.dialect)
+                    )
+                )
+                self.logger.info("Added column {} to table {}".format(column, name))
+
+    def commit(self):
+        """Commits the session, or only flushes it within transaction()"""
+        if self.batched:
+            self.session.flush()
+        else:
+            self.session.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Stores all writes of the block in one commit, or none of them if the block fails"""
+        self.batched = True
+        try:
+            yield
+            self.batched = False
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.batched = False
+
     def add_rec(self, data_dict: Dict[str, str], tablename: str, force=False):
         """Adds a record to the specified table through a dict with columns as keys."""
         pk_list = list()
@@ -157,13 +215,45 @@ class DB_Manipulator:
                 for k, v in data_dict.items():
                     setattr(newobj, k, v)
                 self.session.add(newobj)
-                self.session.commit()
+                self.commit()
             else:
                 self.logger.warning(
                     "Record [{}]=[{}] in table {} already exists".format(
                         ", ".join(pk_list), ", ".join(pk_values), tablename
                     )
                 )
+    def add_recs(self, data_dicts: List[Dict[str, str]], tablename: str):
+        """Adds several records to an ORM table in one transaction. Skips already present records"""
+        if not data_dicts:
+            return
+        table = eval(tablename)
+        pk_list = table.__table__.primary_key.columns.keys()
+        seen = set()
+        try:
+            for data_dict in data_dicts:
+                pk_values = tuple(data_dict[item] for item in pk_list)
+                if pk_values in seen or self.session.query(table).get(pk_values):
+                    self.logger.warning(
+                        "Record [{}]=[{}] in table {} already exists".format(
+                            ", ".join(pk_list), ", ".join(str(v) for v in pk_values), tablename
+                        )
+                    )
+                    continue
+                seen.add(pk_values)
+                newobj = table()
+                for k, v in data_dict.items():
+                    setattr(newobj, k, v)
+                self.session.add(newobj)
+            self.commit()
+        except Exception as e:
+            # A failing batch must not leave the rest of its transaction half written
+            if self.batched:
+                raise
+            self.session.rollback()
+            self.logger.error(
+                "Unable to add records to table {} ({})".format(tablename, e)
+            )
+
     def upd_rec(
         self, req_dict: Dict[str, str], tablename: str, upd_dict: Dict[str, str]
     ):
@@ -180,7 +270,7 @@ class DB_Manipulator:
             sys.exit()
         else:
             eval(megastring + ".update(upd_dict)")
-            self.session.commit()
+            self.commit()
 
     def purge_rec(self, name: str, type: str):
         """Removes seq_data, resistances, sample(s) and possibly project"""
@@ -206,6 +296,11 @@ class DB_Manipulator:
                 .filter(Samples.CG_ID_sample.like("{}%".format(name)))
                 .all()
             )
+            entries.append(
+                self.session.query(Manifests)
+                .filter(Manifests.CG_ID_sample.like("{}%".format(name)))
+                .all()
+            )
             # entries.append(self.session.query(Projects).filter(Projects.CG_ID_project==name).all())
         elif type == "Samples":
             entries.append(
@@ -224,6 +319,11 @@ class DB_Manipulator:
             entries.append(
                 self.session.query(Samples).filter(Samples.CG_ID_sample == name).all()
             )
+            entries.append(
+                self.session.query(Manifests)
+                .filter(Manifests.CG_ID_sample == name)
+                .all()
+            )
         elif type == "Collections":
             entries.append(
                 self.session.query(Collections)
@@ -240,7 +340,7 @@ class DB_Manipulator:
         for entry in entries:
             for instance in entry:
                 self.session.delete(instance)
-                self.session.commit()
+                self.commit()
         self.logger.info("Removed information for {}".format(name))
 
     def query_rec(self, tablename: str, filters: Dict[str, str]):
@@ -337,6 +437,13 @@ class DB_Manipulator:
         else:
             return version.version
 
+    def get_fingerprint(self, name: str):
+        """ Returns the manifest fingerprint of the last scrape of a sample, or None"""
+        manifest = self.session.query(Manifests).get(name)
+        if manifest is None:
+            return None
+        return manifest.fingerprint
+
     def get_report(self, name: str):
         # Sort based on version
         prev_report = []
@@ -619,7 +726,7 @@ class DB_Manipulator:
                     arglist.append("Seq_types.{}=='{}'".format(key, val))
                     args = "and_(" + ", ".join(arglist) + ")"
                 sample.filter(eval(args)).update({Seq_types.st_predictor: 1})
-        self.session.commit()
+        self.commit()
 
     def alleles2st(self, cg_sid: str):
         """ Takes a CG_ID_sample and predicts the correct ST """
@@ -34,6 +34,10 @@ class Samples(db.Model):
     priority = db.Column(db.String(20))
 
     total_reads = db.Column(db.Integer)  # Fetch from bcl2fastq
+    input_reads = db.Column(db.Integer)  # Pre-flight fastq statistics
+    input_bases = db.Column(db.BigInteger)
+    input_mean_quality = db.Column(db.Float)
+    input_q30 = db.Column(db.Float)
     insert_size = db.Column(db.Integer)
     duplication_rate = db.Column(db.Float)
     mapped_rate = db.Column(db.Float)
@@ -42,6 +46,11 @@ class Samples(db.Model):
     coverage_50x = db.Column(db.Float)
     coverage_100x = db.Column(db.Float)
     average_coverage = db.Column(db.Float)
+    median_coverage = db.Column(db.Integer)
+    coverage_p10 = db.Column(db.Integer)
+    coverage_p90 = db.Column(db.Integer)
+    fold_80 = db.Column(db.Float)
+    coverage_depths = db.Column(db.Text)  # JSON of extra depth thresholds
     reference_genome = db.Column(db.String(32))
 
     application_tag = db.Column(db.String(15))
@@ -121,6 +130,15 @@ class Expacs(db.Model):
     contig_end = db.Column(db.Integer)
 
 
+class Manifests(db.Model):
+    __tablename__ = "manifests"
+
+    CG_ID_sample = db.Column(db.String(15), primary_key=True, nullable=False)
+    fingerprint = db.Column(db.String(64))
+    manifest = db.Column(db.Text)
+    date_scraped = db.Column(db.DateTime)
+
+
 class Projects(db.Model):
     __tablename__ = "projects"
     samples = relationship("Samples", back_populates="projects")
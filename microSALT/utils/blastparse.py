@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""Streaming parser for BLAST tabular (outfmt 7) searches made by Job_Creator.blast_subset"""
+
+import re
+
+# Subject names per database type
+MLST_PATTERN = re.compile(r"(.+)_(\d+){1,3}(?:_(\w+))*")
+RESISTANCE_PATTERN = re.compile(r"(?:\>)*(.+)_(\d+){1,3}(?:_(.+))")
+# Thanks, precompiled list standards
+EXPEC_PATTERNS = [
+    re.compile(r">*(\w+_\w+\.*\w+).+\((\w+)\).+\((\w+)\)_(\w+)_\[.+\]"),
+    re.compile(r"(\w+)\(gb\|\w+\)_\((\S+)\)_(.+)_\[(\S+)_.+\]_\[\S+\]"),
+    re.compile(r"(\w+\.*\w+)\:*\w*_*(?:\(\w+\-\w+\))*_\((\w+)\)_([^[]+)\[\S+\]"),
+]
+
+
+class Blast_Hit:
+    """A single BLAST hit. lookup holds the reference headers to try when resolving its length"""
+
+    __slots__ = [
+        "subject",
+        "identity",
+        "evalue",
+        "bitscore",
+        "contig_start",
+        "contig_end",
+        "subject_length",
+        "contig_name",
+        "contig_length",
+        "contig_coverage",
+        "span",
+        "loci",
+        "allele",
+        "gene",
+        "instance",
+        "reference",
+        "resistance",
+        "virulence",
+        "lookup",
+        "exact",
+    ]
+
+    # Database columns of each search type
+    columns = {
+        "seq_type": ["loci", "allele"],
+        "resistance": ["gene", "instance", "reference", "resistance"],
+        "expec": ["gene", "instance", "reference", "virulence"],
+    }
+    common = [
+        "identity",
+        "evalue",
+        "bitscore",
+        "contig_start",
+        "contig_end",
+        "subject_length",
+        "contig_name",
+        "contig_length",
+        "contig_coverage",
+        "span",
+    ]
+
+    def __init__(self):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+
+    def as_dict(self, type):
+        """Returns the hit as a record for the table of search type"""
+        return {column: getattr(self, column) for column in self.common + self.columns[type]}
+
+
+def decode_mlst(hit, subject, instance):
+    partials = MLST_PATTERN.search(subject)
+    hit.loci = partials.group(1)
+    hit.allele = int(partials.group(2))
+    hit.lookup = (">{}".format(partials[0]), ">{}".format(partials[0][:-1]))
+    hit.exact = False
+
+
+def decode_resistance(hit, subject, instance):
+    partials = RESISTANCE_PATTERN.search(subject)
+    hit.instance = instance
+    hit.reference = partials.group(3)
+    hit.gene = partials.group(1)
+    # Ignores reference name and finds relevant resFinder entry
+    hit.lookup = (">{}".format(partials[1]), ">{}".format(partials[1][:-1]))
+    hit.exact = False
+
+
+def decode_expec(hit, subject, instance):
+    if ">" in subject:
+        partials = EXPEC_PATTERNS[0].search(subject)
+    else:
+        partials = EXPEC_PATTERNS[1].search(subject)
+    if not partials:
+        partials = EXPEC_PATTERNS[2].search(subject)
+    # NC/Protein reference
+    hit.reference = partials.group(1)
+    # Full gene name
+    hit.gene = partials.group(2)
+    # More generic group
+    hit.instance = partials.group(3).strip("_")
+    # Description
+    if len(partials.groups()) >= 4:
+        hit.virulence = partials.group(4).replace("_", " ").capitalize()
+    else:
+        hit.virulence = ""
+    hit.lookup = (">{}".format(subject),)
+    hit.exact = True
+
+
+decoders = {"seq_type": decode_mlst, "resistance": decode_resistance, "expec": decode_expec}
+
+
+def read_hits(handle, type, instance=""):
+    """Yields a Blast_Hit for every hit line of an outfmt 7 search of the given type.
+       instance names the searched database, i.e. the resistance class"""
+    decode = decoders[type]
+    for line in handle:
+        # Ignore commented fields
+        if line[0] == "#":
+            continue
+        elem_list = line.rstrip().split("\t")
+        if elem_list[1] == "N/A":
+            continue
+        hit = Blast_Hit()
+        hit.subject = elem_list[3]
+        hit.identity = float(elem_list[4])
+        hit.evalue = elem_list[5]
+        hit.bitscore = float(elem_list[6])
+        qstart, qend = int(elem_list[7]), int(elem_list[8])
+        if qstart < qend:
+            hit.contig_start, hit.contig_end = qstart, qend
+        else:
+            hit.contig_start, hit.contig_end = qend, qstart
+        hit.subject_length = int(elem_list[11])
+        decode(hit, elem_list[3], instance)
+        # split elem 2 into contig node_NO, length, cov
+        nodeinfo = elem_list[2].split("_")
+        hit.contig_name = "{}_{}".format(nodeinfo[0], nodeinfo[1])
+        hit.contig_length = int(nodeinfo[3])
+        hit.contig_coverage = float(nodeinfo[5])
+        yield hit
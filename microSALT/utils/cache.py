@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""Content addressed cache of trimmed reads, alignments and assemblies.
+   Entries are keyed by input checksums, tool versions and parameters"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+
+from functools import lru_cache
+
+# Bytes hashed per read
+CHUNK_SIZE = 1 << 20
+# Checksum sidecar kept next to the hashed files
+CHECKSUM_INDEX = ".checksums.json"
+# Lookups of every job creation, one line each
+LOOKUP_LOG = "lookups.tsv"
+# Commands printing the version of each cached tool
+VERSION_COMMANDS = {
+    "trimmomatic": ["trimmomatic", "-version"],
+    "bwa": ["bwa"],
+    "samtools": ["samtools", "--version"],
+    "picard": ["picard", "MarkDuplicates", "--version"],
+    "spades.py": ["spades.py", "--version"],
+}
+VERSION_PATTERN = re.compile(r"\d+\.\d+[\w.\-]*")
+
+
+def file_checksum(filename):
+    """md5 of a file, read in chunks"""
+    digest = hashlib.md5()
+    with open(filename, "rb") as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_checksums(filenames):
+    """Returns file_checksum of every file, keyed by filename.
+       Checksums are kept per folder in a sidecar keyed by mtime and size"""
+    results = dict()
+    indexes = dict()
+    changed = set()
+    for filename in filenames:
+        folder, name = os.path.split(filename)
+        if folder not in indexes:
+            try:
+                with open(os.path.join(folder, CHECKSUM_INDEX), "r") as fh:
+                    indexes[folder] = json.load(fh)
+            except (IOError, ValueError):
+                indexes[folder] = dict()
+        stat = os.stat(filename)
+        entry = indexes[folder].get(name)
+        if not entry or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+            entry = {"mtime": stat.st_mtime, "size": stat.st_size, "md5": file_checksum(filename)}
+            indexes[folder][name] = entry
+            changed.add(folder)
+        results[filename] = entry["md5"]
+    for folder in changed:
+        # Input folders may be read only, the sidecar is only an optimisation
+        try:
+            tmpfile = os.path.join(folder, "{}.tmp".format(CHECKSUM_INDEX))
+            with open(tmpfile, "w") as fh:
+                json.dump(indexes[folder], fh)
+            os.replace(tmpfile, os.path.join(folder, CHECKSUM_INDEX))
+        except OSError:
+            pass
+    return results
+
+
+@lru_cache(maxsize=None)
+def tool_version(tool):
+    """First version number printed by tool, or 'unknown' when it cannot be run"""
+    try:
+        proc = subprocess.run(
+            VERSION_COMMANDS.get(tool, [tool, "--version"]),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=120,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+    found = VERSION_PATTERN.search(proc.stdout.decode("utf-8", "replace"))
+    return found.group(0) if found else "unknown"
+
+
+def artifact_key(checksums, tools, params):
+    """Key of an artifact made from inputs with checksums, by tools, with params"""
+    content = {
+        "inputs": list(checksums),
+        "tools": {tool: tool_version(tool) for tool in sorted(tools)},
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class Artifact_Cache:
+    """Cache folder with one directory per artifact, <folder>/<kind>/<key>/<files>.
+    Entries are moved into place whole, so an existing entry is always complete"""
+
+    def __init__(self, config, log):
+        self.config = config
+        self.logger = log
+        # Configs from before the cache keep it next to the results
+        self.folder = config["folders"].get("cache") or os.path.join(
+            config["folders"]["results"], ".cache"
+        )
+
+    def entry(self, kind, key):
+        return os.path.join(self.folder, kind, key)
+
+    def lookup(self, kind, key, sample=""):
+        """Returns the entry folder of key, or None. Hits are touched for eviction"""
+        entry = self.entry(kind, key)
+        hit = os.path.isdir(entry)
+        if hit:
+            os.utime(entry)
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(os.path.join(self.folder, LOOKUP_LOG), "a") as fh:
+                fh.write("{}\t{}\t{}\t{}\t{}\n".format(int(time.time()), kind, key, sample, int(hit)))
+        except OSError as e:
+            self.logger.warning("Unable to log cache lookup ({})".format(e))
+        return entry if hit else None
+
+    def link_commands(self, kind, key, files):
+        """Bash lines linking cached files into place. files maps cached names to paths.
+        Hard links keep results intact after eviction, symbolic links cross file systems.
+        The job fails right away if the entry was evicted after the job was created"""
+        entry = self.entry(kind, key)
+        lines = [
+            '[ -d {0} ] || {{ echo "Cache entry {0} was evicted, rerun the sample" >&2; exit 1; }}\n'.format(
+                entry
+            )
+        ]
+        for name, path in sorted(files.items()):
+            cached = os.path.join(self.entry(kind, key), name)
+            lines.append("ln -f {0} {1} 2>/dev/null || ln -sf {0} {1}\n".format(cached, path))
+        return "".join(lines)
+
+    def store_commands(self, kind, key, files):
+        """Bash lines copying finished files into a new entry. files maps cached names to paths"""
+        kinddir = os.path.join(self.folder, kind)
+        lines = ["mkdir -p {}\n".format(kinddir)]
+        lines.append("CACHE_TMP=$(mktemp -d {}/.tmp.XXXXXX)\n".format(kinddir))
+        for name, path in sorted(files.items()):
+            lines.append("cp -L {} $CACHE_TMP/{}\n".format(path, name))
+        # Another job may have stored the same key meanwhile
+        lines.append(
+            "mv -T $CACHE_TMP {} 2>/dev/null || rm -rf $CACHE_TMP\n".format(self.entry(kind, key))
+        )
+        return "".join(lines)
+
+    def entries(self):
+        """Returns (last use, bytes, path) of every entry, oldest first"""
+        found = list()
+        if not os.path.isdir(self.folder):
+            return found
+        for kind in sorted(os.listdir(self.folder)):
+            kinddir = os.path.join(self.folder, kind)
+            if not os.path.isdir(kinddir):
+                continue
+            for key in os.listdir(kinddir):
+                entry = os.path.join(kinddir, key)
+                if key.startswith(".") or not os.path.isdir(entry):
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(root, file))
+                    for root, dirs, files in os.walk(entry)
+                    for file in files
+                )
+                found.append((os.stat(entry).st_mtime, size, entry))
+        return sorted(found)
+
+    def evict(self, max_age_days=None, max_size_gb=None):
+        """Removes entries unused for max_age_days, then the least recently used
+        until the cache fits in max_size_gb. Returns the removed entries"""
+        entries = self.entries()
+        removed = list()
+        if max_age_days is not None:
+            oldest = time.time() - max_age_days * 86400
+            removed = [entry for entry in entries if entry[0] < oldest]
+            entries = [entry for entry in entries if entry[0] >= oldest]
+        if max_size_gb is not None:
+            total = sum(size for used, size, path in entries)
+            while entries and total > max_size_gb * (1 << 30):
+                total -= entries[0][1]
+                removed.append(entries.pop(0))
+        for used, size, path in removed:
+            shutil.rmtree(path, ignore_errors=True)
+            self.logger.info("Evicted cache entry {} ({} bytes)".format(path, size))
+        return [path for used, size, path in removed]
+
+    def report(self):
+        """Returns hits and lookups per artifact kind, from the lookup log"""
+        counts = dict()
+        try:
+            with open(os.path.join(self.folder, LOOKUP_LOG), "r") as fh:
+                for line in fh:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) < 5:
+                        continue
+                    hits, lookups = counts.get(fields[1], (0, 0))
+                    counts[fields[1]] = (hits + int(fields[4]), lookups + 1)
+        except IOError:
+            pass
+        return counts
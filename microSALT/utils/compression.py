@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""Transparent handling of compressed pipeline outputs"""
+
+import gzip
+import io
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Output suffix and the shell filter producing it, per compression method
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+COMMANDS = {"gzip": "gzip -c", "zstd": "zstd -q -c"}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def output_suffix(method):
+    """Returns the suffix added to outputs compressed with method. Empty if uncompressed"""
+    if not method:
+        return ""
+    return SUFFIXES[method]
+
+
+def compress_command(method):
+    """Returns a shell filter that compresses stdin to stdout with method"""
+    return COMMANDS[method]
+
+
+def strip_suffix(filename):
+    """Returns filename without any compression suffix"""
+    for suffix in SUFFIXES.values():
+        if filename.endswith(suffix):
+            return filename[: -len(suffix)]
+    return filename
+
+
+def open_text(filename):
+    """Opens plain, gzip or zstd compressed files for text reading. Detects the format by content"""
+    with open(filename, "rb") as fh:
+        magic = fh.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(filename, "rt")
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise Exception(
+                "File {} is zstd compressed but the zstandard package is not installed".format(
+                    filename
+                )
+            )
+        stream = zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(filename, "r")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""Runs generated runfiles, either through SLURM or on the local machine"""
+
+import re
+import subprocess
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Slurm_Executor:
+    """Submits runfiles with sbatch. Job ids are the ones handed out by SLURM"""
+
+    def __init__(self, config, log, dry=False):
+        self.config = config
+        self.logger = log
+        self.dry = dry
+
+    def headerargs(
+        self,
+        name,
+        logfile=None,
+        threads=None,
+        time=None,
+        mem=None,
+        partition=None,
+        dependencies=[],
+        after="afterok",
+        extra="",
+    ):
+        """Builds sbatch arguments. Unset resources fall back to the slurm header"""
+        header = self.config["slurm_header"]
+        headerline = "-A {} -p {} -n {} -t {} -J {}_{} --qos {}".format(
+            header["project"],
+            partition or header["type"],
+            threads or header["threads"],
+            time or header["time"],
+            header["job_prefix"],
+            name,
+            header["qos"],
+        )
+        if logfile:
+            headerline += " --output {}".format(logfile)
+        if mem:
+            headerline += " --mem {}".format(mem)
+        if extra:
+            headerline += " {}".format(extra)
+        if dependencies:
+            headerline += " --dependency={}:{}".format(after, ":".join(dependencies))
+            # Dependents of a failed job are cancelled rather than left pending
+            if after == "afterok":
+                headerline += " --kill-on-invalid-dep=yes"
+        return headerline
+
+    def submit(self, runfile, name, **resources):
+        """Submits runfile. Returns its job id, or None when dry"""
+        bash_cmd = "sbatch {} {}".format(self.headerargs(name, **resources), runfile)
+        if self.dry:
+            self.logger.info("Suppressed command: {}".format(bash_cmd))
+            return None
+        proc = subprocess.Popen(bash_cmd.split(), stdout=subprocess.PIPE)
+        output, error = proc.communicate()
+        return re.search(r"(\d+)", str(output)).group(0)
+
+    def submit_array(self, dispatcher, runfiles, name, logfile, limit=0, **resources):
+        """Submits runfiles as one job array run through dispatcher.
+        runfiles holds (runfile, logfile) tuples. Returns the array job id in a list"""
+        array = "0-{}".format(len(runfiles) - 1)
+        if limit:
+            array = "{}%{}".format(array, limit)
+        jobno = self.submit(
+            dispatcher, name, logfile=logfile, extra="--array={}".format(array), **resources
+        )
+        if jobno is None:
+            return list()
+        return [jobno]
+
+    def wait(self):
+        """SLURM jobs outlive this process, so there is nothing to wait for"""
+        return list()
+
+
+class Local_Executor:
+    """Runs runfiles with bash on this machine, at most workers at a time.
+    Job ids are counters. Jobs wait for their dependencies like SLURM afterok/afterany"""
+
+    def __init__(self, config, log, workers=1, dry=False):
+        self.config = config
+        self.logger = log
+        self.dry = dry
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # Job id as key, future of its exit status as value
+        self.jobs = dict()
+        self.lock = threading.Lock()
+
+    def run(self, jobid, runfile, logfile, dependencies, after):
+        # Dependencies are always queued first, so waiting here cannot starve the pool
+        for dependency in dependencies:
+            if self.jobs[dependency].result() != 0 and after == "afterok":
+                self.logger.error(
+                    "Local job {} cancelled, dependency {} did not succeed".format(jobid, dependency)
+                )
+                return None
+        with open(logfile or "/dev/null", "a") as log:
+            status = subprocess.call(["bash", runfile], stdout=log, stderr=subprocess.STDOUT)
+        if status != 0:
+            self.logger.error(
+                "Local job {} ({}) failed with exit status {}".format(jobid, runfile, status)
+            )
+        return status
+
+    def submit(self, runfile, name, logfile=None, dependencies=[], after="afterok", **resources):
+        """Queues runfile. Resources besides the log file are left to the machine.
+        Returns its job id, or None when dry"""
+        if self.dry:
+            self.logger.info("Suppressed local run of {}".format(runfile))
+            return None
+        with self.lock:
+            jobid = str(len(self.jobs) + 1)
+            known = [dependency for dependency in dependencies if dependency in self.jobs]
+            self.jobs[jobid] = self.pool.submit(self.run, jobid, runfile, logfile, known, after)
+        self.logger.info("Queued {} as local job {}".format(name, jobid))
+        return jobid
+
+    def submit_array(self, dispatcher, runfiles, name, logfile, limit=0, **resources):
+        """Queues every runfile on its own, the pool already bounds concurrency"""
+        jobs = list()
+        for runfile, log in runfiles:
+            jobno = self.submit(runfile, name, logfile=log, **resources)
+            if jobno is not None:
+                jobs.append(jobno)
+        return jobs
+
+    def wait(self):
+        """Blocks until all queued jobs are done. Returns the ids of jobs that did not succeed"""
+        self.pool.shutdown(wait=True)
+        return [jobid for jobid, future in self.jobs.items() if future.result() != 0]
+
+
+def get_executor(config, log, kind="slurm", workers=1, dry=False):
+    """Returns the executor named kind"""
+    if kind == "slurm":
+        return Slurm_Executor(config, log, dry=dry)
+    if kind == "local":
+        return Local_Executor(config, log, workers=workers, dry=dry)
+    raise Exception("Unknown executor {}".format(kind))
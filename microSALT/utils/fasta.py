@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""Streaming fasta indexing and random access to indexed records"""
+
+import mmap
+import os
+
+from collections import namedtuple
+
+# One .fai line, plus the full header line it was read from
+Fai_Entry = namedtuple(
+    "Fai_Entry", ["header", "name", "length", "offset", "linebases", "linewidth"]
+)
+
+
+def index_fasta(filename):
+    """Streams a fasta file and yields one Fai_Entry per record. Memory use is constant"""
+    header = None
+    length, offset, linebases, linewidth = 0, 0, 0, 0
+    position = 0
+    with open(filename, "rb") as fh:
+        for row in fh:
+            if row.startswith(b">"):
+                if header is not None:
+                    yield Fai_Entry(
+                        header, header[1:].split()[0] if len(header) > 1 else "",
+                        length, offset, linebases, linewidth
+                    )
+                header = row.strip().decode("utf-8")
+                length, linebases, linewidth = 0, 0, 0
+                offset = position + len(row)
+            elif header is not None:
+                bases = len(row.rstrip(b"\r\n"))
+                if linebases == 0:
+                    linebases = bases
+                    linewidth = len(row)
+                length += bases
+            position += len(row)
+    if header is not None:
+        yield Fai_Entry(
+            header, header[1:].split()[0] if len(header) > 1 else "",
+            length, offset, linebases, linewidth
+        )
+
+
+def fasta_lengths(filename):
+    """Returns the sequence length of every record in a fasta file, keyed by full header"""
+    return {entry.header: entry.length for entry in index_fasta(filename)}
+
+
+def read_records(filename):
+    """Yields (header, sequence) for every record of a fasta file, sequence on one line"""
+    header, sequence = None, list()
+    with open(filename, "r") as fh:
+        for row in fh:
+            row = row.strip()
+            if row.startswith(">"):
+                if header is not None:
+                    yield header, "".join(sequence)
+                header, sequence = row, list()
+            elif header is not None:
+                sequence.append(row)
+    if header is not None:
+        yield header, "".join(sequence)
+
+
+def split_regions(lengths, count):
+    """Splits (name, length) records into at most count shards of about equal size.
+    Each shard is a list of (name, start, end) regions, 0-based and end exclusive like BED"""
+    total = sum(length for name, length in lengths)
+    size = max(1, -(-total // count))
+    shards, shard, room = list(), list(), size
+    for name, length in lengths:
+        start = 0
+        while start < length:
+            end = min(length, start + room)
+            shard.append((name, start, end))
+            room -= end - start
+            start = end
+            if room == 0:
+                shards.append(shard)
+                shard, room = list(), size
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def write_fai(filename):
+    """Writes a samtools compatible index to <filename>.fai. Returns the entries"""
+    entries = list()
+    with open("{}.fai".format(filename), "w") as fai:
+        for entry in index_fasta(filename):
+            fai.write(
+                "{}\t{}\t{}\t{}\t{}\n".format(
+                    entry.name, entry.length, entry.offset, entry.linebases, entry.linewidth
+                )
+            )
+            entries.append(entry)
+    return entries
+
+
+class Fasta_Reader:
+    """Random access to records of an indexed fasta file through mmap"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        faifile = "{}.fai".format(filename)
+        if not os.path.isfile(faifile) or os.stat(faifile).st_mtime < os.stat(filename).st_mtime:
+            write_fai(filename)
+        self.index = dict()
+        with open(faifile, "r") as fai:
+            for line in fai:
+                name, length, offset, linebases, linewidth = line.rstrip("\n").split("\t")[:5]
+                self.index[name] = (int(length), int(offset), int(linebases), int(linewidth))
+        self.fh = open(filename, "rb")
+        self.map = None
+        if os.stat(filename).st_size > 0:
+            self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.fh.close()
+
+    def names(self):
+        return list(self.index.keys())
+
+    def length(self, name):
+        return self.index[name][0]
+
+    def fetch(self, name, start=0, end=None):
+        """Returns bases [start, end) of record name, 0-based like python slices"""
+        length, offset, linebases, linewidth = self.index[name]
+        if end is None or end > length:
+            end = length
+        if start >= end:
+            return ""
+        first = offset + (start // linebases) * linewidth + start % linebases
+        last = offset + ((end - 1) // linebases) * linewidth + (end - 1) % linebases
+        chunk = self.map[first : last + 1]
+        return chunk.replace(b"\n", b"").replace(b"\r", b"").decode("utf-8")
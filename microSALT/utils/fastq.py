@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""Streaming validation and read statistics of gzipped fastq files"""
+
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import zlib
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Compressed bytes read, and decompressed bytes produced, per step
+CHUNK_SIZE = 1 << 20
+# Decompressed bytes kept from the end of the file
+TAIL_SIZE = 1 << 16
+GZIP_MAGIC = b"\x1f\x8b"
+# Phred+33 characters below Q30
+LOW_QUALITY = bytes(range(33, 63))
+# Read statistics sidecar kept next to the fastq files
+STATS_INDEX = ".fastqstats.json"
+# Samples columns filled by the pre-flight statistics
+PREFLIGHT_COLUMNS = ["input_reads", "input_bases", "input_mean_quality", "input_q30"]
+
+Fastq_Status = namedtuple(
+    "Fastq_Status", ["filename", "members", "truncated", "crc_error", "error", "tail"]
+)
+
+
+def check_fastq(filename, chunk_size=CHUNK_SIZE, tail_size=TAIL_SIZE):
+    """Decompresses every gzip member of a fastq file with bounded buffers.
+       Only the last tail_size decompressed bytes are kept, so memory use does not depend on file size"""
+    members, tail = 0, b""
+    truncated, crc_error, error = False, False, ""
+    inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    started = False
+    with open(filename, "rb") as fh:
+        data = fh.read(chunk_size)
+        while data:
+            if not started and members > 0 and len(data) < len(GZIP_MAGIC):
+                # The chunk boundary may split the magic of the next member
+                more = fh.read(chunk_size)
+                if more:
+                    data += more
+                    continue
+            if not started and members > 0 and not data.startswith(GZIP_MAGIC):
+                # Padding after the last member is harmless, anything else is not
+                if data.strip(b"\x00"):
+                    error = "trailing data after gzip member {}".format(members)
+                    break
+                data = fh.read(chunk_size)
+                continue
+            started = True
+            try:
+                out = inflater.decompress(data, chunk_size)
+            except zlib.error as e:
+                crc_error = "check" in str(e)
+                error = str(e)
+                break
+            tail = (tail + out)[-tail_size:]
+            if inflater.eof:
+                members += 1
+                data = inflater.unused_data
+                inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                started = False
+            else:
+                data = inflater.unconsumed_tail
+            if not data:
+                data = fh.read(chunk_size)
+    if started and not error:
+        truncated = True
+    return Fastq_Status(filename, members, truncated, crc_error, error, tail)
+
+
+def ends_properly(status):
+    """Checks that the last kept record has its separator line in place"""
+    lines = status.tail.splitlines()
+    return len(lines) >= 2 and b"+" in lines[-2]
+
+
+def check_fastqs(filenames, workers=4):
+    """Checks several fastq files concurrently. zlib releases the GIL while inflating.
+       Returns one Fastq_Status per file in input order, or the raised exception"""
+
+    def guarded(filename):
+        try:
+            return check_fastq(filename)
+        except Exception as e:
+            return e
+
+    if not filenames:
+        return list()
+    with ThreadPoolExecutor(max_workers=min(workers, len(filenames))) as pool:
+        return list(pool.map(guarded, filenames))
+
+
+def fastq_stats(filename):
+    """Counts reads, bases, summed Phred quality and Q30 bases of a gzipped fastq in one pass"""
+    reads, bases, quality, q30 = 0, 0, 0, 0
+    with gzip.open(filename, "rb") as fh:
+        for line in itertools.islice(fh, 3, None, 4):
+            line = line.rstrip(b"\r\n")
+            reads += 1
+            bases += len(line)
+            quality += sum(line)
+            q30 += len(line.translate(None, LOW_QUALITY))
+    return {"reads": reads, "bases": bases, "quality": quality - 33 * bases, "q30": q30}
+
+
+def cached_fastq_stats(filenames, workers=4):
+    """Returns fastq_stats of every file, keyed by filename.
+       Results are cached per folder in a sidecar keyed by mtime and size. Misses are counted in a process pool"""
+    results = dict()
+    indexes = dict()
+    missing = list()
+    for filename in filenames:
+        folder, name = os.path.split(filename)
+        if folder not in indexes:
+            try:
+                with open(os.path.join(folder, STATS_INDEX), "r") as fh:
+                    indexes[folder] = json.load(fh)
+            except (IOError, ValueError):
+                indexes[folder] = dict()
+        stat = os.stat(filename)
+        entry = indexes[folder].get(name)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            results[filename] = entry["stats"]
+        else:
+            missing.append(filename)
+
+    if len(missing) > 1 and workers > 1:
+        with multiprocessing.Pool(min(workers, len(missing))) as pool:
+            computed = pool.map(fastq_stats, missing)
+    else:
+        computed = [fastq_stats(filename) for filename in missing]
+
+    changed = set()
+    for filename, stats in zip(missing, computed):
+        folder, name = os.path.split(filename)
+        stat = os.stat(filename)
+        indexes[folder][name] = {"mtime": stat.st_mtime, "size": stat.st_size, "stats": stats}
+        results[filename] = stats
+        changed.add(folder)
+    for folder in changed:
+        # Input folders may be read only, the cache is only an optimisation
+        try:
+            tmpfile = os.path.join(folder, "{}.tmp".format(STATS_INDEX))
+            with open(tmpfile, "w") as fh:
+                json.dump(indexes[folder], fh)
+            os.replace(tmpfile, os.path.join(folder, STATS_INDEX))
+        except OSError:
+            pass
+    return results
+
+
+def sample_stats(file_stats):
+    """Combines fastq_stats of the files of one sample into Samples columns"""
+    reads = sum(stats["reads"] for stats in file_stats)
+    bases = sum(stats["bases"] for stats in file_stats)
+    quality = sum(stats["quality"] for stats in file_stats)
+    q30 = sum(stats["q30"] for stats in file_stats)
+    return {
+        "input_reads": reads,
+        "input_bases": bases,
+        "input_mean_quality": float(quality) / bases if bases else 0.0,
+        "input_q30": float(q30) / bases if bases else 0.0,
+    }
@@ -4,7 +4,6 @@
 #!/usr/bin/env python
 
 import glob
-import gzip
 import json
 import os
 import re
@@ -18,13 +17,53 @@ from pathlib import Path
 import yaml
 
 from microSALT.store.db_manipulator import DB_Manipulator
-from microSALT.utils.referencer import Referencer
+from microSALT.utils.cache import Artifact_Cache, artifact_key, cached_checksums
+from microSALT.utils.compression import compress_command, output_suffix
+from microSALT.utils.executor import get_executor
+from microSALT.utils.fasta import fasta_lengths, index_fasta, split_regions
+from microSALT.utils.fastq import cached_fastq_stats, check_fastqs, ends_properly, sample_stats
+from microSALT.utils.referencer import MERGED_DB, Referencer, merged_db, merged_records
+from microSALT.utils.reporter import SAMPLE_DELIVERABLES
+from microSALT.utils.snpdistance import SITES_SUFFIX
+
+
+# Read alignment and duplicate removal settings
+BWA_OPTIONS = "-M"
+MARKDUP_OPTIONS = "REMOVE_DUPLICATES=true"
+# Trimmomatic settings following the adapter file
+TRIM_STEPS = "2:30:10 LEADING:3 TRAILING:3 SLIDINGWINDOW:4:15 MINLEN:36"
+# Bases per byte of gzipped fastq, used when no read statistics are at hand
+BASES_PER_BYTE = 1.7
+# Genome size assumed without a reference or a configured sizing.genome_size
+GENOME_SIZE = 5000000
+# Result files read when scraping a sample, relative to its folder
+SCRAPED_FILES = ["blast_search/*/*", "alignment/*.stats.*", "assembly/quast/*report.tsv"]
+# Alignment files that are neither deliverables nor scraped, read again by the SNP job
+ALIGNMENT_FILES = ["alignment/*.bai", "alignment/*.hist.ins"]
+
+
+def gigabytes(mem):
+    """Whole gigabytes of a SLURM memory value such as 500M, 32G or 1T"""
+    units = {"K": 1.0 / 1024 ** 2, "M": 1.0 / 1024, "G": 1, "T": 1024}
+    mem = str(mem).upper()
+    if mem[-1] in units:
+        return max(1, int(float(mem[:-1]) * units[mem[-1]]))
+    # SLURM reads plain numbers as megabytes
+    return max(1, int(float(mem) / 1024))
 
 
 class Job_Creator:
     def __init__(self, config, log, sampleinfo={}, run_settings={}):
         self.config = config
         self.logger = log
+        # Resources of the whole sample, and of the section being written
+        self.resources = {
+            "threads": config["slurm_header"]["threads"],
+            "time": config["slurm_header"]["time"],
+            "mem": None,
+        }
+        self.threads = self.resources["threads"]
+        self.mem = self.resources["mem"]
         self.batchfile = "/tmp/batchfile.sbatch"
 
         self.filelist = list()
@@ -39,6 +78,23 @@ class Job_Creator:
         self.careful = run_settings.get("careful", True)
         self.pool = run_settings.get("pool", [])
         self.finishdir = run_settings.get("finishdir", "")
+        self.compress = run_settings.get("compress")
+        self.preflight = run_settings.get("preflight", False)
+        self.stream_lanes = run_settings.get("stream_lanes", False)
+        self.sizing = run_settings.get("sizing", False)
+        self.incremental = run_settings.get("incremental", False)
+        # Folder holding the sampleinfo.json of the whole run
+        self.project_dir = run_settings.get("project_dir")
+        self.array = run_settings.get("array", False)
+        self.array_limit = run_settings.get("array_limit", 0)
+        self.steps = run_settings.get("steps", False)
+        self.parallel = run_settings.get("parallel", False)
+        # Reference regions called side by side per SNP sample
+        self.shards = run_settings.get("shards", 1)
+        self.stepfiles = list()
+        self.input_stats = run_settings.get("input_stats")
+        # Keys of the cached artifacts of the sample, by kind
+        self.cache_keys = dict()
 
         self.sampleinfo = sampleinfo
         self.sample = None
@@ -83,27 +139,121 @@ class Job_Creator:
 
         if run_settings.get("finishdir") is None:
             self.finishdir = "{}/{}_{}".format(config["folders"]["results"], self.name, self.now)
+        if not self.project_dir:
+            self.project_dir = self.finishdir
         self.db_pusher = DB_Manipulator(config, log)
         self.concat_files = dict()
         self.ref_resolver = Referencer(config, log)
+        self.scratch = run_settings.get("scratch", False)
+        # Shared folders and their node-local copies, filled while staging
+        self.staging = list()
+        self.cache = None
+        if run_settings.get("cache"):
+            self.cache = Artifact_Cache(config, log)
+        self.executor = get_executor(
+            config,
+            log,
+            run_settings.get("executor", "slurm"),
+            run_settings.get("workers", 1),
+            config.get("dry", False),
+        )
 
     def get_sbatch(self):
         """ Returns sbatchfile, slightly superflous"""
         return self.batchfile
 
-    def get_headerargs(self):
-        headerline = "-A {} -p {} -n {} -t {} -J {}_{} --qos {} --output {}/slurm_{}.log".format(
-            self.config["slurm_header"]["project"],
-            self.config["slurm_header"]["type"],
-            self.config["slurm_header"]["threads"],
-            self.config["slurm_header"]["time"],
-            self.config["slurm_header"]["job_prefix"],
-            self.name,
-            self.config["slurm_header"]["qos"],
-            self.finishdir,
+    def step_settings(self, step):
+        """Threads, time and memory of an analysis step. Unset values fall back to the sample resources"""
+        settings = dict(self.resources)
+        settings.update(self.config["slurm_header"].get("steps", {}).get(step, {}))
+        return settings
+
+    def output_redirect(self, filename, option="&>"):
+        """Returns the shell tail writing a command's output to filename.
+        With compression enabled output is piped through the compressor instead"""
+        if not self.compress:
+            return "{} {}".format(option, filename)
+        stderr = "2>&1 " if option == "&>" else ""
+        return "{}| {} > {}{}".format(
+            stderr,
+            compress_command(self.compress),
+            filename,
+            output_suffix(self.compress),
+        )
+
+    def array_job(self, runfiles, **resources):
+        """Submits the runfiles of all samples as a single job array.
+        runfiles holds (runfile, logfile) tuples. Returns the array job id in a list"""
+        dispatcher = "{}/array_dispatch.sh".format(self.finishdir)
+        with open(dispatcher, "w") as fh:
+            fh.write("#!/bin/bash\n\n")
+            fh.write("# Runs the sample of SLURM_ARRAY_TASK_ID\n")
+            fh.write("RUNFILES=(\n{}\n)\n".format("\n".join(run for run, log in runfiles)))
+            fh.write("LOGFILES=(\n{}\n)\n".format("\n".join(log for run, log in runfiles)))
+            fh.write(
+                'exec bash "${RUNFILES[$SLURM_ARRAY_TASK_ID]}" >> "${LOGFILES[$SLURM_ARRAY_TASK_ID]}" 2>&1\n'
+            )
+        jobs = self.executor.submit_array(
+            dispatcher,
+            runfiles,
             self.name,
+            "{}/slurm_{}_%a.log".format(self.finishdir, self.name),
+            limit=self.array_limit,
+            **resources
+        )
+        if jobs:
+            self.logger.info(
+                "Submitted {} samples as job array {}".format(len(runfiles), ":".join(jobs))
+            )
+        return jobs
+
+    def expected_depth(self):
+        """Expected sequencing depth of the sample, from its input and reference genome lengths"""
+        if self.input_stats:
+            bases = self.input_stats["input_bases"]
+        else:
+            size = sum(
+                os.stat("{}/{}".format(self.indir, file)).st_size
+                for file in os.listdir(self.indir)
+                if re.match(self.config["regex"]["file_pattern"], file)
+            )
+            bases = size * BASES_PER_BYTE
+        reference = "{}/{}.fasta".format(self.config["folders"]["genomes"], self.sample.get("reference"))
+        if os.path.isfile(reference):
+            genome = sum(fasta_lengths(reference).values())
+        else:
+            genome = self.config["slurm_header"].get("sizing", {}).get("genome_size", GENOME_SIZE)
+        return float(bases) / genome
+
+    def size_resources(self):
+        """Sets threads, time and memory of the sample from the first row of the sizing
+        table that its expected depth does not exceed"""
+        table = self.config["slurm_header"].get("sizing", {}).get("table", [])
+        if not table:
+            self.logger.warning(
+                "No slurm_header sizing table configured, {} keeps the default resources".format(
+                    self.name
+                )
+            )
+            return
+        depth = self.expected_depth()
+        for row in table:
+            if row.get("max_depth") is None or depth <= row["max_depth"]:
+                for resource in ["threads", "time", "mem"]:
+                    if resource in row:
+                        self.resources[resource] = row[resource]
+                break
+        self.threads = self.resources["threads"]
+        self.mem = self.resources["mem"]
+        self.logger.info(
+            "Sample {} has an expected depth of {:.0f}x. Reserving {} threads, {} and {} memory".format(
+                self.name,
+                depth,
+                self.resources["threads"],
+                self.resources["time"],
+                self.resources["mem"] or "default",
+            )
         )
-        return headerline
 
     def verify_fastq(self):
         """ Uses arg indir to return a dict of PE fastq tuples fulfilling naming convention """
@@ -111,7 +261,11 @@ class Job_Creator:
         files = os.listdir(self.indir)
         if files == []:
             raise Exception("Directory {} lacks fastq files.".format(self.indir))
+        available = set(files)
+        paired = set()
         for file in files:
+            if file in paired:
+                continue
             file_match = re.match(self.config["regex"]["file_pattern"], file)
             if file_match:
                 # Check that symlinks resolve
@@ -144,8 +298,9 @@ class Job_Creator:
                             pairno,
                             file_match.string[file_match.end(1) : file_match.end()],
                         )
-                    if pairname in files:
-                        files.pop(files.index(pairname))
+                    if pairname in available and pairname not in paired:
+                        paired.add(file)
+                        paired.add(pairname)
                         verified_files.append(file_match[0])
                         verified_files.append(pairname)
                 else:
@@ -172,10 +327,26 @@ class Job_Creator:
                 )
 
         # Warn about invalid fastq files
-        for vfile in verified_files:
-            f = gzip.open("{}/{}".format(self.indir, vfile), "r")
-            lines = f.read().splitlines()
-            if len(lines) < 2 or not "+" in str(lines[-2]):
+        statuses = check_fastqs(
+            ["{}/{}".format(self.indir, vfile) for vfile in verified_files],
+            workers=int(self.config["slurm_header"]["threads"]),
+        )
+        for vfile, status in zip(verified_files, statuses):
+            if isinstance(status, Exception):
+                self.logger.warning("Unable to validate input fastq {} ({})".format(vfile, status))
+            elif status.crc_error:
+                self.logger.warning(
+                    "Input fastq {} fails its gzip integrity check ({})".format(vfile, status.error)
+                )
+            elif status.error:
+                self.logger.warning("Input fastq {} is corrupt ({})".format(vfile, status.error))
+            elif status.truncated:
+                self.logger.warning(
+                    "Input fastq {} has a truncated gzip member after {} complete members".format(
+                        vfile, status.members
+                    )
+                )
+            elif not ends_properly(status):
                 self.logger.warning("Input fastq {} does not seem to end properly".format(vfile))
         return sorted(verified_files)
 
@@ -192,23 +363,49 @@ class Job_Creator:
         else:
             careline = ""
 
-        batchfile.write(
-            "spades.py --threads {} {} --memory {} -o {}/assembly -1 {} -2 {} {}\n".format(
-                self.config["slurm_header"]["threads"],
-                careline,
-                8 * int(self.config["slurm_header"]["threads"]),
-                self.finishdir,
-                self.concat_files["f"],
-                self.concat_files["r"],
-                trimline,
+        if self.mem:
+            memory = gigabytes(self.mem)
+        else:
+            memory = 8 * int(self.threads)
+
+        contigs = "{}/assembly/{}_contigs.fasta".format(self.finishdir, self.name)
+        cached = None
+        if self.cache and "reads" in self.cache_keys:
+            key = artifact_key(
+                [self.cache_keys["reads"]],
+                ["spades.py"],
+                {"careful": self.careful, "trimmed": self.trimmed},
+            )
+            self.cache_keys["assembly"] = key
+            cached = self.cache.lookup("assembly", key, self.name)
+        if cached:
+            batchfile.write("## Assembly from the cache\n")
+            batchfile.write("mkdir -p {}/assembly\n".format(self.finishdir))
+            batchfile.write(self.cache.link_commands("assembly", key, {"contigs.fasta": contigs}))
+        else:
+            batchfile.write(
+                "spades.py --threads {} {} --memory {} -o {}/assembly -1 {} -2 {} {}\n".format(
+                    self.threads,
+                    careline,
+                    memory,
+                    self.finishdir,
+                    self.concat_files["f"],
+                    self.concat_files["r"],
+                    trimline,
+                )
             )
-        )
 
-        batchfile.write(
-            "mv {0}/assembly/contigs.fasta {0}/assembly/{1}_contigs.fasta\n".format(
-                self.finishdir, self.name
+            batchfile.write(
+                "mv {0}/assembly/contigs.fasta {0}/assembly/{1}_contigs.fasta\n".format(
+                    self.finishdir, self.name
+                )
             )
-        )
+            if "assembly" in self.cache_keys:
+                batchfile.write(
+                    self.cache.store_commands(
+                        "assembly", self.cache_keys["assembly"], {"contigs.fasta": contigs}
+                    )
+                )
         batchfile.write(
             "sed -n '/NODE_1000_/q;p' {0}/assembly/{1}_contigs.fasta > {0}/assembly/{1}_trimmed_contigs.fasta\n".format(
                 self.finishdir, self.name
@@ -223,10 +420,37 @@ class Job_Creator:
         # Create run
         file_list = glob.glob(search_string)
         batchfile = open(self.batchfile, "a+")
-        batchfile.write("mkdir {}/blast_search/{}\n".format(self.finishdir, name))
+        batchfile.write("mkdir -p {}/blast_search/{}\n".format(self.finishdir, name))
         blast_format = '"7 stitle sstrand qaccver saccver pident evalue bitscore qstart qend sstart send length"'
-
-        if len(file_list) > 1:
+        merged = None
+        if name in ["mlst", "resistance"] and len(file_list) > 1:
+            full_dir, suffix = os.path.dirname(search_string), os.path.splitext(search_string)[1]
+            merged = merged_db(full_dir, suffix)
+            # Every record may hit, the default of 500 target sequences would drop results
+            records = merged_records(full_dir, suffix) if merged else None
+            if not records:
+                merged = None
+
+        if merged:
+            batchfile.write(
+                "# BLAST {} search for {} in all {} files at once\n".format(
+                    name, self.sample.get("organism"), len(file_list)
+                )
+            )
+            batchfile.write(
+                "blastn -db {}  -query {}/assembly/{}_contigs.fasta -task megablast -num_threads {} -max_target_seqs {} -outfmt {} {}\n".format(
+                    self.staged(merged),
+                    self.finishdir,
+                    self.name,
+                    self.threads,
+                    records,
+                    blast_format,
+                    self.output_redirect(
+                        "{}/blast_search/{}/{}.txt".format(self.finishdir, name, MERGED_DB), "-out"
+                    ),
+                )
+            )
+        elif len(file_list) > 1:
             for ref in file_list:
                 if re.search(r"(\w+(?:\-\w+)*)\.\w+", os.path.basename(ref)) is None:
                     self.logger.error(
@@ -241,30 +465,34 @@ class Job_Creator:
                 )
                 if name == "mlst":
                     batchfile.write(
-                        "blastn -db {}/{}  -query {}/assembly/{}_contigs.fasta -out {}/blast_search/{}/loci_query_{}.txt -task megablast -num_threads {} -outfmt {}\n".format(
-                            os.path.dirname(ref),
+                        "blastn -db {}/{}  -query {}/assembly/{}_contigs.fasta -task megablast -num_threads {} -outfmt {} {}\n".format(
+                            self.staged(os.path.dirname(ref)),
                             ref_nosuf,
                             self.finishdir,
                             self.name,
-                            self.finishdir,
-                            name,
-                            ref_nosuf,
-                            self.config["slurm_header"]["threads"],
+                            self.threads,
                             blast_format,
+                            self.output_redirect(
+                                "{}/blast_search/{}/loci_query_{}.txt".format(
+                                    self.finishdir, name, ref_nosuf
+                                ),
+                                "-out",
+                            ),
                         )
                     )
                 else:
                     batchfile.write(
-                        "blastn -db {}/{}  -query {}/assembly/{}_contigs.fasta -out {}/blast_search/{}/{}.txt -task megablast -num_threads {} -outfmt {}\n".format(
-                            os.path.dirname(ref),
+                        "blastn -db {}/{}  -query {}/assembly/{}_contigs.fasta -task megablast -num_threads {} -outfmt {} {}\n".format(
+                            self.staged(os.path.dirname(ref)),
                             ref_nosuf,
                             self.finishdir,
                             self.name,
-                            self.finishdir,
-                            name,
-                            ref_nosuf,
-                            self.config["slurm_header"]["threads"],
+                            self.threads,
                             blast_format,
+                            self.output_redirect(
+                                "{}/blast_search/{}/{}.txt".format(self.finishdir, name, ref_nosuf),
+                                "-out",
+                            ),
                         )
                     )
         elif len(file_list) == 1:
@@ -275,16 +503,16 @@ class Job_Creator:
                 )
             )
             batchfile.write(
-                "blastn -db {}/{}  -query {}/assembly/{}_contigs.fasta -out {}/blast_search/{}/{}.txt -task megablast -num_threads {} -outfmt {}\n".format(
-                    os.path.dirname(search_string),
+                "blastn -db {}/{}  -query {}/assembly/{}_contigs.fasta -task megablast -num_threads {} -outfmt {} {}\n".format(
+                    self.staged(os.path.dirname(search_string)),
                     ref_nosuf,
                     self.finishdir,
                     self.name,
-                    self.finishdir,
-                    name,
-                    ref_nosuf,
-                    self.config["slurm_header"]["threads"],
+                    self.threads,
                     blast_format,
+                    self.output_redirect(
+                        "{}/blast_search/{}/{}.txt".format(self.finishdir, name, ref_nosuf), "-out"
+                    ),
                 )
             )
         batchfile.write("\n")
@@ -299,39 +527,69 @@ class Job_Creator:
         # Create run
         batchfile = open(self.batchfile, "a+")
         batchfile.write("# Variant calling based on local alignment\n")
-        batchfile.write("mkdir {}\n".format(localdir))
-
-        batchfile.write("## Alignment & Deduplication\n")
-        batchfile.write(
-            "bwa mem -M -t {} {} {} {} > {}.sam\n".format(
-                self.config["slurm_header"]["threads"],
-                ref,
-                self.concat_files["f"],
-                self.concat_files["r"],
-                outbase,
+        batchfile.write("mkdir -p {}\n".format(localdir))
+
+        alignments = {
+            "sorted.bam": "{}.bam_sort".format(outbase),
+            "rmdup.bam": "{}.bam_sort_rmdup".format(outbase),
+            "rmdup.bam.bai": "{}.bam_sort_rmdup.bai".format(outbase),
+            "dup.stats": "{}.stats.dup".format(outbase),
+        }
+        cached = None
+        if self.cache and "reads" in self.cache_keys:
+            if os.path.isfile(ref):
+                reference = cached_checksums([ref])[ref]
+            else:
+                reference = ref
+            key = artifact_key(
+                [self.cache_keys["reads"], reference],
+                ["bwa", "samtools", "picard"],
+                {"bwa": BWA_OPTIONS, "markdup": MARKDUP_OPTIONS},
             )
-        )
-        batchfile.write(
-            "samtools view --threads {} -b -o {}.bam -T {} {}.sam\n".format(
-                self.config["slurm_header"]["threads"], outbase, ref, outbase
+            self.cache_keys["alignment"] = key
+            cached = self.cache.lookup("alignment", key, self.name)
+        if cached:
+            batchfile.write("## Alignment from the cache\n")
+            batchfile.write(self.cache.link_commands("alignment", key, alignments))
+        else:
+            batchfile.write("## Alignment & Deduplication\n")
+            batchfile.write(
+                "bwa mem {} -t {} {} {} {} > {}.sam\n".format(
+                    BWA_OPTIONS,
+                    self.threads,
+                    self.staged(ref),
+                    self.concat_files["f"],
+                    self.concat_files["r"],
+                    outbase,
+                )
             )
-        )
-        batchfile.write(
-            "samtools sort --threads {} -o {}.bam_sort {}.bam\n".format(
-                self.config["slurm_header"]["threads"], outbase, outbase
+            batchfile.write(
+                "samtools view --threads {} -b -o {}.bam -T {} {}.sam\n".format(
+                    self.threads, outbase, self.staged(ref), outbase
+                )
             )
-        )
-        batchfile.write(
-            "picard MarkDuplicates I={}.bam_sort O={}.bam_sort_rmdup M={}.stats.dup REMOVE_DUPLICATES=true\n".format(
-                outbase, outbase, outbase
+            batchfile.write(
+                "samtools sort --threads {} -o {}.bam_sort {}.bam\n".format(
+                    self.threads, outbase, outbase
+                )
             )
-        )
-        batchfile.write("samtools index {}.bam_sort_rmdup\n".format(outbase))
+            batchfile.write(
+                "picard MarkDuplicates I={}.bam_sort O={}.bam_sort_rmdup M={}.stats.dup {}\n".format(
+                    outbase, outbase, outbase, MARKDUP_OPTIONS
+                )
+            )
+            batchfile.write("samtools index {}.bam_sort_rmdup\n".format(outbase))
+            # Removal of temp aligment files
+            batchfile.write("rm {}.bam {}.sam\n".format(outbase, outbase))
+            if "alignment" in self.cache_keys:
+                batchfile.write(
+                    self.cache.store_commands("alignment", self.cache_keys["alignment"], alignments)
+                )
         batchfile.write(
-            "samtools idxstats {}.bam_sort_rmdup &> {}.stats.ref\n".format(outbase, outbase)
+            "samtools idxstats {}.bam_sort_rmdup {}\n".format(
+                outbase, self.output_redirect("{}.stats.ref".format(outbase))
+            )
         )
-        # Removal of temp aligment files
-        batchfile.write("rm {}.bam {}.sam\n".format(outbase, outbase))
 
         batchfile.write("## Primary stats generation\n")
         # Insert stats, dedupped
@@ -342,14 +600,22 @@ class Job_Creator:
         )
         # Coverage
         batchfile.write(
-            "samtools stats --coverage 1,10000,1 {}.bam_sort_rmdup |grep ^COV | cut -f 2- &> {}.stats.cov\n".format(
-                outbase, outbase
+            "samtools stats --coverage 1,10000,1 {}.bam_sort_rmdup | {{ grep ^COV || true; }} | cut -f 2- {}\n".format(
+                outbase, self.output_redirect("{}.stats.cov".format(outbase))
             )
         )
         # Mapped rate, no dedup,dedup in MWGS (trimming has no effect)!
-        batchfile.write("samtools flagstat {}.bam_sort &> {}.stats.map\n".format(outbase, outbase))
+        batchfile.write(
+            "samtools flagstat {}.bam_sort {}\n".format(
+                outbase, self.output_redirect("{}.stats.map".format(outbase))
+            )
+        )
         # Total reads, no dedup,dedup in MWGS (trimming has no effect)!
-        batchfile.write("samtools view -c {}.bam_sort &> {}.stats.raw\n".format(outbase, outbase))
+        batchfile.write(
+            "samtools view -c {}.bam_sort {}\n".format(
+                outbase, self.output_redirect("{}.stats.raw".format(outbase))
+            )
+        )
 
         batchfile.write("\n\n")
         batchfile.close()
@@ -369,9 +635,9 @@ class Job_Creator:
         files = self.verify_fastq()
         batchfile = open(self.batchfile, "a+")
         batchfile.write("#Trimmomatic section\n")
-        batchfile.write("mkdir {}\n".format(trimdir))
+        batchfile.write("mkdir -p {}\n".format(trimdir))
+        batchfile.write("PREPROC_START=$SECONDS\n")
 
-        batchfile.write("##Pre-concatination\n")
         for file in files:
             fullfile = "{}/{}".format(self.indir, file)
             # Even indexes = Forward
@@ -387,42 +653,100 @@ class Job_Creator:
         self.concat_files["r"] = "{}/trimmed/{}_reverse_reads.fastq.gz".format(
             self.finishdir, self.name
         )
-        batchfile.write("cat {} > {}\n".format(" ".join(forward), self.concat_files.get("f")))
-        batchfile.write("cat {} > {}\n".format(" ".join(reverse), self.concat_files.get("r")))
-
-        if self.trimmed:
-            fp = "{}/{}_trim_front_pair.fastq.gz".format(trimdir, outfile)
-            fu = "{}/{}_trim_front_unpair.fastq.gz".format(trimdir, outfile)
-            rp = "{}/{}_trim_rev_pair.fastq.gz".format(trimdir, outfile)
-            ru = "{}/{}_trim_rev_unpair.fastq.gz".format(trimdir, outfile)
-            batchfile.write("##Trimming section\n")
-            batchfile.write(
-                "trimmomatic PE -threads {} -phred33 {} {} {} {} {} {}\
-      ILLUMINACLIP:{}/NexteraPE-PE.fa:2:30:10 LEADING:3 TRAILING:3 SLIDINGWINDOW:4:15 MINLEN:36\n".format(
-                    self.config["slurm_header"]["threads"],
-                    self.concat_files.get("f"),
-                    self.concat_files.get("r"),
-                    fp,
-                    fu,
-                    rp,
-                    ru,
-                    self.config["folders"]["adapters"],
-                )
-            )
-
-            batchfile.write("## Interlaced trimmed files\n")
-            self.concat_files["f"] = fp
-            self.concat_files["r"] = rp
+        cached = None
+        if self.cache:
+            checksums = cached_checksums(forward + reverse)
+            key = artifact_key(
+                [checksums[file] for file in forward + reverse],
+                ["trimmomatic"] if self.trimmed else [],
+                {"trimmed": self.trimmed, "trimming": TRIM_STEPS},
+            )
+            self.cache_keys["reads"] = key
+            # Untrimmed reads are only concatenated, their key just chains the later artifacts
+            if self.trimmed:
+                cached = self.cache.lookup("reads", key, self.name)
+        if cached:
+            self.concat_files["f"] = "{}/{}_trim_front_pair.fastq.gz".format(trimdir, outfile)
+            self.concat_files["r"] = "{}/{}_trim_rev_pair.fastq.gz".format(trimdir, outfile)
             self.concat_files["i"] = "{}/{}_trim_unpair.fastq.gz".format(trimdir, outfile)
+            batchfile.write("##Trimmed reads from the cache\n")
+            batchfile.write(self.cache.link_commands("reads", key, self.cached_reads()))
+        else:
+            forward = [self.staged(file) for file in forward]
+            reverse = [self.staged(file) for file in reverse]
+            trim_inputs = [self.concat_files.get("f"), self.concat_files.get("r")]
+            if self.stream_lanes and len(forward) == 1:
+                batchfile.write("##Linking single lane\n")
+                batchfile.write("ln -s {} {}\n".format(forward[0], self.concat_files.get("f")))
+                batchfile.write("ln -s {} {}\n".format(reverse[0], self.concat_files.get("r")))
+            elif self.stream_lanes and self.trimmed:
+                # Trimmomatic tells gzip from plain text by suffix, so lanes are decompressed into it
+                batchfile.write("##Lanes are streamed into trimming\n")
+                trim_inputs = [
+                    "<(zcat {})".format(" ".join(forward)),
+                    "<(zcat {})".format(" ".join(reverse)),
+                ]
+            else:
+                batchfile.write("##Pre-concatination\n")
+                batchfile.write(
+                    "cat {} > {}\n".format(" ".join(forward), self.concat_files.get("f"))
+                )
+                batchfile.write(
+                    "cat {} > {}\n".format(" ".join(reverse), self.concat_files.get("r"))
+                )
 
-            batchfile.write("cat {} >> {}\n".format(" ".join([fu, ru]), self.concat_files.get("i")))
+            if self.trimmed:
+                fp = "{}/{}_trim_front_pair.fastq.gz".format(trimdir, outfile)
+                fu = "{}/{}_trim_front_unpair.fastq.gz".format(trimdir, outfile)
+                rp = "{}/{}_trim_rev_pair.fastq.gz".format(trimdir, outfile)
+                ru = "{}/{}_trim_rev_unpair.fastq.gz".format(trimdir, outfile)
+                batchfile.write("##Trimming section\n")
+                batchfile.write(
+                    "trimmomatic PE -threads {} -phred33 {} {} {} {} {} {}\
+      ILLUMINACLIP:{}/NexteraPE-PE.fa:{}\n".format(
+                        self.threads,
+                        trim_inputs[0],
+                        trim_inputs[1],
+                        fp,
+                        fu,
+                        rp,
+                        ru,
+                        self.config["folders"]["adapters"],
+                        TRIM_STEPS,
+                    )
+                )
+
+                batchfile.write("## Interlaced trimmed files\n")
+                self.concat_files["f"] = fp
+                self.concat_files["r"] = rp
+                self.concat_files["i"] = "{}/{}_trim_unpair.fastq.gz".format(trimdir, outfile)
+
+                batchfile.write(
+                    "cat {} >> {}\n".format(" ".join([fu, ru]), self.concat_files.get("i"))
+                )
+            if self.cache and self.trimmed:
+                batchfile.write(self.cache.store_commands("reads", key, self.cached_reads()))
+        batchfile.write("## Preprocessing wall time and bytes written\n")
+        batchfile.write(
+            'printf "seconds\\tbytes\\n%s\\t%s\\n" $((SECONDS - PREPROC_START)) $(du -sb {} | cut -f1) > {}/preprocessing.stats\n'.format(
+                trimdir, self.finishdir
+            )
+        )
         batchfile.write("\n")
         batchfile.close()
 
+    def cached_reads(self):
+        """Trimmed read files of the sample, by their name in the cache"""
+        return {
+            "forward.fastq.gz": self.concat_files["f"],
+            "reverse.fastq.gz": self.concat_files["r"],
+            "unpaired.fastq.gz": self.concat_files["i"],
+        }
+
     def create_assemblystats_section(self):
         batchfile = open(self.batchfile, "a+")
         batchfile.write("# QUAST QC metrics\n")
-        batchfile.write("mkdir {}/assembly/quast\n".format(self.finishdir))
+        batchfile.write("mkdir -p {}/assembly/quast\n".format(self.finishdir))
         batchfile.write(
             "quast.py {}/assembly/{}_contigs.fasta -o {}/assembly/quast\n".format(
                 self.finishdir, self.name, self.finishdir
@@ -435,91 +759,143 @@ class Job_Creator:
         )
         batchfile.close()
 
-    def create_snpsection(self):
-        snplist = self.filelist.copy()
+    def environment(self):
+        """Lines that load the microSALT environment, for jobs that call microSALT itself"""
+        lines = ""
+        if "MICROSALT_CONFIG" in os.environ:
+            lines += "export MICROSALT_CONFIG={}\n".format(os.environ["MICROSALT_CONFIG"])
+        return lines + "source activate $CONDA_DEFAULT_ENV\n"
+
+    def create_ingestsection(self):
+        """Scrapes the results of this sample into the database as soon as it is done.
+        Reports cover the whole project, so they are left to the project job"""
+        custom_conf = ""
+        if "config_path" in self.config:
+            custom_conf = " --config {}".format(self.config["config_path"])
         batchfile = open(self.batchfile, "a+")
+        batchfile.write("# Ingests the results of this sample\n")
+        batchfile.write(self.environment())
+        batchfile.write(
+            "microSALT utils finish {0}/sampleinfo.json --input {0} --samples {1} --skip_update --scrape_only{2}\n\n".format(
+                self.project_dir, self.name, custom_conf
+            )
+        )
+        batchfile.close()
+
+    def write_sampleinfo(self):
+        """Stores the sample information of the run next to its results"""
+        with open("{}/sampleinfo.json".format(self.finishdir), "w+") as outfile:
+            json.dump(self.sampleinfo, outfile)
+
+    def snp_name(self, item):
+        """Sample name of an analysis folder given to the SNP job"""
         name = ""
+        if item.count("/") >= 2:
+            name = item.split("/")[-2]
+        if "_" in name:
+            name = name.split("_")[0]
+        return name
+
+    def create_snpsection(self, item):
+        """Writes variant calling and filtering of one sample.
+        freebayes runs over self.shards regions of the reference side by side"""
+        batchfile = open(self.batchfile, "a+")
+        name = self.snp_name(item)
 
         # VCFTools filters:
         vcffilter = "--minQ 30 --thin 50 --minDP 3 --min-meanDP 20"
         # BCFTools filters:
         bcffilter = "GL[0]<-500 & GL[1]=0 & QR/RO>30 & QA/AO>30 & QUAL>5000 & ODDS>1100 & GQ>140 & DP>100 & MQM>59 & SAP<15 & PAIRED>0.9 & EPP>3"
+        freebayes = "freebayes -= --pvar 0.7 -j -J --standard-filters -C 6 --min-coverage 30 --ploidy 1"
 
-        for item in snplist:
-            if item.count("/") >= 2:
-                name = item.split("/")[-2]
-            if "_" in name:
-                name = name.split("_")[0]
-            batchfile.write("# Basecalling for sample {}\n".format(name))
-            ref = "{}/{}.fasta".format(
-                self.config["folders"]["genomes"], self.sample.get("reference")
+        batchfile.write("# Basecalling for sample {}\n".format(name))
+        ref = "{}/{}.fasta".format(
+            self.config["folders"]["genomes"], self.sample.get("reference")
+        )
+        outbase = "{}/{}_{}".format(item, name, self.sample.get("reference"))
+        batchfile.write(
+            "samtools view -h -q 1 -F 4 -F 256 {}.bam_sort_rmdup | grep -v XA:Z | grep -v SA:Z| samtools view -b - > {}/{}.unique\n".format(
+                outbase, self.finishdir, name
             )
-            outbase = "{}/{}_{}".format(item, name, self.sample.get("reference"))
-            batchfile.write(
-                "samtools view -h -q 1 -F 4 -F 256 {}.bam_sort_rmdup | grep -v XA:Z | grep -v SA:Z| samtools view -b - > {}/{}.unique\n".format(
-                    outbase, self.finishdir, name
+        )
+        regions = list()
+        if self.shards > 1:
+            if os.path.isfile(ref):
+                lengths = [(entry.name, entry.length) for entry in index_fasta(ref)]
+                regions = split_regions(lengths, self.shards)
+            else:
+                self.logger.warning(
+                    "Reference {} not found, calling {} without sharding".format(ref, name)
                 )
+        if len(regions) > 1:
+            sharddir = "{}/{}_shards".format(self.finishdir, name)
+            os.makedirs(sharddir, exist_ok=True)
+            batchfile.write(
+                "# freebayes over {} regions of the reference side by side\n".format(len(regions))
             )
+            batchfile.write('SHARD_PIDS=""\n')
+            for index, shard in enumerate(regions):
+                with open("{}/{}.bed".format(sharddir, index), "w") as bed:
+                    for chrom, begin, stop in shard:
+                        bed.write("{}\t{}\t{}\n".format(chrom, begin, stop))
+                batchfile.write(
+                    "{} -f {} -t {}/{}.bed -b {}/{}.unique -v {}/{}.vcf &\n".format(
+                        freebayes, ref, sharddir, index, self.finishdir, name, sharddir, index
+                    )
+                )
+                batchfile.write('SHARD_PIDS="$SHARD_PIDS $!"\n')
+            batchfile.write("for pid in $SHARD_PIDS; do wait $pid; done\n")
             batchfile.write(
-                "freebayes -= --pvar 0.7 -j -J --standard-filters -C 6 --min-coverage 30 --ploidy 1 -f {} -b {}/{}.unique -v {}/{}.vcf\n".format(
-                    ref, self.finishdir, name, self.finishdir, name
+                "bcftools concat -O v -o {}/{}.vcf {}\n".format(
+                    self.finishdir,
+                    name,
+                    " ".join("{}/{}.vcf".format(sharddir, index) for index in range(len(regions))),
                 )
             )
+        else:
             batchfile.write(
-                "bcftools view {}/{}.vcf -o {}/{}.bcf.gz -O b --exclude-uncalled --types snps\n".format(
-                    self.finishdir, name, self.finishdir, name
+                "{} -f {} -b {}/{}.unique -v {}/{}.vcf\n".format(
+                    freebayes, ref, self.finishdir, name, self.finishdir, name
                 )
             )
-            batchfile.write("bcftools index {}/{}.bcf.gz\n".format(self.finishdir, name))
-            batchfile.write("\n")
+        batchfile.write(
+            "bcftools view {}/{}.vcf -o {}/{}.bcf.gz -O b --exclude-uncalled --types snps\n".format(
+                self.finishdir, name, self.finishdir, name
+            )
+        )
+        batchfile.write("bcftools index {}/{}.bcf.gz\n".format(self.finishdir, name))
+        batchfile.write("\n")
 
-            batchfile.write(
-                "vcftools --bcf {}/{}.bcf.gz {} --remove-filtered-all --recode-INFO-all --recode-bcf --out {}/{}\n".format(
-                    self.finishdir, name, vcffilter, self.finishdir, name
-                )
+        batchfile.write(
+            "vcftools --bcf {}/{}.bcf.gz {} --remove-filtered-all --recode-INFO-all --recode-bcf --out {}/{}\n".format(
+                self.finishdir, name, vcffilter, self.finishdir, name
             )
-            batchfile.write(
-                'bcftools view {}/{}.recode.bcf -i "{}" -o {}/{}.recode.bcf.gz -O b --exclude-uncalled --types snps\n'.format(
-                    self.finishdir, name, bcffilter, self.finishdir, name
-                )
+        )
+        batchfile.write(
+            'bcftools view {}/{}.recode.bcf -i "{}" -o {}/{}.recode.bcf.gz -O b --exclude-uncalled --types snps\n'.format(
+                self.finishdir, name, bcffilter, self.finishdir, name
             )
-            batchfile.write("bcftools index {}/{}.recode.bcf.gz\n\n".format(self.finishdir, name))
+        )
+        batchfile.write("bcftools index {}/{}.recode.bcf.gz\n".format(self.finishdir, name))
+        # Sites read by the distance step
+        batchfile.write(
+            "bcftools query -f '%CHROM\\t%POS\\n' {}/{}.recode.bcf.gz > {}/{}{}\n\n".format(
+                self.finishdir, name, self.finishdir, name, SITES_SUFFIX
+            )
+        )
+        batchfile.close()
 
+    def create_distancesection(self, names):
+        """Writes the pair-wise distances of all samples. Every sample is read once"""
+        batchfile = open(self.batchfile, "a+")
         batchfile.write("# SNP pair-wise distance\n")
-        batchfile.write("touch {}/stats.out\n".format(self.finishdir))
-        while len(snplist) > 1:
-            nameOne = ""
-            nameTwo = ""
-            top = snplist.pop(0)
-            if top.count("/") >= 2:
-                nameOne = top.split("/")[-2]
-            if "_" in nameOne:
-                nameOne = nameOne.split("_")[0]
-            for entry in snplist:
-                if entry.count("/") >= 2:
-                    nameTwo = entry.split("/")[-2]
-                if "_" in nameTwo:
-                    nameTwo = nameTwo.split("_")[0]
-
-                pair = "{}_{}".format(nameOne, nameTwo)
-                batchfile.write(
-                    "bcftools isec {}/{}.recode.bcf.gz {}/{}.recode.bcf.gz -n=1 -c all -p {}/tmp -O b\n".format(
-                        self.finishdir, nameOne, self.finishdir, nameTwo, self.finishdir
-                    )
-                )
-                batchfile.write(
-                    "bcftools merge -O b -o {}/{}.bcf.gz --force-samples {}/tmp/0000.bcf {}/tmp/0001.bcf\n".format(
-                        self.finishdir, pair, self.finishdir, self.finishdir
-                    )
-                )
-                batchfile.write("bcftools index {}/{}.bcf.gz\n".format(self.finishdir, pair))
-
-                batchfile.write(
-                    "echo {} $( bcftools stats {}/{}.bcf.gz |grep SNPs: | cut -d $'\\t' -f4 ) >> {}/stats.out\n".format(
-                        pair, self.finishdir, pair, self.finishdir
-                    )
-                )
-                batchfile.write("\n")
+        batchfile.write(self.environment())
+        batchfile.write(
+            "microSALT utils snpdistance {} --output {}\n\n".format(
+                " ".join("{}/{}{}".format(self.finishdir, name, SITES_SUFFIX) for name in names),
+                self.finishdir,
+            )
+        )
         batchfile.close()
 
     def create_collection(self):
@@ -575,6 +951,51 @@ class Job_Creator:
         except Exception as e:
             self.logger.error("Unable to add sample {} to database".format(self.name))
 
+    def preflight_stats(self, sampledirs):
+        """Read statistics of the input fastqs of each sample, computed in a process pool
+        before any job is created. Takes and returns dicts keyed by sample name"""
+        files = dict()
+        for name, sampledir in sampledirs.items():
+            files[name] = [
+                "{}/{}".format(sampledir, file)
+                for file in sorted(os.listdir(sampledir))
+                if re.match(self.config["regex"]["file_pattern"], file)
+            ]
+        per_file = cached_fastq_stats(
+            [file for filelist in files.values() for file in filelist],
+            workers=int(self.config["slurm_header"]["threads"]),
+        )
+        stats = dict()
+        for name, filelist in files.items():
+            stats[name] = sample_stats([per_file[file] for file in filelist])
+            self.logger.info(
+                "Sample {} has {} reads, {} bases, mean quality {:.1f} and {:.1%} Q30 bases".format(
+                    name,
+                    stats[name]["input_reads"],
+                    stats[name]["input_bases"],
+                    stats[name]["input_mean_quality"],
+                    stats[name]["input_q30"],
+                )
+            )
+        return stats
+
+    def preflight_gate(self, name, stats, sampleinfo):
+        """Early QC on input read counts. Samples without reads are not analysed.
+        Low counts are judged like the total reads of the QC report"""
+        if stats["input_reads"] == 0:
+            self.logger.error("Sample {} has no input reads. Skipping analysis".format(name))
+            return False
+        tag = sampleinfo.get("application_tag") or ""
+        if tag[-1:].isdigit() and int(tag[-1:]) != 0:
+            perc = stats["input_reads"] * 100.0 / (int(tag[-1:]) * 2000000)
+            if perc < self.config["threshold"]["total_reads_fail"]:
+                self.logger.warning(
+                    "Sample {} has only {:.2f}% of the reads expected by application tag {}".format(
+                        name, perc, tag
+                    )
+                )
+        return True
+
     def project_job(self, single_sample=False):
         if "dry" in self.config and self.config["dry"] == True:
             dry = True
@@ -595,23 +1016,41 @@ class Job_Creator:
             self.logger.error(
                 "LIMS interaction failed. Unable to read/write project {}".format(self.name)
             )
+        # Pre-flight read statistics
+        input_stats = dict()
+        if self.preflight:
+            if single_sample:
+                sampledirs = {self.name: self.indir}
+            else:
+                sampledirs = {
+                    os.path.basename(os.path.normpath(ldir)): os.path.normpath(ldir)
+                    for ldir in glob.glob("{}/*/".format(self.indir))
+                }
+            try:
+                input_stats = self.preflight_stats(sampledirs)
+            except Exception as e:
+                self.logger.warning("Unable to compute pre-flight read statistics ({})".format(e))
+        # Sample jobs ingesting their own results need the sample information up front
+        if self.incremental:
+            self.write_sampleinfo()
         # Writes the job creation sbatch
         if single_sample:
             try:
+                if self.name in input_stats:
+                    self.input_stats = input_stats[self.name]
+                    if not self.preflight_gate(self.name, self.input_stats, self.sample):
+                        return
                 self.sample_job()
-                headerargs = self.get_headerargs()
-                outfile = self.get_sbatch()
-                bash_cmd = "sbatch {} {}".format(headerargs, outfile)
-                if not dry and outfile != "":
-                    samproc = subprocess.Popen(bash_cmd.split(), stdout=subprocess.PIPE)
-                    output, error = samproc.communicate()
-                    jobno = re.search(r"(\d+)", str(output)).group(0)
-                    jobarray.append(jobno)
+                if self.steps:
+                    jobarray.extend(self.submit_steps())
                 else:
-                    self.logger.info("Suppressed command: {}".format(bash_cmd))
+                    jobno = self.submit_sample()
+                    if jobno is not None:
+                        jobarray.append(jobno)
             except Exception as e:
                 self.logger.error("Unable to analyze single sample {}".format(self.name))
         else:
+            runfiles = list()
             for ldir in glob.glob("{}/*/".format(self.indir)):
                 ldir = os.path.basename(os.path.normpath(ldir))
                 try:
@@ -623,9 +1062,15 @@ class Job_Creator:
                         raise Exception("Sample {} has no counterpart in json file".format(ldir))
                     else:
                         local_sampleinfo = local_sampleinfo[0]
+                    if ldir in input_stats and not self.preflight_gate(
+                        ldir, input_stats[ldir], local_sampleinfo
+                    ):
+                        continue
                     sample_settings = dict(self.run_settings)
+                    sample_settings["input_stats"] = input_stats.get(ldir)
                     sample_settings["input"] = sample_in
                     sample_settings["finishdir"] = sample_out
+                    sample_settings["project_dir"] = self.finishdir
                     sample_settings["timestamp"] = self.now
                     sample_instance = Job_Creator(
                         config=self.config,
@@ -633,23 +1078,32 @@ class Job_Creator:
                         sampleinfo=local_sampleinfo,
                         run_settings=sample_settings,
                     )
+                    sample_instance.executor = self.executor
                     sample_instance.sample_job()
-                    headerargs = sample_instance.get_headerargs()
-                    outfile = ""
-                    if os.path.isfile(sample_instance.get_sbatch()):
-                        outfile = sample_instance.get_sbatch()
-                    bash_cmd = "sbatch {} {}".format(headerargs, outfile)
-                    if not dry and outfile != "":
-                        projproc = subprocess.Popen(bash_cmd.split(), stdout=subprocess.PIPE)
-                        output, error = projproc.communicate()
-                        jobno = re.search(r"(\d+)", str(output)).group(0)
+                    if self.steps:
+                        jobarray.extend(sample_instance.submit_steps())
+                        continue
+                    if self.array:
+                        if os.path.isfile(sample_instance.get_sbatch()):
+                            runfiles.append(
+                                (
+                                    sample_instance.get_sbatch(),
+                                    "{}/slurm_{}.log".format(sample_out, ldir),
+                                )
+                            )
+                        continue
+                    jobno = sample_instance.submit_sample()
+                    if jobno is not None:
                         jobarray.append(jobno)
-                    else:
-                        self.logger.info("Suppressed command: {}".format(bash_cmd))
                 except Exception as e:
                     pass
+            if runfiles:
+                jobarray = self.array_job(runfiles)
         if not dry:
             self.finish_job(jobarray, single_sample)
+            failed = self.executor.wait()
+            if failed:
+                self.logger.error("Jobs {} of {} did not succeed".format(", ".join(failed), self.name))
 
     def finish_job(self, joblist, single_sample=False):
         """ Uploads data and sends an email once all analysis jobs are complete. """
@@ -669,9 +1123,7 @@ class Job_Creator:
         startfile = "{}/run_started.out".format(self.finishdir)
         configfile = "{}/config.log".format(self.finishdir)
         mailfile = "{}/mailjob.sh".format(self.finishdir)
-        samplefile = "{}/sampleinfo.json".format(self.finishdir)
-        with open(samplefile, "w+") as outfile:
-            json.dump(self.sampleinfo, outfile)
+        self.write_sampleinfo()
 
         sb = open(startfile, "w+")
         cb = open(configfile, "w+")
@@ -687,9 +1139,7 @@ class Job_Creator:
         cb.close()
         mb.write("#!/usr/bin/env bash\n\n")
         mb.write("#Uploading of results to database and production of report\n")
-        if "MICROSALT_CONFIG" in os.environ:
-            mb.write("export MICROSALT_CONFIG={}\n".format(os.environ["MICROSALT_CONFIG"]))
-        mb.write("source activate $CONDA_DEFAULT_ENV\n")
+        mb.write(self.environment())
 
         mb.write(
             "microSALT utils finish {0}/sampleinfo.json --input {0} --email {1} --report {2} {3}\n".format(
@@ -716,36 +1166,31 @@ class Job_Creator:
                 i += maxlen
             for entry in massagedJobs:
                 if massagedJobs.index(entry) < len(massagedJobs) - 1:
-                    head = "-A {} -p core -n 1 -t 00:00:10 -J {}_{}_SUBTRACKER --qos {} --dependency=afterany:{}".format(
-                        self.config["slurm_header"]["project"],
-                        self.config["slurm_header"]["job_prefix"],
-                        self.name,
-                        self.config["slurm_header"]["qos"],
-                        entry,
+                    jobno = self.executor.submit(
+                        startfile,
+                        "{}_SUBTRACKER".format(self.name),
+                        partition="core",
+                        threads=1,
+                        time="00:00:10",
+                        dependencies=entry.split(":"),
+                        after="afterany",
                     )
-                    bash_cmd = "sbatch {} {}".format(head, startfile)
-                    mailproc = subprocess.Popen(bash_cmd.split(), stdout=subprocess.PIPE)
-                    output, error = mailproc.communicate()
-                    jobno = re.search(r"(\d+)", str(output)).group(0)
                     massagedJobs[massagedJobs.index(entry) + 1] += ":{}".format(jobno)
                 else:
                     final = entry
                     break
 
-        head = "-A {} -p core -n 1 -t 6:00:00 -J {}_{}_MAILJOB --qos {} --open-mode append --dependency=afterany:{} --output {}".format(
-            self.config["slurm_header"]["project"],
-            self.config["slurm_header"]["job_prefix"],
-            self.name,
-            self.config["slurm_header"]["qos"],
-            final,
-            self.config["folders"]["log_file"],
-            self.config["regex"]["mail_recipient"],
+        jobno = self.executor.submit(
+            mailfile,
+            "{}_MAILJOB".format(self.name),
+            logfile=self.config["folders"]["log_file"],
+            partition="core",
+            threads=1,
+            time="6:00:00",
+            dependencies=[job for job in final.split(":") if job],
+            after="afterany",
+            extra="--open-mode append",
         )
-        bash_cmd = "sbatch {} {}".format(head, mailfile)
-        mailproc = subprocess.Popen(bash_cmd.split(), stdout=subprocess.PIPE)
-        output, error = mailproc.communicate()
-
-        jobno = str(re.search(r"(\d+)", str(output)).group(0))
         joblist.append(jobno)
 
         try:
@@ -772,18 +1217,39 @@ class Job_Creator:
             if not os.path.exists(self.finishdir):
                 os.makedirs(self.finishdir)
             try:
-                # This is one job
-                self.batchfile = "{}/runfile.sbatch".format(self.finishdir)
-                batchfile = open(self.batchfile, "w+")
-                batchfile.write("#!/bin/sh\n\n")
-                batchfile.write("mkdir -p {}\n".format(self.finishdir))
-                batchfile.close()
-                self.create_preprocsection()
-                self.create_variantsection()
-                if not self.qc_only:
-                    self.create_assemblysection()
-                    self.create_assemblystats_section()
-                    self.create_blast_search()
+                if self.sizing:
+                    self.size_resources()
+                if self.steps:
+                    if self.scratch:
+                        self.logger.warning(
+                            "Steps of {} may run on different nodes, scratch staging is skipped".format(
+                                self.name
+                            )
+                        )
+                    self.create_stepfiles()
+                else:
+                    # This is one job
+                    self.batchfile = "{}/runfile.sbatch".format(self.finishdir)
+                    batchfile = open(self.batchfile, "w+")
+                    batchfile.write("#!/bin/bash\n\n")
+                    if self.compress:
+                        # Output is piped through the compressor, failures must not be masked by it
+                        batchfile.write("set -o pipefail\n")
+                    batchfile.write("mkdir -p {}\n".format(self.finishdir))
+                    batchfile.close()
+                    if self.scratch:
+                        self.create_stagingsection()
+                        # Sections write under scratch, only the copy back sees the results folder
+                        finishdir, self.finishdir = self.finishdir, "$SCRATCH/work"
+                        try:
+                            self.write_sections()
+                        finally:
+                            self.finishdir = finishdir
+                        self.create_copybacksection()
+                    else:
+                        self.write_sections()
+                    if self.incremental:
+                        self.create_ingestsection()
                 batchfile = open(self.batchfile, "a+")
                 batchfile.close()
 
@@ -794,6 +1260,10 @@ class Job_Creator:
                 raise
             try:
                 self.create_sample(self.name)
+                if self.input_stats:
+                    self.db_pusher.upd_rec(
+                        {"CG_ID_sample": self.name}, "Samples", self.input_stats
+                    )
             except Exception as e:
                 self.logger.error("Unable to access LIMS info for sample {}".format(self.name))
         except Exception as e:
@@ -803,9 +1273,207 @@ class Job_Creator:
             shutil.rmtree(self.finishdir, ignore_errors=True)
             raise
 
+    def write_sections(self):
+        """Writes the analysis sections of a single sample job"""
+        self.create_preprocsection()
+        if self.parallel and not self.qc_only:
+            # bwa finishes long before SPAdes, so it gets the smaller share
+            align_threads = max(1, int(self.threads) // 4)
+            assembly = [
+                self.create_assemblysection,
+                self.create_assemblystats_section,
+                self.create_blast_search,
+            ]
+            self.create_parallel_sections(
+                [
+                    ("alignment", [self.create_variantsection], align_threads),
+                    ("assembly", assembly, max(1, int(self.threads) - align_threads)),
+                ]
+            )
+        else:
+            self.create_variantsection()
+            if not self.qc_only:
+                self.create_assemblysection()
+                self.create_assemblystats_section()
+                self.create_blast_search()
+
+    def staged(self, path):
+        """Node-local copy of path when its folder is staged to scratch, else path itself"""
+        for folder, local in self.staging:
+            if path == folder or path.startswith("{}/".format(folder)):
+                return local + path[len(folder) :]
+        return path
+
+    def create_stagingsection(self):
+        """Copies the input reads, the reference genome with its bwa index and the BLAST
+        databases to node-local scratch. Later sections write under scratch until
+        the copy back. The scratch folder is removed however the job ends"""
+        root = self.config["folders"].get("scratch") or "${TMPDIR:-/tmp}"
+        genome = "{}/{}.fasta".format(self.config["folders"]["genomes"], self.sample.get("reference"))
+        inputs = sorted(
+            file
+            for file in os.listdir(self.indir)
+            if re.match(self.config["regex"]["file_pattern"], file)
+        )
+        batchfile = open(self.batchfile, "a+")
+        batchfile.write(
+            "# Heavy I/O runs in node-local scratch, deliverables are copied back at the end\n"
+        )
+        batchfile.write("mkdir -p {}\n".format(root))
+        batchfile.write("SCRATCH=$(mktemp -d {}/microSALT_{}.XXXXXX)\n".format(root, self.name))
+        batchfile.write("trap 'rm -rf \"$SCRATCH\"' EXIT\n")
+        batchfile.write("trap 'exit 143' TERM INT\n")
+        # Keeps the first failing status, results of a failed job are not copied back
+        batchfile.write("trap 'FAILED=${FAILED:-$?}' ERR\n")
+        batchfile.write("mkdir -p $SCRATCH/work $SCRATCH/input $SCRATCH/genome\n")
+        batchfile.write("## Staging input reads\n")
+        batchfile.write(
+            "cp {} $SCRATCH/input/\n".format(
+                " ".join("{}/{}".format(self.indir, file) for file in inputs)
+            )
+        )
+        batchfile.write("## Staging reference genome and its index\n")
+        batchfile.write("cp {}* $SCRATCH/genome/\n".format(genome))
+        self.staging = [
+            (self.indir, "$SCRATCH/input"),
+            (os.path.dirname(genome), "$SCRATCH/genome"),
+        ]
+        if not self.qc_only:
+            reforganism = self.ref_resolver.organism2reference(self.sample.get("organism"))
+            databases = [(self.config["folders"]["resistances"], "resistance")]
+            if reforganism:
+                databases.append(
+                    ("{}/{}".format(self.config["folders"]["references"], reforganism), "mlst")
+                )
+            if reforganism == "escherichia_coli":
+                databases.append((os.path.dirname(self.config["folders"]["expec"]), "expec"))
+            batchfile.write("## Staging BLAST databases\n")
+            for folder, name in databases:
+                folder = folder.rstrip("/")
+                if os.path.isdir(folder):
+                    batchfile.write("cp -r {} $SCRATCH/{}\n".format(folder, name))
+                    self.staging.append((folder, "$SCRATCH/{}".format(name)))
+        batchfile.write("\n")
+        batchfile.close()
+
+    def create_copybacksection(self):
+        """Copies the deliverables and the files read by the scraper back from scratch.
+        If any command failed the job exits with its status instead"""
+        patterns = [
+            path.format(sample="*", reference=self.sample.get("reference"))
+            for format, path, step, tag in SAMPLE_DELIVERABLES
+        ]
+        patterns.extend(SCRAPED_FILES)
+        patterns.extend(ALIGNMENT_FILES)
+        patterns.append("preprocessing.stats")
+        batchfile = open(self.batchfile, "a+")
+        batchfile.write("# Copies deliverables and scraped results back from scratch\n")
+        batchfile.write(
+            'if [ -n "$FAILED" ]; then echo "A command failed with status $FAILED, nothing is copied back to {}" >&2; exit $FAILED; fi\n'.format(
+                self.finishdir
+            )
+        )
+        batchfile.write("cd $SCRATCH/work\n")
+        batchfile.write("for file in {}; do\n".format(" ".join(patterns)))
+        batchfile.write(
+            '  if [ -e "$file" ]; then cp -L --parents "$file" {}/; fi\n'.format(self.finishdir)
+        )
+        batchfile.write("done\n")
+        batchfile.write("cd {}\n\n".format(self.finishdir))
+        batchfile.close()
+
+    def create_parallel_sections(self, sections):
+        """Writes sections as background subshells followed by a wait barrier.
+        sections holds (name, writers, threads) tuples. The job fails if any section fails"""
+        for name, writers, threads in sections:
+            batchfile = open(self.batchfile, "a+")
+            batchfile.write("# Section {} runs in the background on {} threads\n".format(name, threads))
+            batchfile.write("(\nset -e\n")
+            batchfile.close()
+            self.threads = threads
+            for writer in writers:
+                writer()
+            batchfile = open(self.batchfile, "a+")
+            batchfile.write(") &\n")
+            batchfile.write("{}_PID=$!\n\n".format(name.upper()))
+            batchfile.close()
+        self.threads = self.resources["threads"]
+
+        batchfile = open(self.batchfile, "a+")
+        batchfile.write("# Waits for all sections and keeps the first failure\n")
+        batchfile.write("SECTIONS_STATUS=0\n")
+        for name, writers, threads in sections:
+            batchfile.write(
+                'wait ${0}_PID || {{ STATUS=$?; echo "Section {1} failed with status $STATUS" >&2; [ $SECTIONS_STATUS -ne 0 ] || SECTIONS_STATUS=$STATUS; }}\n'.format(
+                    name.upper(), name
+                )
+            )
+        batchfile.write("[ $SECTIONS_STATUS -eq 0 ] || exit $SECTIONS_STATUS\n\n")
+        batchfile.close()
+
+    def create_stepfiles(self):
+        """Writes one runfile per analysis step. Alignment and assembly only need the
+        trimmed reads, so they run side by side once preprocessing is done"""
+        sections = [
+            ("preproc", [self.create_preprocsection], []),
+            ("alignment", [self.create_variantsection], ["preproc"]),
+        ]
+        if not self.qc_only:
+            sections.append(
+                ("assembly", [self.create_assemblysection, self.create_assemblystats_section], ["preproc"])
+            )
+            sections.append(("blast", [self.create_blast_search], ["assembly"]))
+        if self.incremental:
+            finals = ["alignment"] if self.qc_only else ["alignment", "blast"]
+            sections.append(("ingest", [self.create_ingestsection], finals))
+        self.stepfiles = list()
+        for step, writers, after in sections:
+            self.batchfile = "{}/runfile_{}.sbatch".format(self.finishdir, step)
+            self.threads = self.step_settings(step)["threads"]
+            self.mem = self.step_settings(step)["mem"]
+            with open(self.batchfile, "w") as batchfile:
+                batchfile.write("#!/bin/bash\n\n")
+                # A failing command has to fail the step, or afterok dependents would start
+                batchfile.write("set -e\n")
+                if self.compress:
+                    batchfile.write("set -o pipefail\n")
+            for writer in writers:
+                writer()
+            self.stepfiles.append((step, self.batchfile, after))
+        self.threads = self.resources["threads"]
+        self.mem = self.resources["mem"]
+
+    def submit_sample(self):
+        """Submits the runfile of a sample. Returns its job id, or None if nothing was submitted"""
+        if not os.path.isfile(self.get_sbatch()):
+            return None
+        return self.executor.submit(
+            self.get_sbatch(),
+            self.name,
+            logfile="{}/slurm_{}.log".format(self.finishdir, self.name),
+            **self.resources
+        )
+
+    def submit_steps(self):
+        """Submits the step runfiles of a sample with afterok dependencies. Returns their job ids"""
+        jobs = dict()
+        for step, runfile, after in self.stepfiles:
+            settings = self.step_settings(step)
+            jobno = self.executor.submit(
+                runfile,
+                "{}_{}".format(self.name, step),
+                logfile="{}/slurm_{}_{}.log".format(self.finishdir, self.name, step),
+                threads=settings["threads"],
+                time=settings["time"],
+                mem=settings["mem"],
+                dependencies=[jobs[prev] for prev in after if prev in jobs],
+            )
+            if jobno is not None:
+                jobs[step] = jobno
+        return list(jobs.values())
+
     def create_blast_search(self):
         reforganism = self.ref_resolver.organism2reference(self.sample.get("organism"))
-        self.batchfile = "{}/runfile.sbatch".format(self.finishdir)
         batchfile = open(self.batchfile, "a+")
         batchfile.write("mkdir -p {}/blast_search\n".format(self.finishdir))
         batchfile.close()
@@ -822,32 +1490,49 @@ class Job_Creator:
             self.blast_subset("expec", ss)
 
     def snp_job(self):
-        """ Writes a SNP calling job for a set of samples """
+        """Submits variant calling of every sample as parallel jobs,
+        followed by a distance job that depends on all of them"""
         if not os.path.exists(self.finishdir):
             os.makedirs(self.finishdir)
 
+        names = list()
+        runfiles = list()
+        for item in self.filelist:
+            names.append(self.snp_name(item))
+            self.batchfile = "{}/runfile_{}.sbatch".format(self.finishdir, names[-1])
+            batchfile = open(self.batchfile, "w+")
+            batchfile.write("#!/usr/bin/env bash\n\nset -e\n")
+            batchfile.write("mkdir -p {}\n\n".format(self.finishdir))
+            batchfile.close()
+            self.create_snpsection(item)
+            runfiles.append(
+                (self.batchfile, "{}/slurm_{}_snp.log".format(self.finishdir, names[-1]))
+            )
+
+        if self.array:
+            jobs = self.array_job(runfiles, threads=self.shards)
+        else:
+            jobs = list()
+            for name, (runfile, logfile) in zip(names, runfiles):
+                jobno = self.executor.submit(
+                    runfile, "{}_snp".format(name), logfile=logfile, threads=self.shards
+                )
+                if jobno is not None:
+                    jobs.append(jobno)
+
         self.batchfile = "{}/runfile.sbatch".format(self.finishdir)
         batchfile = open(self.batchfile, "w+")
-        batchfile.write("#!/usr/bin/env bash\n")
-        batchfile.write("mkdir -p {}\n\n".format(self.finishdir))
-        batchfile.close()
-
-        self.create_snpsection()
-        batchfile = open(self.batchfile, "a+")
+        batchfile.write("#!/usr/bin/env bash\n\nset -e\n\n")
         batchfile.close()
-
-        headerline = (
-            "-A {} -p {} -n 1 -t 24:00:00 -J {}_{} --qos {} --output {}/slurm_{}.log".format(
-                self.config["slurm_header"]["project"],
-                self.config["slurm_header"]["type"],
-                self.config["slurm_header"]["job_prefix"],
-                self.name,
-                self.config["slurm_header"]["qos"],
-                self.finishdir,
-                self.name,
-            )
+        self.create_distancesection(names)
+
+        self.executor.submit(
+            self.get_sbatch(),
+            "{}_snpdistance".format(self.name),
+            logfile="{}/slurm_{}.log".format(self.finishdir, self.name),
+            threads=1,
+            dependencies=jobs,
         )
-        outfile = self.get_sbatch()
-        bash_cmd = "sbatch {} {}".format(headerline, outfile)
-        samproc = subprocess.Popen(bash_cmd.split(), stdout=subprocess.PIPE)
-        output, error = samproc.communicate()
+        failed = self.executor.wait()
+        if failed:
+            self.logger.error("SNP jobs {} did not succeed".format(", ".join(failed)))
@@ -14,6 +14,141 @@ import zipfile
 from Bio import Entrez
 import xml.etree.ElementTree as ET
 from microSALT.store.db_manipulator import DB_Manipulator
+from microSALT.utils.fasta import fasta_lengths, read_records, write_fai
+
+# Sidecar file kept next to each set of BLAST databases
+LENGTHS_INDEX = ".locilengths.json"
+# Database holding all sequences of a folder, searched with one blastn call
+MERGED_DB = "merged"
+
+
+def current_index(full_dir, suffix):
+    """Returns the sidecar index entries of all files with suffix in full_dir, keyed by file.
+       Returns None if the sidecar index is missing or older than any source file"""
+    try:
+        with open("{}/{}".format(full_dir, LENGTHS_INDEX), "r") as fh:
+            index = json.load(fh)
+    except (IOError, ValueError):
+        return None
+    entries = dict()
+    for file in os.listdir(full_dir):
+        if file.endswith(suffix) and not file.startswith("."):
+            entry = index.get(file)
+            if (
+                entry is None
+                or entry["mtime"] != os.stat("{}/{}".format(full_dir, file)).st_mtime
+            ):
+                return None
+            entries[file] = entry
+    return entries
+
+
+def load_lengths(full_dir, suffix):
+    """Returns the stored locus lengths of all files with suffix in full_dir.
+       Returns None if the sidecar index is missing or older than any source file"""
+    entries = current_index(full_dir, suffix)
+    if entries is None:
+        return None
+    lengths = dict()
+    for entry in entries.values():
+        lengths.update(entry["lengths"])
+    return lengths
+
+
+def load_sources(full_dir, suffix):
+    """Returns the source files, without suffix, holding each subject id of full_dir.
+       Returns None if the sidecar index is missing or older than any source file"""
+    entries = current_index(full_dir, suffix)
+    if entries is None:
+        return None
+    sources = dict()
+    for file, entry in sorted(entries.items()):
+        for header in entry["lengths"]:
+            sources.setdefault(header[1:].split()[0], []).append(file[: -len(suffix)])
+    return sources
+
+
+def merged_db(full_dir, suffix):
+    """Returns the path of the merged BLAST database of full_dir.
+       Returns None if it is missing or older than any source file with suffix"""
+    base = "{}/{}".format(full_dir, MERGED_DB)
+    # Large databases are split into volumes listed by an alias file
+    built = [
+        os.stat(file).st_mtime
+        for file in ["{}.nal".format(base), "{}.nsq".format(base)]
+        if os.path.isfile(file)
+    ]
+    if not built:
+        return None
+    for file in glob.glob("{}/*{}".format(full_dir, suffix)):
+        if os.stat(file).st_mtime > max(built):
+            return None
+    return base
+
+
+def merged_records(full_dir, suffix):
+    """Returns the number of records in the merged database of full_dir, or None if unknown"""
+    try:
+        with open("{}/.{}{}".format(full_dir, MERGED_DB, suffix), "r") as fh:
+            return sum(1 for line in fh if line.startswith(">"))
+    except IOError:
+        return None
+
+
+# Misspellings seen in order forms, as misspelled word: reference spelling
+ORGANISM_ALIASES = {"pneumonsiae": "pneumoniae"}
+
+
+class Reference_Resolver:
+    """Matches organism names against a snapshot of the reference folder names.
+       Results are cached per organism string until the folder changes"""
+
+    def __init__(self, folder, aliases):
+        self.folder = folder
+        self.aliases = aliases
+        self.mtime = None
+        self.targets = list()
+        self.pieces = dict()
+        self.resolved = dict()
+
+    def refresh(self):
+        """Snapshots the folder again if it changed since the last call"""
+        mtime = os.stat(self.folder).st_mtime_ns
+        if mtime != self.mtime:
+            self.targets = os.listdir(self.folder)
+            self.pieces = dict()
+            self.resolved = dict()
+            self.mtime = mtime
+
+    def matches(self, piece):
+        """Positions of the targets a single word of an organism name matches"""
+        if piece not in self.pieces:
+            alias = self.aliases.get(piece)
+            if len(piece) == 1:
+                hits = [target.startswith(piece) for target in self.targets]
+            else:
+                hits = [
+                    piece in target or (alias is not None and alias in target)
+                    for target in self.targets
+                ]
+            self.pieces[piece] = {pos for pos, hit in enumerate(hits) if hit}
+        return self.pieces[piece]
+
+    def resolve(self, normal_organism_name):
+        """Returns the first target, in listing order, matching every word. None if there is none"""
+        self.refresh()
+        if normal_organism_name not in self.resolved:
+            candidates = set(range(len(self.targets)))
+            for piece in re.split(r"\W+", normal_organism_name.lower()):
+                candidates &= self.matches(piece)
+            self.resolved[normal_organism_name] = (
+                self.targets[min(candidates)] if candidates else None
+            )
+        return self.resolved[normal_organism_name]
+
+
+# One resolver per reference folder, shared by all Referencers of a process
+resolvers = dict()
 
 
 class Referencer:
@@ -83,6 +218,11 @@ class Referencer:
 
         # Reindexes
         self.index_db(os.path.dirname(self.config["folders"]["expec"]), ".fsa")
+        for organism in os.listdir(self.config["folders"]["references"]):
+            orgdir = "{}/{}".format(self.config["folders"]["references"], organism)
+            if os.path.isdir(orgdir):
+                self.index_lengths(orgdir, ".tfa")
+                self.index_merged(orgdir, ".tfa")
 
     def index_db(self, full_dir, suffix):
         """Check for indexation, makeblastdb job if not enough of them."""
@@ -133,6 +273,71 @@ class Referencer:
                     )
         if reindexation:
             self.logger.info("Re-indexed contents of {}".format(full_dir))
+        self.index_lengths(full_dir, suffix)
+        self.index_merged(full_dir, suffix)
+
+    def index_merged(self, full_dir, suffix):
+        """Builds the merged database of all files with suffix in full_dir, unless current.
+           Identical records found in several files are stored once"""
+        sufx_files = sorted(glob.glob("{}/*{}".format(full_dir, suffix)))
+        if len(sufx_files) < 2 or merged_db(full_dir, suffix):
+            return
+        merged = "{}/.{}{}".format(full_dir, MERGED_DB, suffix)
+        try:
+            seen = set()
+            with open(merged, "w") as out:
+                for file in sufx_files:
+                    for record in read_records(file):
+                        if record not in seen:
+                            seen.add(record)
+                            out.write("{}\n{}\n".format(*record))
+            # Ids may repeat across files, so they are not parsed
+            bash_cmd = "makeblastdb -in {} -dbtype nucl -out {}".format(
+                os.path.basename(merged), MERGED_DB
+            )
+            proc = subprocess.Popen(bash_cmd.split(), cwd=full_dir, stdout=subprocess.PIPE)
+            proc.communicate()
+            self.logger.info(
+                "Merged {} files of {} into one database".format(len(sufx_files), full_dir)
+            )
+        except Exception as e:
+            self.logger.error("Unable to build merged database in {} ({})".format(full_dir, e))
+
+    def index_lengths(self, full_dir, suffix):
+        """Keeps the locus length sidecar of full_dir current for files with suffix"""
+        target = "{}/{}".format(full_dir, LENGTHS_INDEX)
+        try:
+            with open(target, "r") as fh:
+                index = json.load(fh)
+        except (IOError, ValueError):
+            index = dict()
+        updated = False
+        for file in os.listdir(full_dir):
+            if not file.endswith(suffix) or file.startswith("."):
+                continue
+            mtime = os.stat("{}/{}".format(full_dir, file)).st_mtime
+            if file in index and index[file]["mtime"] == mtime:
+                continue
+            index[file] = {
+                "mtime": mtime,
+                "lengths": fasta_lengths("{}/{}".format(full_dir, file)),
+            }
+            updated = True
+        # Forget files that no longer exist
+        for file in [f for f in index if not os.path.isfile("{}/{}".format(full_dir, f))]:
+            del index[file]
+            updated = True
+        if updated:
+            try:
+                tmpfile = "{}.tmp".format(target)
+                with open(tmpfile, "w") as fh:
+                    json.dump(index, fh)
+                os.rename(tmpfile, target)
+                self.logger.info("Updated locus lengths index of {}".format(full_dir))
+            except Exception as e:
+                self.logger.warning(
+                    "Unable to write locus lengths index for {} ({})".format(full_dir, e)
+                )
 
     def fetch_external(self, force=False):
         url = "https://pubmlst.org/static/data/dbases.xml"
@@ -264,31 +469,19 @@ class Referencer:
 
     def organism2reference(self, normal_organism_name):
         """Finds which reference contains the same words as the organism
-       and returns it in a format for database calls. Returns empty string if none found"""
-        orgs = os.listdir(self.config["folders"]["references"])
-        organism = re.split(r"\W+", normal_organism_name.lower())
+       and returns it in a format for database calls. Returns None if none found"""
+        folder = self.config["folders"]["references"]
+        aliases = self.config["regex"].get("organism_aliases", ORGANISM_ALIASES)
+        resolver = resolvers.get(folder)
+        if resolver is None or resolver.aliases != aliases:
+            resolver = Reference_Resolver(folder, aliases)
+            resolvers[folder] = resolver
         try:
-            refs = 0
-            for target in orgs:
-                hit = 0
-                for piece in organism:
-                    if len(piece) == 1:
-                        if target.startswith(piece):
-                            hit += 1
-                    else:
-                        if piece in target:
-                            hit += 1
-                        # For when people misspell the strain in the orderform
-                        elif piece == "pneumonsiae" and "pneumoniae" in target:
-                            hit += 1
-                        else:
-                            break
-                if hit == len(organism):
-                    return target
+            return resolver.resolve(normal_organism_name)
         except Exception as e:
             self.logger.warn(
-                "Unable to find existing reference for {}, strain {} has no reference match\nSource: {}".format(
-                    organism, normal_organism_name, e
+                "Unable to find existing reference for {}, strain has no reference match\nSource: {}".format(
+                    normal_organism_name, e
                 )
             )
 
@@ -300,10 +493,10 @@ class Referencer:
             record = Entrez.efetch(
                 db="nucleotide", id=reference, rettype="fasta", retmod="text"
             )
-            sequence = record.read()
             output = "{}/{}.fasta".format(self.config["folders"]["genomes"], reference)
             with open(output, "w") as f:
-                f.write(sequence)
+                shutil.copyfileobj(record, f)
+            record.close()
             bwaindex = "bwa index {}".format(output)
             proc = subprocess.Popen(
                 bwaindex.split(),
@@ -312,14 +505,7 @@ class Referencer:
                 stderr=DEVNULL,
             )
             out, err = proc.communicate()
-            samindex = "samtools faidx {}".format(output)
-            proc = subprocess.Popen(
-                samindex.split(),
-                cwd=self.config["folders"]["genomes"],
-                stdout=DEVNULL,
-                stderr=DEVNULL,
-            )
-            out, err = proc.communicate()
+            write_fai(output)
             self.logger.info("Downloaded reference {}".format(reference))
         except Exception as e:
             self.logger.warning(
@@ -26,6 +26,19 @@ from microSALT.server.views import app, session, gen_reportdata, gen_collectiond
 from microSALT.store.db_manipulator import DB_Manipulator
 from microSALT.store.orm_models import Samples
 
+# Delivered files of every sample as (format, path in the sample folder, step, tag)
+SAMPLE_DELIVERABLES = [
+    ("fasta", "assembly/{sample}_trimmed_contigs.fasta", "assembly", "assembly"),
+    ("fastq", "trimmed/{sample}_trim_front_pair.fastq.gz", "concatination", "trimmed-forward-reads"),
+    ("fastq", "trimmed/{sample}_trim_rev_pair.fastq.gz", "concatination", "trimmed-reverse-reads"),
+    ("fastq", "trimmed/{sample}_trim_unpair.fastq.gz", "concatination", "trimmed-unpaired-reads"),
+    ("txt", "slurm_{sample}.log", "analysis", "logfile"),
+    ("tsv", "assembly/quast/{sample}_report.tsv", "assembly", "quast-results"),
+    ("bam", "alignment/{sample}_{reference}.bam_sort", "alignment", "reference-alignment-sorted"),
+    ("bam", "alignment/{sample}_{reference}.bam_sort_rmdup", "alignment", "reference-alignment-deduplicated"),
+    ("meta", "alignment/{sample}_{reference}.stats.ins", "insertsize_calc", "picard-insertsize"),
+]
+
 
 class Reporter:
     def __init__(
@@ -375,42 +388,10 @@ class Reporter:
         for s in hklist:
             if len(hklist) > 1:
                 resultsdir = os.path.join(self.output, s["CG_ID_sample"])
-            #Contig/Assembly file
-            deliv['files'].append({'format':'fasta','id':s["CG_ID_sample"],
-                                   'path':"{0}/assembly/{1}_trimmed_contigs.fasta".format(resultsdir, s["CG_ID_sample"]),
-                                   'path_index':'~','step':'assembly','tag':'assembly'})
-            #Concat trimmed reads forwards
-            deliv['files'].append({'format':'fastq','id':s["CG_ID_sample"],
-                                   'path':"{0}/trimmed/{1}_trim_front_pair.fastq.gz".format(resultsdir, s["CG_ID_sample"]),
-                                   'path_index':'~','step':'concatination','tag':'trimmed-forward-reads'}) 
-            #Concat trimmed reads reverse
-            deliv['files'].append({'format':'fastq','id':s["CG_ID_sample"],
-                                   'path':"{0}/trimmed/{1}_trim_rev_pair.fastq.gz".format(resultsdir, s["CG_ID_sample"]),
-                                   'path_index':'~','step':'concatination','tag':'trimmed-reverse-reads'})
-            #Concat trimmed reads unpaired
-            deliv['files'].append({'format':'fastq','id':s["CG_ID_sample"],
-                                   'path':"{0}/trimmed/{1}_trim_unpair.fastq.gz".format(resultsdir, s["CG_ID_sample"]),
-                                   'path_index':'~','step':'concatination','tag':'trimmed-unpaired-reads'})            
-            #Slurm dump
-            deliv['files'].append({'format':'txt','id':s["CG_ID_sample"],
-                                   'path':"{0}/slurm_{1}.log".format(resultsdir, s["CG_ID_sample"]),
-                                   'path_index':'~','step':'analysis','tag':'logfile'})
-            #Quast (assembly) qc report
-            deliv['files'].append({'format':'tsv','id':s["CG_ID_sample"],
-                                   'path':"{0}/assembly/quast/{1}_report.tsv".format(resultsdir, s["CG_ID_sample"]),
-                                   'path_index':'~','step':'assembly','tag':'quast-results'})
-            #Alignment (bam, sorted)
-            deliv['files'].append({'format':'bam','id':s["CG_ID_sample"],
-                                   'path':"{0}/alignment/{1}_{2}.bam_sort".format(resultsdir, s["CG_ID_sample"], s["reference"]),
-                                   'path_index':'~','step':'alignment','tag':'reference-alignment-sorted'})
-            #Alignment (bam, sorted, deduplicated)
-            deliv['files'].append({'format':'bam','id':s["CG_ID_sample"],
-                                   'path':"{0}/alignment/{1}_{2}.bam_sort_rmdup".format(resultsdir, s["CG_ID_sample"], s["reference"]),
-                                   'path_index':'~','step':'alignment','tag':'reference-alignment-deduplicated'})
-            #Picard insert size stats
-            deliv['files'].append({'format':'meta','id':s["CG_ID_sample"],
-                                   'path':"{0}/alignment/{1}_{2}.stats.ins".format(resultsdir, s["CG_ID_sample"], s["reference"]),
-                                   'path_index':'~','step':'insertsize_calc','tag':'picard-insertsize'})
+            for format, path, step, tag in SAMPLE_DELIVERABLES:
+                deliv['files'].append({'format':format,'id':s["CG_ID_sample"],
+                                       'path':"{}/{}".format(resultsdir, path.format(sample=s["CG_ID_sample"], reference=s["reference"])),
+                                       'path_index':'~','step':step,'tag':tag})
 
 
         with open(output, 'w') as delivfile:
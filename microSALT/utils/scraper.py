@@ -3,25 +3,365 @@
 
 #!/usr/bin/env python
 
+import bisect
 import glob
+import hashlib
+import heapq
+import json
+import multiprocessing
 import os
 import re
 import string
 import sys
 import time
 
+import numpy as np
+
+from datetime import datetime
 from microSALT.store.db_manipulator import DB_Manipulator
-from microSALT.utils.referencer import Referencer
-from microSALT.utils.job_creator import Job_Creator
+from microSALT.utils.blastparse import read_hits
+from microSALT.utils.compression import open_text, strip_suffix
+from microSALT.utils.fasta import Fasta_Reader, fasta_lengths
+from microSALT.utils.fastq import PREFLIGHT_COLUMNS
+from microSALT.utils.referencer import MERGED_DB, Referencer, load_lengths, load_sources
+from microSALT.utils.job_creator import SCRAPED_FILES, Job_Creator
+
+# Depths always reported as Samples.coverage_<depth>x
+COVERAGE_DEPTHS = [10, 30, 50, 100]
+
+class Prefix_Index:
+    """Finds the first inserted key starting with a given prefix in O(log n)"""
+
+    def __init__(self, keys):
+        self.inserted = list(keys)
+        order = sorted(range(len(self.inserted)), key=self.inserted.__getitem__)
+        self.keys = [self.inserted[i] for i in order]
+        # Sparse table of the lowest insertion rank for every power of two range of sorted keys
+        self.ranks = [order]
+        span = 1
+        while span * 2 <= len(order):
+            prev = self.ranks[-1]
+            self.ranks.append(
+                [min(prev[i], prev[i + span]) for i in range(len(prev) - span)]
+            )
+            span *= 2
+
+    def first(self, prefix):
+        """Returns the earliest inserted key starting with prefix, or None"""
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + "\U0010ffff", lo)
+        if lo >= hi:
+            return None
+        level = (hi - lo).bit_length() - 1
+        rank = min(self.ranks[level][lo], self.ranks[level][hi - (1 << level)])
+        return self.inserted[rank]
+
+
+class Interval_Index:
+    """Finds the lowest queued index among intervals containing a point in O(log^2 n).
+       Intervals sit on the O(log n) segment tree nodes covering them, each node a min-heap"""
+
+    def __init__(self, spans, queued):
+        # spans maps index to (start, end), queued[index] tells whether index may be returned
+        self.queued = queued
+        self.points = sorted(set(point for span in spans.values() for point in span))
+        self.size = 1
+        while self.size < len(self.points):
+            self.size *= 2
+        self.heaps = [list() for _ in range(2 * self.size)]
+        self.leaves = {
+            index: (
+                bisect.bisect_left(self.points, start),
+                bisect.bisect_left(self.points, end),
+            )
+            for index, (start, end) in spans.items()
+            if start <= end
+        }
+        for index in sorted(self.leaves):
+            self.add(index)
+
+    def add(self, index):
+        """Queues the interval of index again. Empty intervals are never added"""
+        if index not in self.leaves:
+            return
+        lo, hi = self.leaves[index]
+        lo, hi = lo + self.size, hi + self.size + 1
+        while lo < hi:
+            if lo & 1:
+                heapq.heappush(self.heaps[lo], index)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                heapq.heappush(self.heaps[hi], index)
+            lo, hi = lo // 2, hi // 2
+
+    def first(self, point):
+        """Returns the lowest queued index whose interval contains point, or None"""
+        pos = bisect.bisect_left(self.points, point)
+        if pos == len(self.points) or self.points[pos] != point:
+            return None
+        best = None
+        node = pos + self.size
+        while node:
+            heap = self.heaps[node]
+            while heap and not self.queued[heap[0]]:
+                heapq.heappop(heap)
+            if heap and (best is None or heap[0] < best):
+                best = heap[0]
+            node //= 2
+        return best
+
+
+def remove_overlaps(hypo, identifier):
+    """Drops the worse of every two hits sharing identifier, or on the same contig where the
+       earlier hit starts or ends within the later one. Worse is lower identity*(1-|1-span|),
+       then lower contig coverage, with the later hit losing ties.
+       Same result as comparing every hit to all later ones while deleting losers in place.
+       Each hit is only compared to the later hits it conflicts with, found in index order"""
+    scores = [float(hit.get("identity")) * (1 - abs(1 - hit.get("span"))) for hit in hypo]
+    alive = [True] * len(hypo)
+    # Hits after the one being resolved, the only ones it is compared to
+    queued = [True] * len(hypo)
+    spans = dict()
+    by_identifier = dict()
+    for i, hit in enumerate(hypo):
+        spans.setdefault(hit["contig_name"], dict())[i] = (
+            hit.get("contig_start"),
+            hit.get("contig_end"),
+        )
+        by_identifier.setdefault(hit[identifier], list()).append(i)
+    contigs = {contig: Interval_Index(members, queued) for contig, members in spans.items()}
+
+    def next_target(hit):
+        candidates = [
+            contigs[hit["contig_name"]].first(hit.get("contig_start")),
+            contigs[hit["contig_name"]].first(hit.get("contig_end")),
+        ]
+        # Identifier lists are in index order and so valid heaps
+        shared = by_identifier[hit[identifier]]
+        while shared and not queued[shared[0]]:
+            heapq.heappop(shared)
+        if shared:
+            candidates.append(shared[0])
+        candidates = [found for found in candidates if found is not None]
+        return min(candidates) if candidates else None
+
+    for ind, hit in enumerate(hypo):
+        if not alive[ind]:
+            continue
+        queued[ind] = False
+        # Hits neither side wins against, compared once and queued again afterwards
+        parked = list()
+        targ = next_target(hit)
+        while targ is not None:
+            other = hypo[targ]
+            if scores[ind] > scores[targ]:
+                alive[targ] = queued[targ] = False
+            elif scores[ind] < scores[targ]:
+                alive[ind] = False
+            elif float(hit.get("contig_coverage")) >= float(other.get("contig_coverage")):
+                alive[targ] = queued[targ] = False
+            elif float(hit.get("contig_coverage")) < float(other.get("contig_coverage")):
+                alive[ind] = False
+            else:
+                queued[targ] = False
+                parked.append(targ)
+            # A replaced hit is not compared further, the next live hit takes its place
+            if not alive[ind]:
+                break
+            targ = next_target(hit)
+        for targ in parked:
+            queued[targ] = True
+            contigs[hypo[targ]["contig_name"]].add(targ)
+            heapq.heappush(by_identifier[hypo[targ][identifier]], targ)
+    return [hit for hit, keep in zip(hypo, alive) if keep]
+
+
+def coverage_metrics(depths, counts, ref_len, thresholds=COVERAGE_DEPTHS, percentiles=(10, 50, 90)):
+    """Coverage statistics from a samtools stats COV histogram of bases with depth > 0.
+       Reference bases missing from the histogram have depth 0.
+       Returns the mean depth, the fraction of bases deeper than each threshold,
+       depth percentiles over all bases and the fold-80 penalty over covered bases"""
+    order = np.argsort(depths, kind="stable")
+    depths = np.asarray(depths, dtype=np.int64)[order]
+    counts = np.asarray(counts, dtype=np.int64)[order]
+    metrics = {
+        "average": 0.0,
+        "depths": {depth: 0.0 for depth in thresholds},
+        "percentiles": {percentile: 0 for percentile in percentiles},
+        "fold_80": 0.0,
+    }
+    covered = int(counts.sum())
+    if ref_len <= 0 or covered == 0:
+        return metrics
+    uncovered = max(ref_len - covered, 0)
+    metrics["average"] = float((depths * counts).sum()) / ref_len
+
+    # Bases at or above each histogram depth; thresholds are exclusive
+    above = np.append(counts[::-1].cumsum()[::-1], 0)
+    deeper = above[np.searchsorted(depths, thresholds, side="right")]
+    metrics["depths"] = {
+        depth: float(bases) / ref_len for depth, bases in zip(thresholds, deeper)
+    }
+
+    # Smallest depth reached by the given share of all reference bases
+    cumulative = counts.cumsum()
+    ranks = np.ceil(np.asarray(percentiles, dtype=np.float64) / 100 * (uncovered + covered))
+    indices = np.searchsorted(cumulative, ranks - uncovered, side="left")
+    values = np.where(ranks > uncovered, depths[np.minimum(indices, len(depths) - 1)], 0)
+    metrics["percentiles"] = {
+        percentile: int(value) for percentile, value in zip(percentiles, values)
+    }
+
+    # Fold-80 base penalty: mean depth over the 20th percentile depth of covered bases
+    p20 = depths[min(int(np.searchsorted(cumulative, np.ceil(0.2 * covered))), len(depths) - 1)]
+    metrics["fold_80"] = float((depths * counts).sum()) / covered / p20
+    return metrics
+
+
+def fingerprint(manifest):
+    """Digest of a sample manifest"""
+    return hashlib.sha256(
+        json.dumps(manifest, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+# Context of a scrape_project worker process
+worker_context = None
+
+
+def init_worker(config, log):
+    """Builds the context shared by all samples parsed in a worker process"""
+    global worker_context
+    worker_context = ScrapeContext(config, log)
+
+
+def parse_sample_job(task):
+    """Parses one sample folder. Runs in worker processes of scrape_project"""
+    sampleinfo, sampledir = task
+    return Scraper(
+        config=worker_context.config,
+        log=worker_context.logger,
+        sampleinfo=sampleinfo,
+        input=sampledir,
+        context=worker_context,
+    ).parse_sample()
+
+
+class ScrapeContext:
+    """Setup shared by all samples of a finish run. Scrapers borrow the database handle,
+       reference resolution, resistance names and locus length indexes from it"""
+
+    def __init__(self, config, log):
+        self.config = config
+        self.logger = log
+        self.db_pusher = DB_Manipulator(config, log)
+        self.referencer = Referencer(config, log)
+        self.gene2resistance = self.load_resistances()
+        # (folder, suffix) as key, (source signature, lengths, prefix index) as value
+        self.locilengths = dict()
+        # (folder, suffix) as key, (source signature, source files per subject id) as value
+        self.sources = dict()
+        self.fallback = None
+
+    def job_fallback(self, sampleinfo):
+        """Job_Creator used to create missing projects and samples. Made on first use"""
+        if self.fallback is None:
+            self.fallback = Job_Creator(config=self.config, log=self.logger, sampleinfo=sampleinfo)
+            self.fallback.db_pusher = self.db_pusher
+        self.fallback.sample = sampleinfo
+        return self.fallback
+
+    def organism2reference(self, organism):
+        """Resolves the reference folder of an organism"""
+        return self.referencer.organism2reference(organism)
+
+    def get_locilengths(self, foldername, suffix):
+        """ Generate a dict of length for any given loci """
+        # Full name as key, sequence length as value. Reuses earlier loads unless a source file changed
+        files = [
+            file
+            for file in os.listdir(foldername)
+            if file.endswith(suffix) and not file.startswith(".")
+        ]
+        signature = sorted(
+            (file, os.stat("{}/{}".format(foldername, file)).st_mtime) for file in files
+        )
+        cached = self.locilengths.get((foldername, suffix))
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        finalalleles = load_lengths(foldername, suffix)
+        if finalalleles is None:
+            self.logger.debug(
+                "No current locus lengths index in {}, reading references".format(foldername)
+            )
+            finalalleles = dict()
+            for file in files:
+                finalalleles.update(fasta_lengths("{}/{}".format(foldername, file)))
+        self.locilengths[(foldername, suffix)] = (signature, finalalleles, None)
+        return finalalleles
+
+    def get_loci_index(self, foldername, suffix):
+        """ Returns a prefix index over the loci names of get_locilengths """
+        locilengths = self.get_locilengths(foldername, suffix)
+        signature, lengths, index = self.locilengths[(foldername, suffix)]
+        if index is None:
+            index = Prefix_Index(lengths.keys())
+            self.locilengths[(foldername, suffix)] = (signature, lengths, index)
+        return index
+
+    def get_sources(self, foldername, suffix):
+        """ Returns the files, without suffix, that hold each subject id of foldername """
+        cached = self.sources.get((foldername, suffix))
+        signature = sorted(
+            (file, os.stat("{}/{}".format(foldername, file)).st_mtime)
+            for file in os.listdir(foldername)
+            if file.endswith(suffix) and not file.startswith(".")
+        )
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        sources = load_sources(foldername, ".{}".format(suffix))
+        if sources is None:
+            sources = dict()
+            for file, mtime in signature:
+                for header in fasta_lengths("{}/{}".format(foldername, file)):
+                    sources.setdefault(header[1:].split()[0], []).append(file[: -len(suffix) - 1])
+        self.sources[(foldername, suffix)] = (signature, sources)
+        return sources
+
+    def load_resistances(self):
+        """Legacy function, loads common resistance names for genes from notes file"""
+        conversions = dict()
+        try:
+            with open(
+                "{}/notes.txt".format(self.config["folders"]["resistances"])
+            ) as fh:
+                for line in fh:
+                    if "#" not in line:
+                        line = line.split(":")
+                        cropped = re.sub(" resistance", "", line[1])
+                        conversions[line[0]] = cropped
+                        # Workaround for case issues
+                        conversions[line[0].lower()] = cropped
+        except Exception as e:
+            self.logger.error(
+                "Unable to initialize trivial names for resistances ({})".format(e)
+            )
+        return conversions
+
 
 # TODO: Rewrite so samples use seperate objects
 class Scraper:
-    def __init__(self, config, log, sampleinfo={}, input=""):
+    def __init__(self, config, log, sampleinfo={}, input="", context=None):
         self.config = config
         self.logger = log
-        self.db_pusher = DB_Manipulator(config, log)
-        self.referencer = Referencer(config, log)
-        self.job_fallback = Job_Creator(config=config, log=log, sampleinfo=sampleinfo)
+        if context is None:
+            context = ScrapeContext(config, log)
+        self.context = context
+        self.db_pusher = context.db_pusher
+        self.referencer = context.referencer
+        self.gene2resistance = context.gene2resistance
         self.infolder = os.path.abspath(input)
         self.sampledir = ""
 
@@ -45,68 +385,231 @@ class Scraper:
             self.name = self.sampleinfo.get("CG_ID_sample")
             self.sample = self.sampleinfo
 
-        self.gene2resistance = self.load_resistances()
-
-    def scrape_project(self, project=None):
-        """Scrapes a project folder for information"""
+    def scrape_project(self, project=None, workers=1, force=False, samples=None):
+        """Scrapes a project folder for information.
+           Samples are parsed by up to workers processes while this process writes to the database.
+           Samples whose results are unchanged since the last scrape are skipped unless forced.
+           samples limits the scrape to the listed samples, which are always re-scraped"""
         if project is None:
             project = self.name
-        self.db_pusher.purge_rec(project, "Projects")
+        if force and not samples:
+            self.db_pusher.purge_rec(project, "Projects")
         if not self.db_pusher.exists("Projects", {"CG_ID_project": project}):
             self.logger.warning("Replacing project {}".format(project))
-            self.job_fallback.create_project(project)
+            self.context.job_fallback(self.sample).create_project(project)
 
-        # Scrape order matters a lot!
-        for item in os.listdir(self.infolder):
+        tasks = list()
+        manifests = dict()
+        for item in sorted(os.listdir(self.infolder)):
             sampledir = "{}/{}".format(self.infolder, item)
-            if os.path.isdir(sampledir):
-                local_param = [p for p in self.sampleinfo if p["CG_ID_sample"] == item]
-                if local_param != []:
-                    local_param = local_param[0]
-                    sample_scraper = Scraper(
-                        config=self.config,
-                        log=self.logger,
-                        sampleinfo=local_param,
-                        input=sampledir,
-                    )
-                    sample_scraper.scrape_sample()
-                else:
-                    self.logger.warning(
-                        "Skipping {} due to lacking info in sample_json file".format(dir)
-                    )
+            if not os.path.isdir(sampledir):
+                continue
+            if samples and item not in samples:
+                continue
+            local_param = [p for p in self.sampleinfo if p["CG_ID_sample"] == item]
+            if local_param == []:
+                self.logger.warning(
+                    "Skipping {} due to lacking info in sample_json file".format(item)
+                )
+                continue
+            manifests[item] = self.sample_manifest(sampledir, local_param[0])
+            if not (force or samples) and self.is_unchanged(item, manifests[item]):
+                continue
+            tasks.append((local_param[0], sampledir))
+        self.logger.info(
+            "Scraping {} of {} samples in project {}".format(len(tasks), len(manifests), project)
+        )
 
-    def scrape_sample(self, sample=None):
-        """Scrapes a sample folder for information"""
+        if workers > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(
+                min(workers, len(tasks)), initializer=init_worker, initargs=(self.config, self.logger)
+            ) as pool:
+                for result in pool.imap_unordered(parse_sample_job, tasks):
+                    self.store_sample(result, manifest=manifests[result["name"]])
+        else:
+            for task in tasks:
+                result = Scraper(
+                    config=self.config,
+                    log=self.logger,
+                    sampleinfo=task[0],
+                    input=task[1],
+                    context=self.context,
+                ).parse_sample()
+                self.store_sample(result, manifest=manifests[result["name"]])
+
+    def scrape_sample(self, sample=None, force=False):
+        """Scrapes a sample folder for information. Skipped if unchanged since the last scrape"""
         if sample is None:
             sample = self.name
+        manifest = self.sample_manifest(self.infolder, self.sample)
+        if not force and self.is_unchanged(sample, manifest):
+            return
+        self.store_sample(self.parse_sample(), sample, manifest)
+
+    def sample_manifest(self, sampledir, sampleinfo):
+        """Describes everything a scrape of sampledir depends on:
+           sizes and mtimes of the result files, the sample info and the reference versions"""
+        files = dict()
+        for pattern in SCRAPED_FILES:
+            for file in sorted(glob.glob("{}/{}".format(sampledir, pattern))):
+                stat = os.stat(file)
+                files[os.path.relpath(file, sampledir)] = [stat.st_size, stat.st_mtime]
+
+        organism = self.context.organism2reference(sampleinfo.get("organism"))
+        references = dict()
+        folders = [
+            self.config["folders"]["resistances"],
+            os.path.dirname(self.config["folders"]["expec"]),
+        ]
+        if organism:
+            references["profile"] = self.db_pusher.get_version("profile_{}".format(organism))
+            folders.append("{}/{}".format(self.config["folders"]["references"], organism))
+        for folder in folders:
+            if os.path.isdir(folder):
+                references[folder] = sorted(
+                    [file, os.stat("{}/{}".format(folder, file)).st_mtime]
+                    for file in os.listdir(folder)
+                    if not file.startswith(".")
+                )
+        return {"files": files, "references": references, "sample": sampleinfo}
+
+    def is_unchanged(self, sample, manifest):
+        """Checks a manifest against the one stored by the last scrape of sample"""
+        if self.db_pusher.get_fingerprint(sample) != fingerprint(manifest):
+            return False
+        self.logger.info("Sample {} unchanged since last scrape, skipping".format(sample))
+        return True
+
+    def store_manifest(self, sample, manifest):
+        """Records the manifest of a completed scrape. store_sample clears the previous one"""
+        self.db_pusher.add_recs(
+            [
+                {
+                    "CG_ID_sample": sample,
+                    "fingerprint": fingerprint(manifest),
+                    "manifest": json.dumps(manifest, sort_keys=True, default=str),
+                    "date_scraped": datetime.now(),
+                }
+            ],
+            "Manifests",
+        )
+
+    def parse_sample(self):
+        """Reads all results of a sample folder without touching the database"""
+        # Scrape order matters a lot!
+        self.sampledir = self.infolder
+        result = {"name": self.name, "sample": self.sample, "Samples": dict()}
+        organism = self.context.organism2reference(self.sample.get("organism"))
+        if organism:
+            result["Samples"]["organism"] = organism
+        result["Seq_types"] = self.parse_blast(type="seq_type")
+        self.write_novel_alleles(result["Seq_types"])
+        result["Resistances"] = self.parse_blast(type="resistance")
+        result["Expacs"] = list()
+        if organism == "escherichia_coli":
+            result["Expacs"] = self.parse_blast(type="expec")
+        result["Samples"].update(self.parse_alignment())
+        result["Samples"].update(self.parse_quast())
+        return result
+
+    def write_novel_alleles(self, hits):
+        """Writes the assembly sequence of every allele hit below the MLST identity threshold,
+           ready for submission of novel alleles. Sequences are read by region from the indexed contigs"""
+        novel = [hit for hit in hits if hit["identity"] < self.config["threshold"]["mlst_id"]]
+        contigs = "{}/assembly/{}_contigs.fasta".format(self.sampledir, self.name)
+        output = "{}/assembly/{}_novel_alleles.fasta".format(self.sampledir, self.name)
+        if not novel or not os.path.isfile(contigs):
+            return
+        try:
+            with Fasta_Reader(contigs) as reader, open(output, "w") as fh:
+                # Hits name contigs by their first two fields, e.g. NODE_1
+                names = {"_".join(name.split("_")[:2]): name for name in reader.names()}
+                for hit in novel:
+                    name = names.get(hit["contig_name"])
+                    if name is None:
+                        self.logger.warning(
+                            "Contig {} of {} is missing from its assembly".format(
+                                hit["contig_name"], self.name
+                            )
+                        )
+                        continue
+                    # BLAST positions are 1-based and inclusive
+                    fh.write(
+                        ">{}_{} {}:{}-{}\n{}\n".format(
+                            hit["loci"],
+                            hit["allele"],
+                            name,
+                            hit["contig_start"],
+                            hit["contig_end"],
+                            reader.fetch(name, hit["contig_start"] - 1, hit["contig_end"]),
+                        )
+                    )
+            self.logger.info("Wrote {} novel allele candidates of {}".format(len(novel), self.name))
+        except (IOError, OSError) as e:
+            self.logger.warning("Unable to write novel alleles of {} ({})".format(self.name, e))
+
+    def store_sample(self, result, sample=None, manifest=None):
+        """Replaces the database entries of a sample with the output of parse_sample.
+           Everything is written in one transaction, ending with the manifest if given"""
+        if sample is None:
+            sample = result["name"]
+        with self.db_pusher.transaction():
+            self.replace_sample(result, sample)
+            # Typing needs all alleles in place
+            self.type_sample(sample)
+            if manifest is not None:
+                self.store_manifest(sample, manifest)
+
+    def replace_sample(self, result, sample):
+        """Swaps the stored sample, its hits and its project for the output of parse_sample"""
+        sampleinfo = result["sample"]
+        # Pre-flight read statistics are only made when jobs are created
+        carried = dict()
+        for row in self.db_pusher.query_rec("Samples", {"CG_ID_sample": sample}):
+            carried = {
+                column: getattr(row, column)
+                for column in PREFLIGHT_COLUMNS
+                if getattr(row, column) is not None
+            }
         self.db_pusher.purge_rec(sample, "Samples")
 
         if not self.db_pusher.exists(
-            "Projects", {"CG_ID_project": self.sample.get("CG_ID_project")}
+            "Projects", {"CG_ID_project": sampleinfo.get("CG_ID_project")}
         ):
             self.logger.warning(
-                "Replacing project {}".format(self.sample.get("CG_ID_project"))
+                "Replacing project {}".format(sampleinfo.get("CG_ID_project"))
             )
-            self.job_fallback.create_project(self.sample.get("CG_ID_project"))
+            self.context.job_fallback(sampleinfo).create_project(sampleinfo.get("CG_ID_project"))
 
         if not self.db_pusher.exists("Samples", {"CG_ID_sample": sample}):
             self.logger.info("Replacing sample {}".format(sample))
-            self.job_fallback.create_sample(sample)
+            self.context.job_fallback(sampleinfo).create_sample(sample)
 
-        # Scrape order matters a lot!
-        self.sampledir = self.infolder
-        self.scrape_blast(type="seq_type")
-        self.scrape_blast(type="resistance")
-        if (
-            self.referencer.organism2reference(self.sample.get("organism"))
-            == "escherichia_coli"
-        ):
-            self.scrape_blast(type="expec")
-        self.scrape_alignment()
-        self.scrape_quast()
+        self.db_pusher.upd_rec(
+            {"CG_ID_sample": sample}, "Samples", dict(result["Samples"], **carried)
+        )
+        for table in ["Seq_types", "Resistances", "Expacs"]:
+            self.db_pusher.add_recs(result[table], table)
+
+    def type_sample(self, sample):
+        """Assigns a sequence type from the stored alleles of a sample"""
+        try:
+            ST = self.db_pusher.alleles2st(sample)
+            self.db_pusher.upd_rec({"CG_ID_sample": sample}, "Samples", {"ST": ST})
+            self.logger.info("Sample {} received ST {}".format(sample, ST))
+        except Exception as e:
+            self.logger.warning(
+                "Unable to type sample {} due to data value '{}'".format(sample, str(e))
+            )
 
     def scrape_quast(self, filename=""):
         """Scrapes a quast report for assembly information"""
+        quast = self.parse_quast(filename)
+        if quast:
+            self.db_pusher.upd_rec({"CG_ID_sample": self.name}, "Samples", quast)
+
+    def parse_quast(self, filename=""):
+        """Reads assembly information from a quast report"""
         if filename == "":
             filename = "{}/assembly/quast/{}_report.tsv".format(self.sampledir, self.name)
             if not os.path.isfile(filename):
@@ -126,7 +629,6 @@ class Scraper:
                     elif lsplit[0] == "N50":
                         quast["n50"] = int(lsplit[1])
 
-            self.db_pusher.upd_rec({"CG_ID_sample": self.name}, "Samples", quast)
             self.logger.debug(
                 "Project {} recieved quast stats: {}".format(self.name, quast)
             )
@@ -134,53 +636,53 @@ class Scraper:
             self.logger.warning(
                 "Cannot generate quast statistics for {}".format(self.name)
             )
+            quast = dict()
+        return quast
 
     def get_locilengths(self, foldername, suffix):
         """ Generate a dict of length for any given loci """
-        # Create dict with full name as key, associated nucleotides as value.
-        alleles = dict()
-        finalalleles = dict()
-        for file in os.listdir(foldername):
-            if file.endswith(suffix):
-                lastallele = ""
-                f = open("{}/{}".format(foldername, file), "r")
-                for row in f:
-                    if ">" in row:
-                        lastallele = row.strip()
-                        alleles[lastallele] = ""
-                    else:
-                        alleles[lastallele] = alleles[lastallele] + row.strip()
-                f.close()
-
-                for k, v in alleles.items():
-                    finalalleles[k] = len(v)
-        return finalalleles
+        return self.context.get_locilengths(foldername, suffix)
+
+    def get_loci_index(self, foldername, suffix):
+        """ Returns a prefix index over the loci names of get_locilengths """
+        return self.context.get_loci_index(foldername, suffix)
 
     def scrape_blast(self, type="", file_list=[]):
+        """Scrapes BLAST results of one type into the database"""
+        type2db = type.capitalize() + "s"
+        if type == "expec":
+            type2db = "Expacs"
+        organism = self.context.organism2reference(self.sample.get("organism"))
+        if organism:
+            self.db_pusher.upd_rec(
+                {"CG_ID_sample": self.name}, "Samples", {"organism": organism}
+            )
+        self.db_pusher.add_recs(self.parse_blast(type, file_list), type2db)
+        if type == "seq_type":
+            self.type_sample(self.name)
+
+    def parse_blast(self, type="", file_list=[]):
+        """Reads BLAST results of one type, returns the hits left after overlap removal"""
         hypo = list()
         type2db = type.capitalize() + "s"
         if type == "expec":
             type2db = "Expacs"
 
+        # Sorted, so ties between files are always broken the same way
         if file_list == []:
             if type == "seq_type":
-                file_list = glob.glob("{}/blast_search/mlst/*".format(self.sampledir))
+                file_list = sorted(glob.glob("{}/blast_search/mlst/*".format(self.sampledir)))
             else:
-                file_list = glob.glob(
-                    "{}/blast_search/{}/*".format(self.sampledir, type)
+                file_list = sorted(
+                    glob.glob("{}/blast_search/{}/*".format(self.sampledir, type))
                 )
 
-        organism = self.referencer.organism2reference(self.sample.get("organism"))
-        if organism:
-            self.db_pusher.upd_rec(
-                {"CG_ID_sample": self.name}, "Samples", {"organism": organism}
-            )
-        res_cols = self.db_pusher.get_columns("{}".format(type2db))
+        organism = self.context.organism2reference(self.sample.get("organism"))
 
         try:
-            old_ref = ""
             for file in file_list:
-                filename = os.path.basename(file).rsplit(".", 1)[0]  # Removes suffix
+                # Removes compression and file suffix
+                filename = os.path.basename(strip_suffix(file)).rsplit(".", 1)[0]
                 if filename == "lactam":
                     filename = "beta-lactam"
                 if type == "resistance":
@@ -197,122 +699,52 @@ class Scraper:
                     )
                     suffix = "tfa"
                 locilengths = self.get_locilengths(ref_folder, suffix)
-
-                with open("{}".format(file), "r") as sample:
-                    for line in sample:
-                        # Ignore commented fields
-                        if not line[0] == "#":
-
-                            elem_list = line.rstrip().split("\t")
-                            if not elem_list[1] == "N/A":
-                                hypo.append(dict())
-                                hypo[-1]["CG_ID_sample"] = self.name
-                                hypo[-1]["identity"] = elem_list[4]
-                                hypo[-1]["evalue"] = elem_list[5]
-                                hypo[-1]["bitscore"] = elem_list[6]
-                                if int(elem_list[7]) < int(elem_list[8]):
-                                    hypo[-1]["contig_start"] = int(elem_list[7])
-                                    hypo[-1]["contig_end"] = int(elem_list[8])
-                                else:
-                                    hypo[-1]["contig_start"] = int(elem_list[8])
-                                    hypo[-1]["contig_end"] = int(elem_list[7])
-                                hypo[-1]["subject_length"] = int(elem_list[11])
-
-                                if type == "resistance":
-                                    hypo[-1]["instance"] = filename
-                                    partials = re.search("(?:\>)*(.+)_(\d+){1,3}(?:_(.+))",elem_list[3])
-                                    hypo[-1]["reference"] = partials.group(3)
-                                    hypo[-1]["gene"] = partials.group(1)
-                                    if hypo[-1]["gene"] in self.gene2resistance.keys():
-                                        hypo[-1]["resistance"] = self.gene2resistance[
-                                            hypo[-1]["gene"]
-                                        ]
-                                    else:
-                                        hypo[-1]["{}".format(type)] = hypo[-1][
-                                            "instance"
-                                        ].capitalize()
-                                    #Ignores reference name and finds relevant resFinder entry
-
-                                    padder = [x for x in locilengths.keys() if x.startswith('>{}'.format(partials[1]))]
-                                    if len(padder) == 0:
-                                        padder = [x for x in locilengths.keys() if x.startswith('>{}'.format(partials[1][:-1]))]
-                                    try:
-                                        padder = padder[0]
-                                    except IndexError as e:
-                                        self.logger.warning("In {} gene {} can't be resolved. Wrong resistance?".format(self.name, partials[1]))
-
-                                    hypo[-1]["span"] = (
-                                        float(hypo[-1]["subject_length"])
-                                        / locilengths[padder]
-                                    )
-
-                                elif type == "expec":
-                                    hypo[-1]["instance"] = filename
-                                    # Thanks, precompiled list standards
-                                    if ">" in elem_list[3]:
-                                        partials = re.search(
-                                            r">*(\w+_\w+\.*\w+).+\((\w+)\).+\((\w+)\)_(\w+)_\[.+\]",
-                                            elem_list[3],
-                                        )
-                                    else:
-                                        partials = re.search(
-                                            r"(\w+)\(gb\|\w+\)_\((\S+)\)_(.+)_\[(\S+)_.+\]_\[\S+\]",
-                                            elem_list[3],
-                                        )
-                                    if not partials:
-                                        partials = re.search(
-                                            r"(\w+\.*\w+)\:*\w*_*(?:\(\w+\-\w+\))*_\((\w+)\)_([^[]+)\[\S+\]",
-                                            elem_list[3],
-                                        )
-                                    # NC/Protein reference
-                                    hypo[-1]["reference"] = partials.group(1)
-                                    # Full gene name
-                                    hypo[-1]["gene"] = partials.group(2)
-                                    # More generic group
-                                    hypo[-1]["instance"] = partials.group(3).strip("_")
-                                    # Description
-                                    if len(partials.groups()) >= 4:
-                                        hypo[-1]["virulence"] = (
-                                            partials.group(4)
-                                            .replace("_", " ")
-                                            .capitalize()
-                                        )
-                                    else:
-                                        hypo[-1]["virulence"] = ""
-                                    #padder = [x for x in locilengths.keys() if x.startswith('>{}'.format(partials[1]))][0]
-                                    hypo[-1]["span"] = (
-                                        float(hypo[-1]["subject_length"])
-                                        / locilengths[">{}".format(elem_list[3])]
-                                    )
-
-                                elif type == "seq_type":
-                                    partials = re.search(
-                                        r"(.+)_(\d+){1,3}(?:_(\w+))*", elem_list[3]
-                                    )
-                                    hypo[-1]["loci"] = partials.group(1)
-                                    hypo[-1]["allele"] = int(partials.group(2))
-                                    #Ignores reference name and finds relevant resFinder entry
-
-                                    padder = [x for x in locilengths.keys() if x.startswith('>{}'.format(partials[0]))]
-                                    if len(padder) == 0:
-                                        padder = [x for x in locilengths.keys() if x.startswith('>{}'.format(partials[0][:-1]))]                 
-                                    try:
-                                        padder = padder[0]
-                                    except IndexError as e:
-                                        self.logger.warning("In {} allele {} can't be resolved. Wrong organism?".format(self.name, partials[0]))
-                                    hypo[-1]["span"] = (
-                                        float(hypo[-1]["subject_length"])
-                                        / locilengths[padder]
-                                    )
-
-                                # split elem 2 into contig node_NO, length, cov
-                                nodeinfo = elem_list[2].split("_")
-                                hypo[-1]["contig_name"] = "{}_{}".format(
-                                    nodeinfo[0], nodeinfo[1]
+                loci_index = self.get_loci_index(ref_folder, suffix)
+                # Hits of merged searches are split back by the file holding their subject
+                sources = None
+                if filename == MERGED_DB and type != "seq_type":
+                    sources = self.context.get_sources(ref_folder, suffix)
+
+                with open_text(file) as sample:
+                    for hit in read_hits(sample, type, filename):
+                        self.logger.debug("scrape_blast scrape loop hit '%s'", hit.subject)
+                        if hit.exact:
+                            padder = hit.lookup[0]
+                        else:
+                            padder = loci_index.first(hit.lookup[0])
+                            if padder is None:
+                                padder = loci_index.first(hit.lookup[1])
+                        if padder not in locilengths:
+                            self.logger.warning(
+                                "In %s %s %s can't be resolved. Wrong %s?",
+                                self.name,
+                                "allele" if type == "seq_type" else "gene",
+                                hit.subject,
+                                "organism" if type == "seq_type" else "reference",
+                            )
+                            continue
+                        hit.span = float(hit.subject_length) / locilengths[padder]
+                        instances = [hit.instance]
+                        if sources is not None and hit.subject not in sources:
+                            self.logger.warning(
+                                "In {} {} has no source file in the index of {}, stored as {}".format(
+                                    self.name, hit.subject, ref_folder, hit.instance
                                 )
-                                hypo[-1]["contig_length"] = int(nodeinfo[3])
-                                hypo[-1]["contig_coverage"] = nodeinfo[5]
-                                self.logger.debug("scrape_blast scrape loop hit '{}'".format(elem_list[3]))
+                            )
+                        elif sources is not None:
+                            instances = [
+                                "beta-lactam" if source == "lactam" else source
+                                for source in sources[hit.subject]
+                            ]
+                        for instance in instances:
+                            hit.instance = instance
+                            if type == "resistance":
+                                hit.resistance = self.gene2resistance.get(
+                                    hit.gene, hit.instance.capitalize()
+                                )
+                            record = hit.as_dict(type)
+                            record["CG_ID_sample"] = self.name
+                            hypo.append(record)
             self.logger.info("{} candidate {} hits found".format(len(hypo), type2db))
         except Exception as e:
             self.logger.error("Unable to process the pattern of {}".format(str(e)))
@@ -322,68 +754,7 @@ class Scraper:
             identifier = "loci"
         elif type == "resistance" or type == "expec":
             identifier = "gene"
-        ind = 0
-        while ind < len(hypo) - 1:
-            targ = ind + 1
-            while targ < len(hypo):
-                ignore = False
-                if (
-                    hypo[ind]["contig_name"] == hypo[targ]["contig_name"]
-                    or hypo[ind][identifier] == hypo[targ][identifier]
-                ):
-                    # Overlapping or shared gene
-                    if (
-                        (
-                            hypo[ind].get("contig_start")
-                            >= hypo[targ].get("contig_start")
-                            and hypo[ind].get("contig_start")
-                            <= hypo[targ].get("contig_end")
-                        )
-                        or (
-                            hypo[ind].get("contig_end")
-                            >= hypo[targ].get("contig_start")
-                            and hypo[ind].get("contig_end")
-                            <= hypo[targ].get("contig_end")
-                        )
-                        or (hypo[ind].get(identifier) == hypo[targ].get(identifier))
-                    ):
-                        # Rightmost is worse
-                        if float(hypo[ind].get("identity")) * (
-                            1 - abs(1 - hypo[ind].get("span"))
-                        ) > float(hypo[targ].get("identity")) * (
-                            1 - abs(1 - hypo[targ].get("span"))
-                        ):
-                            del hypo[targ]
-                            ignore = True
-                        # Leftmost is worse
-                        elif float(hypo[ind].get("identity")) * (
-                            1 - abs(1 - hypo[ind].get("span"))
-                        ) < float(hypo[targ].get("identity")) * (
-                            1 - abs(1 - hypo[targ].get("span"))
-                        ):
-                            del hypo[ind]
-                            targ = ind + 1
-                            ignore = True
-                        # Identical identity and span, seperating based on contig coverage
-                        else:
-                            # Rightmost is worse
-                            if float(hypo[ind].get("contig_coverage")) >= float(
-                                hypo[targ].get("contig_coverage")
-                            ):
-                                del hypo[targ]
-                                ignore = True
-                            # Leftmost is worse
-                            elif float(hypo[ind].get("contig_coverage")) < float(
-                                hypo[targ].get("contig_coverage")
-                            ):
-                                del hypo[ind]
-                                targ = ind + 1
-                                ignore = True
-                if not ignore:
-                    targ += 1
-                else:
-                    pass
-            ind += 1
+        hypo = remove_overlaps(hypo, identifier)
 
         self.logger.info(
             "{} {} hits were added after removing overlaps and duplicate hits".format(
@@ -392,69 +763,45 @@ class Scraper:
         )
         for hit in hypo:
             self.logger.debug(
-                "Kept {}:{} with span {} and id {}".format(
-                    hit.get("loci"),
-                    hit.get("allele"),
-                    hit.get("span"),
-                    hit.get("identity"),
-                )
+                "Kept %s:%s with span %s and id %s",
+                hit.get("loci"),
+                hit.get("allele"),
+                hit.get("span"),
+                hit.get("identity"),
             )
-            self.db_pusher.add_rec(hit, "{}".format(type2db))
-
-        if type == "seq_type":
-            try:
-                ST = self.db_pusher.alleles2st(self.name)
-                self.db_pusher.upd_rec(
-                    {"CG_ID_sample": self.name}, "Samples", {"ST": ST}
-                )
-                self.logger.info("Sample {} received ST {}".format(self.name, ST))
-            except Exception as e:
-                self.logger.warning(
-                    "Unable to type sample {} due to data value '{}'".format(
-                        self.name, str(e)
-                    )
-                )
-
-    def load_resistances(self):
-        """Legacy function, loads common resistance names for genes from notes file"""
-        conversions = dict()
-        try:
-            with open(
-                "{}/notes.txt".format(self.config["folders"]["resistances"])
-            ) as fh:
-                for line in fh:
-                    if "#" not in line:
-                        line = line.split(":")
-                        cropped = re.sub(" resistance", "", line[1])
-                        conversions[line[0]] = cropped
-                        # Workaround for case issues
-                        conversions[line[0].lower()] = cropped
-        except Exception as e:
-            self.logger.error(
-                "Unable to initialize trivial names for resistances ({})".format(e)
-            )
-        return conversions
+        return hypo
 
     def scrape_alignment(self, file_list=[]):
         """Scrapes a single alignment result"""
+        self.db_pusher.upd_rec(
+            {"CG_ID_sample": self.name}, "Samples", self.parse_alignment(file_list)
+        )
+
+    def parse_alignment(self, file_list=[]):
+        """Reads alignment statistics of a sample"""
         if file_list == []:
             file_list = glob.glob("{}/alignment/*.stats.*".format(self.sampledir))
-        ins_list = list()
-        cov_dict = dict()
+        histograms = list()
         align_dict = dict()
         align_dict["reference_genome"] = self.sample.get("reference")
 
         # Reading
         map_rate = 0.0
         median_ins = 0
-        ref_len = 0.0
+        ref_len = 0
         tot_reads = 0
         tot_map = 0
         duprate = 0.0
         for file in file_list:
-            with open(file, "r") as fh:
-                type = file.split(".")[-1]
-                for line in fh.readlines():
+            with open_text(file) as fh:
+                type = strip_suffix(file).split(".")[-1]
+                if type == "cov":
+                    # Depth and base count columns of the samtools stats COV section
+                    histograms.append(
+                        np.loadtxt(fh, usecols=(1, 2), dtype=np.int64, ndmin=2)
+                    )
+                    continue
+                for line in fh:
                     lsplit = line.rstrip().split("\t")
                     if type == "raw":
                         try:
@@ -467,8 +814,6 @@ class Scraper:
                                 median_ins = int(lsplit[0])
                             except Exception as e:
                                 pass
-                    elif type == "cov":
-                        cov_dict[lsplit[1]] = int(lsplit[2])
                     elif type == "ref":
                         if lsplit[0] != "*" and len(lsplit) >= 2:
                             ref_len = ref_len + int(lsplit[1])
@@ -487,36 +832,30 @@ class Scraper:
                                 map_rate = int(dsplit[0]) / float(tot_map)
 
         # Mangling
-        sumz, plus10, plus30, plus50, plus100, total = 0, 0, 0, 0, 0, 0
-        for k, v in cov_dict.items():
-            sumz += int(k) * v
-            total += v
-            if int(k) > 10:
-                plus10 += v
-            if int(k) > 30:
-                plus30 += v
-            if int(k) > 50:
-                plus50 += v
-            if int(k) > 100:
-                plus100 += v
-        if total > 0:
-            align_dict["coverage_10x"] = plus10 / float(ref_len)
-            align_dict["coverage_30x"] = plus30 / float(ref_len)
-            align_dict["coverage_50x"] = plus50 / float(ref_len)
-            align_dict["coverage_100x"] = plus100 / float(ref_len)
+        if histograms:
+            histogram = np.concatenate(histograms)
         else:
-            align_dict["coverage_10x"] = 0.0
-            align_dict["coverage_30x"] = 0.0
-            align_dict["coverage_50x"] = 0.0
-            align_dict["coverage_100x"] = 0.0
+            histogram = np.zeros((0, 2), dtype=np.int64)
+        extra_depths = self.config.get("threshold", {}).get("coverage_depths", [])
+        metrics = coverage_metrics(
+            histogram[:, 0], histogram[:, 1], ref_len, sorted(set(COVERAGE_DEPTHS + extra_depths))
+        )
+        for depth in COVERAGE_DEPTHS:
+            align_dict["coverage_{}x".format(depth)] = metrics["depths"][depth]
+        align_dict["coverage_depths"] = json.dumps(
+            {str(depth): metrics["depths"][depth] for depth in extra_depths}
+        )
+        align_dict["average_coverage"] = metrics["average"]
+        align_dict["coverage_p10"] = metrics["percentiles"][10]
+        align_dict["median_coverage"] = metrics["percentiles"][50]
+        align_dict["coverage_p90"] = metrics["percentiles"][90]
+        align_dict["fold_80"] = metrics["fold_80"]
 
         align_dict["mapped_rate"] = map_rate
         align_dict["insert_size"] = median_ins
         if ref_len > 0:
             align_dict["duplication_rate"] = duprate
-            align_dict["average_coverage"] = sumz / float(ref_len)
         else:
             align_dict["duplication_rate"] = 0.0
-            align_dict["average_coverage"] = 0.0
         align_dict["total_reads"] = tot_reads
-        self.db_pusher.upd_rec({"CG_ID_sample": self.name}, "Samples", align_dict)
+        return align_dict
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""Pairwise SNP distances of many samples, computed in one pass over their SNP calls"""
+
+import gzip
+import os
+
+import numpy as np
+
+# Packed site bytes expanded to a dense matrix per step
+BLOCK_BYTES = 1 << 12
+# Suffix of the per-sample site tables written by the SNP runfile
+SITES_SUFFIX = ".snps.tsv"
+
+
+def sample_name(filename):
+    """Sample name of a site table or filtered call file, <folder>/<sample>.<suffix>"""
+    return os.path.basename(filename).split(".")[0]
+
+
+def read_sites(filename):
+    """Returns the (chromosome, position) of every record of a VCF or a CHROM/POS table.
+    Alleles are ignored, like bcftools isec -c all"""
+    opener = gzip.open if filename.endswith(".gz") else open
+    sites = set()
+    with opener(filename, "rt") as fh:
+        for line in fh:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.split("\t", 2)
+            sites.add((fields[0], int(fields[1])))
+    return sites
+
+
+def site_bits(samples):
+    """Places the sites of every sample on one shared coordinate system.
+    Returns a (samples x sites) matrix of packed bits, and the sorted shared sites"""
+    chromosomes = sorted(set(chrom for sites in samples for chrom, pos in sites))
+    chrom_ids = {chrom: i for i, chrom in enumerate(chromosomes)}
+    # Chromosome in the high bits, position in the low bits
+    keys = [
+        np.fromiter(
+            ((chrom_ids[chrom] << 32) | pos for chrom, pos in sites),
+            dtype=np.int64,
+            count=len(sites),
+        )
+        for sites in samples
+    ]
+    shared, columns = np.unique(
+        np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64), return_inverse=True
+    )
+    bits = np.zeros((len(samples), (len(shared) + 7) // 8), dtype=np.uint8)
+    start = 0
+    for row, key in enumerate(keys):
+        mask = np.zeros(bits.shape[1] * 8, dtype=bool)
+        mask[columns[start : start + len(key)]] = True
+        bits[row] = np.packbits(mask)
+        start += len(key)
+    sites = [(chromosomes[key >> 32], int(key & 0xFFFFFFFF)) for key in shared]
+    return bits, sites
+
+
+def pairwise_distances(bits, block_bytes=BLOCK_BYTES):
+    """Counts the sites found in exactly one sample of every pair.
+    |A xor B| = |A| + |B| - 2|A and B|, the intersections come from one matrix product per block"""
+    samples = bits.shape[0]
+    counts = np.zeros(samples, dtype=np.float64)
+    shared = np.zeros((samples, samples), dtype=np.float64)
+    for start in range(0, bits.shape[1], block_bytes):
+        dense = np.unpackbits(bits[:, start : start + block_bytes], axis=1).astype(np.float64)
+        counts += dense.sum(axis=1)
+        shared += dense @ dense.T
+    return np.rint(counts[:, None] + counts[None, :] - 2 * shared).astype(np.int64)
+
+
+def write_stats(names, distances, filename):
+    """Writes '<sample>_<sample> <distance>' per pair, in the order of the former bcftools loop"""
+    with open(filename, "w") as fh:
+        for one in range(len(names)):
+            for two in range(one + 1, len(names)):
+                fh.write("{}_{} {}\n".format(names[one], names[two], distances[one, two]))
+
+
+def write_matrix(names, distances, filename):
+    """Writes the full distance matrix as tab separated values with sample names as headers"""
+    with open(filename, "w") as fh:
+        fh.write("\t{}\n".format("\t".join(names)))
+        for name, row in zip(names, distances):
+            fh.write("{}\t{}\n".format(name, "\t".join(str(x) for x in row)))
+
+
+def snp_distances(filenames, output):
+    """Reads the SNP calls of every sample once and writes stats.out and distances.tsv to output.
+    Returns the sample names and the distance matrix"""
+    names = [sample_name(filename) for filename in filenames]
+    bits, _ = site_bits([read_sites(filename) for filename in filenames])
+    distances = pairwise_distances(bits)
+    write_stats(names, distances, os.path.join(output, "stats.out"))
+    write_matrix(names, distances, os.path.join(output, "distances.tsv"))
+    return names, distances
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import io
+import os
+import pathlib
+import pytest
+import random
+import time
+
+from distutils.sysconfig import get_python_lib
+
+from microSALT import logger
+from microSALT.utils.blastparse import read_hits
+
+@pytest.fixture
+def testdata_prefix():
+  test_path = os.path.abspath(os.path.join(pathlib.Path(__file__).parent.parent, 'tests/testdata/'))
+  #Check if release install exists
+  for entry in os.listdir(get_python_lib()):
+    if 'microSALT-' in entry:
+      test_path = os.path.abspath(os.path.join(os.path.expandvars('$CONDA_PREFIX'), 'testdata/'))
+  return test_path
+
+def blast_line(subject, start=1392, end=2186, node='NODE_32_length_3197_cov_303.662317'):
+  return '{0} \tplus\t{1}\t{0}\t99.874\t0.0\t1463\t{2}\t{3}\t1\t795\t795\n'.format(subject, node, start, end)
+
+def test_read_mlst(testdata_prefix):
+  with open('{}/blast_single_loci.txt'.format(testdata_prefix)) as fh:
+    hits = list(read_hits(fh, 'seq_type'))
+  assert len(hits) == 500
+  assert (hits[0].loci, hits[0].allele, hits[0].identity, hits[0].bitscore) == ('arcC', 3, 100.0, 843.0)
+  assert (hits[0].contig_name, hits[0].contig_length, hits[0].contig_coverage) == ('NODE_8', 133572, 80.129317)
+  assert hits[0].lookup == ('>arcC_3', '>arcC_')
+  assert set(hits[0].as_dict('seq_type')) >= {'loci', 'allele', 'span', 'contig_start', 'contig_end'}
+
+def test_read_resistance(testdata_prefix):
+  with open('{}/blast_single_resistance.txt'.format(testdata_prefix)) as fh:
+    hits = list(read_hits(fh, 'resistance', 'aminoglycoside'))
+  assert len(hits) == 7
+  assert (hits[0].gene, hits[0].reference, hits[0].instance) == ("aph(3')-III", 'M26832', 'aminoglycoside')
+  assert hits[0].lookup[0] == ">aph(3')-III"
+
+def test_read_expec():
+  lines = [blast_line('VFG000840(gb|YP_325608)_(hlyA)_hemolysin_toxin_protein_[Hemolysin_(VF0207)]_[Escherichia_coli_O157:H7_str._EDL933]', 500, 20),
+           blast_line('NC_000913.3:c_(2455646-2455083)_(yfcV1)_putative_fimbrial_protein_YfcV[Escherichia_coli_str._K-12_substr._MG1655]')]
+  hits = list(read_hits(io.StringIO(''.join(lines)), 'expec'))
+  assert (hits[0].reference, hits[0].gene, hits[0].instance, hits[0].virulence) == ('VFG000840', 'hlyA', 'hemolysin_toxin_protein', 'Hemolysin')
+  assert (hits[0].contig_start, hits[0].contig_end) == (20, 500)
+  assert hits[0].exact
+  assert (hits[1].gene, hits[1].virulence) == ('yfcV1', '')
+
+def test_read_throughput():
+  random.seed(3)
+  lines = ['# BLASTN 2.9.0+\n', '# 200000 hits found\n']
+  for i in range(200000):
+    lines.append(blast_line("aph(3')-III_{}_M{}".format(random.randint(1, 50), i), i, i + 800, 'NODE_{}_length_3197_cov_303.6'.format(i % 300)))
+  handle = io.StringIO(''.join(lines))
+  begin = time.time()
+  count = sum(1 for hit in read_hits(handle, 'resistance', 'aminoglycoside'))
+  elapsed = time.time() - begin
+  logger.info("Parsed {} resistance hits at {:.0f} hits/s".format(count, count / elapsed))
+  assert count == 200000
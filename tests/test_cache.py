@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import copy
+import os
+import subprocess
+import time
+
+from microSALT import preset_config, logger
+from microSALT.utils.cache import Artifact_Cache, artifact_key, cached_checksums, file_checksum
+
+def cache_config(tmp_path):
+  config = copy.deepcopy(preset_config)
+  config['folders']['cache'] = str(tmp_path / 'cache')
+  return config
+
+def test_cached_checksums(tmp_path):
+  fastq = tmp_path / 'reads.fastq.gz'
+  fastq.write_bytes(b'ACGT')
+  assert cached_checksums([str(fastq)]) == {str(fastq): 'f1f8f4bf413b16ad135722aa4591043e'}
+  assert os.path.isfile(str(tmp_path / '.checksums.json'))
+  #Changed files are hashed again
+  fastq.write_bytes(b'ACGTT')
+  os.utime(str(fastq), (0, 0))
+  assert cached_checksums([str(fastq)])[str(fastq)] == file_checksum(str(fastq))
+
+def test_artifact_key():
+  key = artifact_key(['a', 'b'], ['bwa'], {'careful': True})
+  assert key == artifact_key(['a', 'b'], ['bwa'], {'careful': True})
+  assert key != artifact_key(['b', 'a'], ['bwa'], {'careful': True})
+  assert key != artifact_key(['a', 'b'], ['bwa'], {'careful': False})
+
+def test_store_and_link(tmp_path):
+  cache = Artifact_Cache(cache_config(tmp_path), logger)
+  (tmp_path / 'contigs.fasta').write_text('>c\nACGT\n')
+  assert cache.lookup('assembly', 'k1', 'AAA1234A1') is None
+  script = cache.store_commands('assembly', 'k1', {'contigs.fasta': str(tmp_path / 'contigs.fasta')})
+  script += cache.link_commands('assembly', 'k1', {'contigs.fasta': str(tmp_path / 'linked.fasta')})
+  subprocess.check_call(['bash', '-c', 'set -e\n' + script])
+  assert cache.lookup('assembly', 'k1', 'AAA1234A2') == str(tmp_path / 'cache' / 'assembly' / 'k1')
+  assert (tmp_path / 'linked.fasta').read_text() == '>c\nACGT\n'
+  #Storing a key twice keeps the first entry
+  subprocess.check_call(['bash', '-c', 'set -e\n' + script])
+  assert os.listdir(str(tmp_path / 'cache' / 'assembly')) == ['k1']
+  assert cache.report() == {'assembly': (1, 2)}
+
+def test_evict(tmp_path):
+  cache = Artifact_Cache(cache_config(tmp_path), logger)
+  for age, key in enumerate(['new', 'mid', 'old']):
+    entry = tmp_path / 'cache' / 'reads' / key
+    entry.mkdir(parents=True)
+    (entry / 'forward.fastq.gz').write_bytes(b'A' * 1024)
+    used = time.time() - age * 10 * 86400
+    os.utime(str(entry), (used, used))
+  assert cache.evict(max_age_days=15) == [str(tmp_path / 'cache' / 'reads' / 'old')]
+  assert cache.evict(max_size_gb=1500.0 / (1 << 30)) == [str(tmp_path / 'cache' / 'reads' / 'mid')]
+  assert [path for used, size, path in cache.entries()] == [str(tmp_path / 'cache' / 'reads' / 'new')]
+
+def test_evicted_before_run(tmp_path):
+  cache = Artifact_Cache(cache_config(tmp_path), logger)
+  script = cache.link_commands('reads', 'gone', {'forward.fastq.gz': str(tmp_path / 'forward.fastq.gz')})
+  proc = subprocess.run(['bash', '-c', script + 'touch {}/after\n'.format(tmp_path)], stderr=subprocess.PIPE)
+  assert proc.returncode == 1 and b'was evicted' in proc.stderr
+  assert not os.path.exists(str(tmp_path / 'forward.fastq.gz')) and not os.path.exists(str(tmp_path / 'after'))
+
+def test_cache_folder_fallback(tmp_path):
+  config = copy.deepcopy(preset_config)
+  config['folders'].pop('cache', None)
+  config['folders']['results'] = str(tmp_path)
+  assert Artifact_Cache(config, logger).folder == str(tmp_path / '.cache')
+
@@ -20,6 +20,7 @@ from unittest.mock import patch, mock_open
 
 from microSALT import preset_config, logger
 from microSALT.cli import root
+from microSALT.utils import compression
 from microSALT.store.db_manipulator import DB_Manipulator
 
 def unpack_db_json(filename):
@@ -134,6 +135,23 @@ def test_analyse_dry(isdir, jc_glob, gzip, listdir, subproc, runner, config, pat
   assert "INFO - Execution finished!" in caplog.text
   caplog.clear()
 
+def test_analyse_zstd_missing(runner, path_testdata, tmp_path, monkeypatch):
+  #zstd outputs cannot be scraped without the zstandard package
+  monkeypatch.setattr(compression, 'zstandard', None)
+  missing = runner.invoke(root, ['analyse', path_testdata, '--input', str(tmp_path), '--compress', 'zstd', '--dry'])
+  assert missing.exit_code != 0
+  assert "needs the zstandard package" in missing.output
+
+def test_analyse_steps_array(runner, path_testdata, tmp_path):
+  #Step jobs are submitted per sample, so they cannot form one array
+  conflict = runner.invoke(root, ['analyse', path_testdata, '--input', str(tmp_path), '--steps', '--array', '--dry'])
+  assert conflict.exit_code != 0
+  assert "cannot be combined with --array" in conflict.output
+  #Sized resources differ per sample, an array shares one header
+  conflict = runner.invoke(root, ['analyse', path_testdata, '--input', str(tmp_path), '--sizing', '--array', '--dry'])
+  assert conflict.exit_code != 0
+  assert "--sizing sets resources per sample" in conflict.output
+
 @patch('subprocess.Popen')
 @patch('os.listdir')
 @patch('gzip.open')
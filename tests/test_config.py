@@ -12,15 +12,17 @@ def exp_config():
   precon = \
   {
     'slurm_header': 
-      {'time','threads', 'qos', 'job_prefix','project', 'type'},
+      {'time','threads', 'qos', 'job_prefix','project', 'type', 'steps', 'sizing'},
     'regex':
-      {'file_pattern', 'mail_recipient', 'verified_organisms'},
+      {'file_pattern', 'mail_recipient', 'verified_organisms', 'organism_aliases'},
     'folders':
-      {'results', 'reports', 'log_file', 'seqdata', 'profiles', 'references', 'resistances', 'genomes', 'expec', 'adapters'},
+      {'results', 'reports', 'log_file', 'seqdata', 'profiles', 'references', 'resistances', 'genomes', 'expec', 'adapters', 'cache', 'scratch'},
+    'cache':
+      {'max_age_days', 'max_size_gb'},
     'threshold':
       {'mlst_id', 'mlst_novel_id', 'mlst_span', 'motif_id', 'motif_span', 'total_reads_warn', 'total_reads_fail', 'NTC_total_reads_warn', \
                        'NTC_total_reads_fail', 'mapped_rate_warn', 'mapped_rate_fail', 'duplication_rate_warn', 'duplication_rate_fail', 'insert_size_warn', 'insert_size_fail', \
-                       'average_coverage_warn', 'average_coverage_fail', 'bp_10x_warn', 'bp_10x_fail', 'bp_30x_warn', 'bp_50x_warn', 'bp_100x_warn'},
+                       'average_coverage_warn', 'average_coverage_fail', 'bp_10x_warn', 'bp_10x_fail', 'bp_30x_warn', 'bp_50x_warn', 'bp_100x_warn', 'coverage_depths'},
     'database':
       {'SQLALCHEMY_DATABASE_URI' ,'SQLALCHEMY_TRACK_MODIFICATIONS' , 'DEBUG'},
     'genologics':
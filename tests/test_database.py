@@ -13,7 +13,10 @@ import time
 from distutils.sysconfig import get_python_lib
 from unittest.mock import patch
 
+from sqlalchemy import Column, MetaData, Table, inspect
+
 from microSALT.store.db_manipulator import DB_Manipulator
+from microSALT.store.orm_models import Samples
 from microSALT import preset_config, logger
 from microSALT.cli import root
 
@@ -54,6 +57,26 @@ def test_create_every_table(dbm):
   assert dbm.engine.dialect.has_table(dbm.engine, 'reports')
   assert dbm.engine.dialect.has_table(dbm.engine, 'collections')
 
+# Samples columns of the first release, before any were added
+BASELINE_SAMPLES = ['CG_ID_sample', 'CG_ID_project', 'Customer_ID_sample', 'organism', 'ST', 'pubmlst_ST', 'date_analysis',
+                    'genome_length', 'gc_percentage', 'n50', 'contigs', 'priority', 'total_reads', 'insert_size', 'duplication_rate',
+                    'mapped_rate', 'coverage_10x', 'coverage_30x', 'coverage_50x', 'coverage_100x', 'average_coverage',
+                    'reference_genome', 'application_tag', 'date_arrival', 'date_sequencing', 'date_libprep',
+                    'method_sequencing', 'method_libprep']
+
+def test_add_columns(dbm):
+  #Databases from before a column was added are upgraded on start
+  old = Table('samples', MetaData(), *[Column(c.name, c.type, primary_key=c.primary_key) for c in Samples.__table__.columns if c.name in BASELINE_SAMPLES])
+  assert len(old.columns) == len(BASELINE_SAMPLES)
+  Samples.__table__.drop(dbm.engine)
+  old.create(dbm.engine)
+  upgraded = DB_Manipulator(config=preset_config, log=logger)
+  assert set(c.name for c in Samples.__table__.columns) == set(column['name'] for column in inspect(upgraded.engine).get_columns('samples'))
+  assert upgraded.session.query(Samples).all() == []
+  assert upgraded.query_rec('Samples', {'CG_ID_sample': 'AAA1234A1'}) == []
+  #Upgrading twice changes nothing
+  upgraded.add_columns()
+
 def test_add_rec(caplog, dbm):
   #Adds records to all databases
   dbm.add_rec({'ST':'130','arcC':'6','aroE':'57','glpF':'45','gmk':'2','pta':'7','tpi':'58','yqiL':'52','clonal_complex':'CC1'}, dbm.profiles['staphylococcus_aureus'])
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import pytest
+import time
+
+from microSALT import preset_config, logger
+from microSALT.utils.executor import Local_Executor, Slurm_Executor, get_executor
+
+def runfile(tmp_path, name, body):
+  path = tmp_path / '{}.sh'.format(name)
+  path.write_text('#!/bin/bash\n{}\n'.format(body))
+  return str(path)
+
+def test_slurm_headerargs():
+  executor = Slurm_Executor(preset_config, logger)
+  header = preset_config['slurm_header']
+  line = executor.headerargs('AAA1234A1_blast', logfile='/tmp/x.log', threads=2, mem='4G', dependencies=['11', '12'])
+  assert line.startswith('-A {} -p {} -n 2 -t {} -J {}_AAA1234A1_blast --qos {}'.format(
+    header['project'], header['type'], header['time'], header['job_prefix'], header['qos']))
+  assert line.endswith('--output /tmp/x.log --mem 4G --dependency=afterok:11:12 --kill-on-invalid-dep=yes')
+  line = executor.headerargs('AAA1234_MAILJOB', partition='core', dependencies=['13'], after='afterany')
+  assert ' -p core ' in line and line.endswith('--dependency=afterany:13')
+
+def test_local_dependencies(tmp_path):
+  executor = get_executor(preset_config, logger, 'local', workers=2)
+  order = tmp_path / 'order.log'
+  first = executor.submit(runfile(tmp_path, 'first', 'sleep 0.2; echo first >> {}'.format(order)), 'first', logfile=str(tmp_path / 'first.log'))
+  failing = executor.submit(runfile(tmp_path, 'failing', 'echo broken; exit 4'), 'failing', logfile=str(tmp_path / 'failing.log'))
+  second = executor.submit(runfile(tmp_path, 'second', 'echo second >> {}'.format(order)), 'second', dependencies=[first])
+  skipped = executor.submit(runfile(tmp_path, 'skipped', 'echo skipped >> {}'.format(order)), 'skipped', dependencies=[first, failing])
+  final = executor.submit(runfile(tmp_path, 'final', 'echo final >> {}'.format(order)), 'final',
+                          dependencies=[second, skipped], after='afterany')
+  assert sorted(executor.wait()) == sorted([failing, skipped])
+  assert order.read_text().split() == ['first', 'second', 'final']
+  assert (tmp_path / 'failing.log').read_text() == 'broken\n'
+
+def test_local_bounded(tmp_path):
+  executor = Local_Executor(preset_config, logger, workers=2)
+  running = tmp_path / 'running'
+  running.mkdir()
+  #Each job records how many jobs run beside it
+  body = 'touch {0}/$$; sleep 0.3; ls {0} | wc -l >> {1}/peak.log; rm {0}/$$'.format(running, tmp_path)
+  for i in range(6):
+    executor.submit(runfile(tmp_path, 'job{}'.format(i), body), 'job{}'.format(i))
+  start = time.time()
+  assert executor.wait() == []
+  peaks = [int(x) for x in (tmp_path / 'peak.log').read_text().split()]
+  assert len(peaks) == 6 and max(peaks) <= 2
+  assert time.time() - start < 6 * 0.3
+
+def test_local_dry(tmp_path):
+  executor = get_executor(preset_config, logger, 'local', dry=True)
+  assert executor.submit(runfile(tmp_path, 'job', 'touch {}/ran'.format(tmp_path)), 'job') is None
+  assert executor.wait() == []
+  assert not (tmp_path / 'ran').exists()
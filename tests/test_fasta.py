@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import os
+import pytest
+
+from microSALT.utils.fasta import Fasta_Reader, fasta_lengths, index_fasta, split_regions, write_fai
+
+@pytest.fixture
+def fastafile(tmp_path):
+  fasta = str(tmp_path / 'genome.fasta')
+  with open(fasta, 'w') as fh:
+    fh.write('>contig_1 some description\nACGTA\nCGTAC\nGT\n>contig_2\nTTTTT\nGG\n>empty\n')
+  return fasta
+
+def test_index_fasta(fastafile):
+  entries = list(index_fasta(fastafile))
+  assert [e.name for e in entries] == ['contig_1', 'contig_2', 'empty']
+  assert entries[0].header == '>contig_1 some description'
+  assert (entries[0].length, entries[0].offset, entries[0].linebases, entries[0].linewidth) == (12, 27, 5, 6)
+  assert (entries[1].length, entries[1].offset) == (7, 52)
+  assert entries[2].length == 0
+  assert fasta_lengths(fastafile) == {'>contig_1 some description': 12, '>contig_2': 7, '>empty': 0}
+
+def test_write_fai(fastafile):
+  write_fai(fastafile)
+  with open('{}.fai'.format(fastafile)) as fh:
+    lines = fh.read().splitlines()
+  assert lines[0] == 'contig_1\t12\t27\t5\t6'
+  assert lines[1] == 'contig_2\t7\t52\t5\t6'
+
+def test_fasta_reader(fastafile):
+  with Fasta_Reader(fastafile) as reader:
+    assert os.path.isfile('{}.fai'.format(fastafile))
+    assert reader.fetch('contig_1') == 'ACGTACGTACGT'
+    assert reader.fetch('contig_1', 3, 8) == 'TACGT'
+    assert reader.fetch('contig_1', 10) == 'GT'
+    assert reader.fetch('contig_2', 4, 100) == 'TGG'
+    assert reader.fetch('empty') == ''
+    assert reader.length('contig_2') == 7
+
+def test_split_regions():
+  shards = split_regions([('contig_1', 12), ('contig_2', 7), ('empty', 0)], 3)
+  assert shards == [[('contig_1', 0, 7)], [('contig_1', 7, 12), ('contig_2', 0, 2)], [('contig_2', 2, 7)]]
+  assert split_regions([('contig_1', 12)], 1) == [[('contig_1', 0, 12)]]
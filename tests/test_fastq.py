@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import gzip
+import os
+import pytest
+import tracemalloc
+import zlib
+
+from microSALT.utils import fastq
+from microSALT.utils.fastq import STATS_INDEX, cached_fastq_stats, check_fastq, check_fastqs, ends_properly, fastq_stats, sample_stats
+
+def records(start, count):
+  return ''.join('@read{0}\nACGTACGTAC\n+\nFFFFFFFFFF\n'.format(i) for i in range(start, start + count)).encode()
+
+@pytest.fixture
+def multimember(tmp_path):
+  path = tmp_path / 'multi.fastq.gz'
+  with open(str(path), 'wb') as fh:
+    for i in range(3):
+      fh.write(gzip.compress(records(i * 1000, 1000)))
+  return path
+
+def test_multimember(multimember):
+  status = check_fastq(str(multimember), chunk_size=512)
+  assert status.members == 3
+  assert not (status.truncated or status.crc_error or status.error)
+  assert ends_properly(status)
+  assert status.tail.endswith(b'@read2999\nACGTACGTAC\n+\nFFFFFFFFFF\n')
+
+def test_truncated(multimember, tmp_path):
+  data = multimember.read_bytes()
+  path = tmp_path / 'truncated.fastq.gz'
+  path.write_bytes(data[:-100])
+  status = check_fastq(str(path), chunk_size=512)
+  assert status.truncated and status.members == 2
+
+def test_crc_error(tmp_path):
+  data = bytearray(gzip.compress(records(0, 100)))
+  #Trailer holds the CRC32 and then the size of the member
+  data[-8] ^= 0xff
+  path = tmp_path / 'crc.fastq.gz'
+  path.write_bytes(bytes(data))
+  status = check_fastq(str(path))
+  assert status.crc_error and not status.truncated
+
+def test_padding_and_garbage(multimember, tmp_path):
+  padded = tmp_path / 'padded.fastq.gz'
+  padded.write_bytes(multimember.read_bytes() + b'\x00' * 2048)
+  assert not check_fastq(str(padded), chunk_size=512).error
+  garbage = tmp_path / 'garbage.fastq.gz'
+  garbage.write_bytes(multimember.read_bytes() + b'not gzip')
+  assert check_fastq(str(garbage)).error
+
+def test_split_magic(tmp_path):
+  #Chunks ending one byte into the next member split its gzip magic
+  first, second = gzip.compress(records(0, 100)), gzip.compress(records(100, 100))
+  path = tmp_path / 'split.fastq.gz'
+  path.write_bytes(first + second)
+  for chunk_size in [len(first) + 1, len(first) - 1, 1, 2]:
+    status = check_fastq(str(path), chunk_size=chunk_size)
+    assert status.members == 2 and not (status.error or status.truncated)
+
+def test_bad_ending(tmp_path):
+  path = tmp_path / 'ending.fastq.gz'
+  path.write_bytes(gzip.compress(records(0, 10) + b'@read10\nACGT\n'))
+  assert not ends_properly(check_fastq(str(path)))
+
+def test_bounded_memory(tmp_path):
+  #About 200MB of decompressed reads
+  path = tmp_path / 'large.fastq.gz'
+  block = records(0, 10000)
+  packer = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+  with open(str(path), 'wb') as fh:
+    for i in range(500):
+      fh.write(packer.compress(block))
+    fh.write(packer.flush())
+  tracemalloc.start()
+  status = check_fastq(str(path))
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  assert status.members == 1 and ends_properly(status)
+  assert peak < 16 << 20
+
+def test_concurrent(multimember, tmp_path):
+  statuses = check_fastqs([str(multimember), str(tmp_path / 'missing.fastq.gz')], workers=2)
+  assert statuses[0].members == 3
+  assert isinstance(statuses[1], Exception)
+
+def test_fastq_stats(tmp_path):
+  path = tmp_path / 'stats.fastq.gz'
+  #Phred+33: '5' is Q20, '?' is Q30, 'I' is Q40
+  path.write_bytes(gzip.compress(b'@r1\nACGT\n+\n55??\n@r2\nACG\n+\nIII\n'))
+  stats = fastq_stats(str(path))
+  assert stats == {'reads': 2, 'bases': 7, 'quality': 20 * 2 + 30 * 2 + 40 * 3, 'q30': 5}
+  combined = sample_stats([stats, stats])
+  assert combined['input_reads'] == 4 and combined['input_bases'] == 14
+  assert combined['input_mean_quality'] == pytest.approx(220 / 7.0)
+  assert combined['input_q30'] == pytest.approx(5 / 7.0)
+
+def test_fastq_stats_cache(multimember, tmp_path, monkeypatch):
+  first = cached_fastq_stats([str(multimember)], workers=1)
+  assert first[str(multimember)]['reads'] == 3000
+  assert os.path.isfile(str(tmp_path / STATS_INDEX))
+  monkeypatch.setattr(fastq, 'fastq_stats', lambda filename: pytest.fail('cached stats recomputed'))
+  assert cached_fastq_stats([str(multimember)], workers=1) == first
+  #Changed files are counted again
+  multimember.write_bytes(gzip.compress(records(0, 10)))
+  monkeypatch.undo()
+  assert cached_fastq_stats([str(multimember)], workers=1)[str(multimember)]['reads'] == 10
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import copy
+import gzip
 import json
 import mock
 import os
@@ -7,15 +9,20 @@ import pathlib
 import pdb
 import pytest
 import re
+import subprocess
 
 from distutils.sysconfig import get_python_lib
 from unittest.mock import patch
 
 from microSALT.store.db_manipulator import DB_Manipulator
-from microSALT.utils.job_creator import Job_Creator
+from microSALT.utils.job_creator import BASES_PER_BYTE, GENOME_SIZE, Job_Creator, gigabytes
 from microSALT import preset_config, logger
 from microSALT.cli import root
 
+# Outputs that tool stubs write, so later commands can move or remove them. OUT holds the -o argument
+STUB_OUTPUTS = {'trimmomatic': 'touch "${@:7:4}"', 'samtools': '[ "$1" != index ] || touch $2.bai; touch ${OUT:-/dev/null}',
+                'spades.py': 'mkdir -p $OUT && touch $OUT/contigs.fasta', 'quast.py': 'touch $OUT/report.tsv'}
+
 @pytest.fixture
 def testdata():
   testdata = os.path.abspath(os.path.join(pathlib.Path(__file__).parent.parent, 'tests/testdata/sampleinfo_samples.json'))
@@ -43,6 +50,62 @@ def test_verify_fastq(gopen, stat, listdir, testdata):
   t = jc.verify_fastq()
   assert len(t) > 0
 
+def test_verify_fastq_pairing(testdata, tmp_path, caplog):
+  read = b'@r1\nACGT\n+\nFFFF\n'
+  names = ['ACC6438A3_HVMHWDSXX_L{}_{}.fastq.gz'.format(lane, mate) for lane in range(1, 9) for mate in [1, 2]]
+  for name in names:
+    (tmp_path / name).write_bytes(gzip.compress(read))
+  (tmp_path / 'ACC6438A3_HVMHWDSXX_L9_1.fastq.gz').write_bytes(gzip.compress(read))
+  (tmp_path / names[0]).write_bytes(gzip.compress(read)[:-20])
+  jc = Job_Creator(run_settings={'input':str(tmp_path)}, config=preset_config, log=logger,sampleinfo=testdata)
+  assert jc.verify_fastq() == sorted(names)
+  assert "{} has a truncated gzip member".format(names[0]) in caplog.text
+
+def test_preflight(testdata, tmp_path, caplog):
+  read = b'@r1\nACGT\n+\n????\n'
+  for sample, reads in [('AAA1234A1', 3), ('AAA1234A2', 0)]:
+    (tmp_path / sample).mkdir()
+    for mate in [1, 2]:
+      (tmp_path / sample / 'ACC6438A3_HVMHWDSXX_L1_{}.fastq.gz'.format(mate)).write_bytes(gzip.compress(read * reads))
+  jc = Job_Creator(run_settings={'input':str(tmp_path), 'preflight':True}, config=preset_config, log=logger,sampleinfo=testdata)
+  stats = jc.preflight_stats({'AAA1234A1': str(tmp_path / 'AAA1234A1'), 'AAA1234A2': str(tmp_path / 'AAA1234A2')})
+  assert stats['AAA1234A1'] == {'input_reads': 6, 'input_bases': 24, 'input_mean_quality': 30.0, 'input_q30': 1.0}
+  assert jc.preflight_gate('AAA1234A1', stats['AAA1234A1'], {'application_tag': 'MWRNXTR003'})
+  assert "only 0.00% of the reads" in caplog.text
+  assert not jc.preflight_gate('AAA1234A2', stats['AAA1234A2'], testdata[1])
+
+def run_preprocessing(testdata, tmp_path, lanes, stream):
+  """Runs the preprocessing section with a stub trimmomatic. Returns the recorded seconds and bytes"""
+  indir = tmp_path / 'input'
+  outdir = tmp_path / 'output'
+  for folder in [indir, outdir]:
+    folder.mkdir(parents=True)
+  reads = ''.join('@r{0}\nACGTACGTACGTACGT\n+\nFFFFFFFFFFFFFFFF\n'.format(i) for i in range(20000)).encode()
+  for lane in range(1, lanes + 1):
+    for mate in [1, 2]:
+      (indir / 'ACC6438A3_HVMHWDSXX_L{}_{}.fastq.gz'.format(lane, mate)).write_bytes(gzip.compress(reads))
+
+  jc = Job_Creator(run_settings={'input':str(indir), 'finishdir':str(outdir), 'stream_lanes':stream}, config=preset_config, log=logger,sampleinfo=testdata[0])
+  jc.batchfile = str(outdir / 'runfile.sbatch')
+  with open(jc.batchfile, 'w') as fh:
+    fh.write('#!/bin/bash\nset -e\n')
+  jc.create_preprocsection()
+  subprocess.check_call(['bash', jc.batchfile])
+  with open(str(outdir / 'preprocessing.stats')) as fh:
+    seconds, written = fh.readlines()[1].split()
+  return int(seconds), int(written)
+
+def test_streamed_lanes(testdata, tmp_path, tool_stubs):
+  tool_stubs(['trimmomatic'], {'trimmomatic': 'cat "$5" "$6" > /dev/null\nfor f in "$7" "$8" "$9" "${10}"; do echo trimmed > "$f"; done'})
+  concatenated = run_preprocessing(testdata, tmp_path / 'cat', 2, False)
+  streamed = run_preprocessing(testdata, tmp_path / 'stream', 2, True)
+  linked = run_preprocessing(testdata, tmp_path / 'link', 1, True)
+  logger.info("Preprocessing wrote {} bytes concatenating, {} streaming and {} linking".format(concatenated[1], streamed[1], linked[1]))
+  assert streamed[1] < concatenated[1] / 10
+  assert linked[1] < concatenated[1] / 10
+  with open(str(tmp_path / 'stream' / 'output' / 'runfile.sbatch')) as fh:
+    assert '<(zcat ' in fh.read()
+
 @patch('re.search')
 @patch('microSALT.utils.job_creator.glob.glob')
 def test_blast_subset(glob_search, research, testdata):
@@ -61,6 +124,48 @@ def test_blast_subset(glob_search, research, testdata):
       count = count + 1
   assert count > 0
 
+@patch('microSALT.utils.job_creator.glob.glob')
+def test_compressed_blast_subset(glob_search, testdata, tmp_path):
+  jc = Job_Creator(run_settings={'input':'/tmp/', 'compress':'gzip'}, config=preset_config, log=logger,sampleinfo=testdata)
+  jc.batchfile = str(tmp_path / 'runfile.sbatch')
+  glob_search.return_value = ["/a/a/arcC.tfa", "/a/a/aroE.tfa"]
+  jc.blast_subset('mlst', '/tmp/*')
+  searches = [x for x in open(jc.get_sbatch(), 'r').readlines() if "blastn -db" in x]
+  assert len(searches) == 2
+  for search in searches:
+    assert " -out " not in search
+    assert re.search(r"\| gzip -c > \S+/blast_search/mlst/loci_query_\w+\.txt\.gz$", search)
+
+def test_merged_blast_subset(testdata, tmp_path):
+  config = copy.deepcopy(preset_config)
+  config['folders']['resistances'] = str(tmp_path)
+  for name in ['aminoglycoside.fsa', 'beta-lactam.fsa', 'merged.nsq']:
+    (tmp_path / name).write_text('>a_1_b\nACGT\n')
+  (tmp_path / '.merged.fsa').write_text('>a_1_b\nACGT\n' * 600)
+  jc = Job_Creator(run_settings={'input':'/tmp/', 'finishdir':str(tmp_path / 'out')}, config=config, log=logger, sampleinfo=testdata)
+  jc.batchfile = str(tmp_path / 'runfile.sbatch')
+  jc.blast_subset('resistance', '{}/*.fsa'.format(tmp_path))
+  searches = [x for x in open(jc.get_sbatch(), 'r').readlines() if "blastn -db" in x]
+  assert len(searches) == 1
+  assert searches[0].startswith('blastn -db {}/merged '.format(tmp_path))
+  #All records of the merged database are reported, without prefilters
+  assert ' -max_target_seqs 600 ' in searches[0]
+  assert '-perc_identity' not in searches[0] and '-max_hsps' not in searches[0]
+  assert searches[0].rstrip().endswith('-out {}/out/blast_search/resistance/merged.txt'.format(tmp_path))
+
+  #Stale merged databases are not used
+  os.utime(str(tmp_path / 'merged.nsq'), (0, 0))
+  jc.blast_subset('resistance', '{}/*.fsa'.format(tmp_path))
+  searches = [x for x in open(jc.get_sbatch(), 'r').readlines() if "blastn -db" in x]
+  assert len(searches) == 3
+
+  #Nor are databases of unknown size
+  os.utime(str(tmp_path / 'merged.nsq'))
+  (tmp_path / '.merged.fsa').unlink()
+  jc.blast_subset('resistance', '{}/*.fsa'.format(tmp_path))
+  searches = [x for x in open(jc.get_sbatch(), 'r').readlines() if "blastn -db" in x]
+  assert len(searches) == 5
+
 @patch('subprocess.Popen')
 def test_create_snpsection(subproc,testdata):
   #Sets up subprocess mocking
@@ -78,6 +183,10 @@ def test_create_snpsection(subproc,testdata):
     if "# SNP pair-wise distance" in x:
       count = count + 1
   assert count > 0
+  #All pairs are compared by one process
+  lines = open(jc.get_sbatch(), 'r').readlines()
+  assert not [x for x in lines if "bcftools isec" in x]
+  assert len([x for x in lines if x.startswith("microSALT utils snpdistance ")]) == 1
 
 @patch('subprocess.Popen')
 def test_project_job(subproc,testdata):
@@ -90,6 +199,362 @@ def test_project_job(subproc,testdata):
   jc = Job_Creator( config=preset_config, log=logger, sampleinfo=testdata, run_settings={'pool':["AAA1234A1","AAA1234A2"], 'input':'/tmp/AAA1234'})
   jc.project_job()
 
+@pytest.fixture
+def sbatch_calls(tmp_path, monkeypatch):
+  """Puts an sbatch on PATH that logs its arguments and hands out job ids 4001, 4002, ..."""
+  stubs = tmp_path / 'bin'
+  stubs.mkdir(exist_ok=True)
+  calls = tmp_path / 'sbatch.log'
+  (stubs / 'sbatch').write_text('#!/bin/bash\necho "$@" >> {0}\necho "Submitted batch job $((4000 + $(wc -l < {0})))"\n'.format(calls))
+  os.chmod(str(stubs / 'sbatch'), 0o755)
+  monkeypatch.setenv('PATH', '{}:{}'.format(stubs, os.environ['PATH']))
+  return calls
+
+@pytest.fixture
+def tool_stubs(tmp_path, monkeypatch):
+  """Puts stubs on PATH that log their arguments to calls.log. Stubs write the outputs in STUB_OUTPUTS,
+  unless bodies gives them their own. Returns the log"""
+  stubs = tmp_path / 'bin'
+  stubs.mkdir(exist_ok=True)
+  calls = tmp_path / 'calls.log'
+  monkeypatch.setenv('PATH', '{}:{}'.format(stubs, os.environ['PATH']))
+  def stub(tools, bodies={}):
+    for tool in tools:
+      (stubs / tool).write_text('#!/bin/bash\nOUT=$(printf "%s\\n" "$@" | grep -A1 -x -- -o | tail -n +2)\n{}\necho {} "$@" >> {}\n'.format(
+        bodies.get(tool, STUB_OUTPUTS.get(tool, '')), tool, calls))
+      os.chmod(str(stubs / tool), 0o755)
+    return calls
+  return stub
+
+@pytest.fixture
+def config(tmp_path):
+  """A copy of the preset config that submits for real and writes results under tmp_path"""
+  config = copy.deepcopy(preset_config)
+  config['dry'] = False
+  config['folders']['results'] = str(tmp_path / 'results')
+  return config
+
+def project_input(tmp_path, samples):
+  indir = tmp_path / 'AAA1234'
+  for entry in samples:
+    (indir / entry['CG_ID_sample']).mkdir(parents=True)
+    for mate in [1, 2]:
+      (indir / entry['CG_ID_sample'] / 'ACC6438A3_HVMHWDSXX_L1_{}.fastq.gz'.format(mate)).write_bytes(gzip.compress(b'@r1\nACGT\n+\nFFFF\n'))
+  return indir
+
+def test_array_project_job(testdata, tmp_path, sbatch_calls, config):
+  indir = project_input(tmp_path, testdata[:2])
+  calls = sbatch_calls
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:2], run_settings={'input':str(indir), 'qc_only':True, 'array':True, 'array_limit':2})
+  jc.project_job()
+
+  submitted = calls.read_text().splitlines()
+  assert len(submitted) == 2
+  assert '--array=0-1%2' in submitted[0] and submitted[0].endswith('array_dispatch.sh')
+  assert 'MAILJOB' in submitted[1] and '--dependency=afterany:4001' in submitted[1]
+  dispatcher = '{}/array_dispatch.sh'.format(jc.finishdir)
+  listed = subprocess.check_output(['bash', '-c', 'source <(grep -v ^exec {}); printf "%s\\n" "${{RUNFILES[@]}}"'.format(dispatcher)]).decode().split()
+  assert sorted(listed) == ['{}/{}/runfile.sbatch'.format(jc.finishdir, entry['CG_ID_sample']) for entry in testdata[:2]]
+  assert all(os.path.isfile(runfile) for runfile in listed)
+
+def test_local_project_job(testdata, tmp_path, tool_stubs, config):
+  """Runs a generated project end to end on the local executor with stub tools"""
+  indir = project_input(tmp_path, testdata[:2])
+  order = tool_stubs(['trimmomatic', 'bwa', 'samtools', 'picard', 'microSALT', 'activate'])
+
+  config['folders']['log_file'] = str(tmp_path / 'microsalt.log')
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:2], run_settings={'input':str(indir), 'qc_only':True, 'executor':'local', 'workers':2})
+  jc.project_job()
+
+  calls = order.read_text().splitlines()
+  assert len([call for call in calls if call.startswith('bwa mem')]) == 2
+  assert calls[-1].startswith('microSALT utils finish {}/sampleinfo.json'.format(jc.finishdir))
+  assert os.path.isfile('{}/run_complete.out'.format(jc.finishdir))
+  for entry in testdata[:2]:
+    assert os.path.isfile('{0}/{1}/slurm_{1}.log'.format(jc.finishdir, entry['CG_ID_sample']))
+    assert os.path.isfile('{}/{}/preprocessing.stats'.format(jc.finishdir, entry['CG_ID_sample']))
+
+def snp_folders(tmp_path, names):
+  folders = list()
+  for name in names:
+    (tmp_path / 'results' / '{}_2020.1.2_3.4.5'.format(name)).mkdir(parents=True)
+    folders.append('{}/results/{}_2020.1.2_3.4.5/'.format(tmp_path, name))
+  return folders
+
+def test_snp_job(testdata, tmp_path, sbatch_calls, config):
+  config['folders']['genomes'] = str(tmp_path)
+  (tmp_path / '{}.fasta'.format(testdata[0]['reference'])).write_text('>chr1\n{}\n>plasmid\nACGT\n'.format('A' * 96))
+  folders = snp_folders(tmp_path, ['AAA1234A1', 'AAA1234A2', 'AAA1234A3'])
+  jc = Job_Creator(run_settings={'input':folders, 'shards':2}, config=config, log=logger, sampleinfo=testdata[:2])
+  jc.snp_job()
+
+  calls = sbatch_calls.read_text().splitlines()
+  assert len(calls) == 4
+  assert [' -n 2 ' in call for call in calls] == [True, True, True, False]
+  assert calls[-1].endswith('--dependency=afterok:4001:4002:4003 --kill-on-invalid-dep=yes {}/runfile.sbatch'.format(jc.finishdir))
+  runfile = open('{}/runfile_AAA1234A2.sbatch'.format(jc.finishdir)).read()
+  assert runfile.count(' -t {}/AAA1234A2_shards/'.format(jc.finishdir)) == 2
+  assert open('{}/AAA1234A2_shards/1.bed'.format(jc.finishdir)).read() == 'chr1\t50\t96\nplasmid\t0\t4\n'
+  distance = [x for x in open(jc.get_sbatch()).readlines() if x.startswith('microSALT utils snpdistance')]
+  assert distance[0].split()[3:6] == ['{}/AAA1234A{}.snps.tsv'.format(jc.finishdir, i) for i in [1, 2, 3]]
+
+def test_local_snp_job(testdata, tmp_path, monkeypatch, tool_stubs, config):
+  order = tool_stubs(['samtools', 'freebayes', 'bcftools', 'vcftools', 'microSALT', 'activate'])
+  monkeypatch.setenv('MICROSALT_CONFIG', str(tmp_path / 'config.json'))
+  folders = snp_folders(tmp_path, ['AAA1234A1', 'AAA1234A2'])
+  jc = Job_Creator(run_settings={'input':folders, 'executor':'local', 'workers':2}, config=config, log=logger, sampleinfo=testdata[:2])
+  jc.snp_job()
+  calls = order.read_text().splitlines()
+  assert len([call for call in calls if call.startswith('freebayes')]) == 2
+  #The distance job loads the microSALT environment like the mail job
+  assert calls[-2:] == ['activate', calls[-1]] and calls[-1].startswith('microSALT utils snpdistance')
+  assert 'export MICROSALT_CONFIG={}\nsource activate $CONDA_DEFAULT_ENV\nmicroSALT utils snpdistance'.format(
+    tmp_path / 'config.json') in open(jc.get_sbatch()).read()
+
+def test_gigabytes():
+  assert [gigabytes(mem) for mem in ['32G', '1t', '2048M', '500M', '4096']] == [32, 1024, 2, 1, 4]
+
+@pytest.mark.parametrize('bases,row', [(10**8, 0), (25 * 10**7, 1), (10**10, 3)])
+def test_sized_sample_job(testdata, tmp_path, sbatch_calls, config, bases, row):
+  indir = project_input(tmp_path, testdata[:1]) / testdata[0]['CG_ID_sample']
+  config['folders']['genomes'] = str(tmp_path)
+  #A 2 Mb reference, so 10^8 bases is 50x
+  (tmp_path / '{}.fasta'.format(testdata[0]['reference'])).write_text('>chr\n{}\n'.format('A' * 2000000))
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1], run_settings={'input':str(indir), 'sizing':True,
+                   'input_stats':{'input_bases':bases}})
+  assert jc.expected_depth() == bases / 2000000.0
+  jc.project_job(single_sample=True)
+
+  chosen = config['slurm_header']['sizing']['table'][row]
+  submitted = sbatch_calls.read_text().splitlines()[0]
+  assert '-n {} -t {} '.format(chosen['threads'], chosen['time']) in submitted and '--mem {}'.format(chosen['mem']) in submitted
+  runfile = open(jc.get_sbatch()).read()
+  assert 'spades.py --threads {} --careful --memory {} '.format(chosen['threads'], gigabytes(chosen['mem'])) in runfile
+
+def test_sizing_without_config(testdata, tmp_path, sbatch_calls, config):
+  #Configs from before --sizing keep their resources
+  indir = project_input(tmp_path, testdata[:1]) / testdata[0]['CG_ID_sample']
+  del config['slurm_header']['sizing']
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1], run_settings={'input':str(indir), 'sizing':True,
+                   'input_stats':{'input_bases':10**9}})
+  assert jc.expected_depth() == 10**9 / float(GENOME_SIZE)
+  jc.project_job(single_sample=True)
+  submitted = sbatch_calls.read_text().splitlines()[0]
+  assert '-n {} -t {} '.format(config['slurm_header']['threads'], config['slurm_header']['time']) in submitted
+
+def test_cached_sample_job(testdata, tmp_path, sbatch_calls, config):
+  indir = project_input(tmp_path, testdata[:1]) / testdata[0]['CG_ID_sample']
+  config['folders']['cache'] = str(tmp_path / 'cache')
+  config['folders']['results'] = str(tmp_path / 'first')
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1], run_settings={'input':str(indir), 'cache':True})
+  jc.project_job(single_sample=True)
+  runfile = open(jc.get_sbatch()).read()
+  for kind in ['reads', 'alignment', 'assembly']:
+    assert 'mv -T $CACHE_TMP {}/cache/{}/{} '.format(tmp_path, kind, jc.cache_keys[kind]) in runfile
+    #As if the first run had finished
+    (tmp_path / 'cache' / kind / jc.cache_keys[kind]).mkdir(parents=True)
+
+  config['folders']['results'] = str(tmp_path / 'second')
+  rerun = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1], run_settings={'input':str(indir), 'cache':True})
+  rerun.project_job(single_sample=True)
+  assert rerun.cache_keys == jc.cache_keys
+  runfile = open(rerun.get_sbatch()).read()
+  assert runfile.count('from the cache') == 3
+  assert 'trimmomatic PE' not in runfile and 'bwa mem' not in runfile and 'spades.py' not in runfile
+  assert 'samtools idxstats' in runfile and 'quast.py' in runfile
+  assert rerun.cache.report() == {'reads': (1, 2), 'alignment': (1, 2), 'assembly': (1, 2)}
+
+def test_scratch_sample_job(testdata, tmp_path, sbatch_calls, config):
+  indir = project_input(tmp_path, testdata[:1]) / testdata[0]['CG_ID_sample']
+  resistances = tmp_path / 'resistances'
+  resistances.mkdir()
+  for gene in ['aminoglycoside', 'colistin']:
+    (resistances / '{}.fsa'.format(gene)).write_text('>{}\nACGT\n'.format(gene))
+  config['folders']['resistances'] = str(resistances)
+  config['folders']['scratch'] = '/local/scratch'
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1], run_settings={'input':str(indir), 'scratch':True})
+  jc.project_job(single_sample=True)
+  runfile = open(jc.get_sbatch()).read()
+  assert 'SCRATCH=$(mktemp -d /local/scratch/microSALT_{}.XXXXXX)'.format(jc.name) in runfile
+  assert 'cp -r {} $SCRATCH/resistance\n'.format(resistances) in runfile
+  assert '-db $SCRATCH/resistance/colistin ' in runfile
+  assert 'spades.py' in runfile and ' -o $SCRATCH/work/assembly ' in runfile
+  assert 'trimmed/*_trim_front_pair.fastq.gz' in runfile and 'blast_search/*/*' in runfile
+  #Nothing but the copy back writes to the results folder
+  assert 'alignment/*.bai' in runfile
+  assert [x for x in runfile.splitlines() if jc.finishdir in x and not x.startswith('mkdir -p')] == \
+    ['if [ -n "$FAILED" ]; then echo "A command failed with status $FAILED, nothing is copied back to {}" >&2; exit $FAILED; fi'.format(jc.finishdir),
+     '  if [ -e "$file" ]; then cp -L --parents "$file" {}/; fi'.format(jc.finishdir), 'cd {}'.format(jc.finishdir)]
+
+def test_local_scratch_sample_job(testdata, tmp_path, tool_stubs, config):
+  indir = project_input(tmp_path, testdata[:1]) / testdata[0]['CG_ID_sample']
+  calls = tool_stubs(['trimmomatic', 'bwa', 'samtools', 'picard'])
+  scratch = tmp_path / 'scratch'
+  config['folders']['scratch'] = str(scratch)
+  config['folders']['genomes'] = str(tmp_path)
+  (tmp_path / '{}.fasta'.format(testdata[0]['reference'])).write_text('>ref\nACGT\n')
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1],
+                   run_settings={'input':str(indir), 'qc_only':True, 'scratch':True, 'executor':'local'})
+  jc.project_job(single_sample=True)
+  bwa = [x for x in calls.read_text().splitlines() if x.startswith('bwa mem')][0]
+  assert '{}/microSALT_{}.'.format(scratch, jc.name) in bwa
+  #Scraped statistics are copied back, the scratch folder is gone
+  assert os.path.isfile('{}/alignment/{}_{}.stats.map'.format(jc.finishdir, jc.name, testdata[0]['reference']))
+  assert os.path.isfile('{}/preprocessing.stats'.format(jc.finishdir))
+  #The BAM index is kept for the SNP job
+  assert os.path.isfile('{}/alignment/{}_{}.bam_sort_rmdup.bai'.format(jc.finishdir, jc.name, testdata[0]['reference']))
+  #Deliverable reads are copied back, concatenated input is not
+  assert sorted(os.listdir('{}/trimmed'.format(jc.finishdir))) == \
+    ['ACC6438A3_trim_front_pair.fastq.gz', 'ACC6438A3_trim_rev_pair.fastq.gz', 'ACC6438A3_trim_unpair.fastq.gz']
+  assert os.listdir(str(scratch)) == []
+
+def test_scratch_sample_job_failure(testdata, tmp_path, tool_stubs, config):
+  """Nothing is copied back after a failed command and the job keeps its status"""
+  indir = project_input(tmp_path, testdata[:1]) / testdata[0]['CG_ID_sample']
+  tool_stubs(['trimmomatic', 'bwa', 'samtools', 'picard'], {'picard': 'exit 3'})
+  scratch = tmp_path / 'scratch'
+  config['folders']['scratch'] = str(scratch)
+  config['folders']['genomes'] = str(tmp_path)
+  (tmp_path / '{}.fasta'.format(testdata[0]['reference'])).write_text('>ref\nACGT\n')
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1],
+                   run_settings={'input':str(indir), 'finishdir':str(tmp_path / 'out'), 'qc_only':True, 'scratch':True})
+  jc.sample_job()
+  finished = subprocess.run(['bash', jc.get_sbatch()], stderr=subprocess.PIPE)
+  assert finished.returncode == 3
+  assert b'A command failed with status 3, nothing is copied back' in finished.stderr
+  assert os.listdir(jc.finishdir) == ['runfile.sbatch']
+  assert os.listdir(str(scratch)) == []
+
+def test_estimated_depth(testdata, tmp_path):
+  indir = project_input(tmp_path, testdata[:1]) / testdata[0]['CG_ID_sample']
+  config = copy.deepcopy(preset_config)
+  config['folders']['genomes'] = str(tmp_path)
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1], run_settings={'input':str(indir)})
+  size = sum(os.stat(str(fastq)).st_size for fastq in indir.iterdir())
+  #Without a reference the configured genome size is used
+  assert jc.expected_depth() == size * BASES_PER_BYTE / config['slurm_header']['sizing']['genome_size']
+
+def test_incremental_project_job(testdata, tmp_path, tool_stubs, config):
+  """Sample jobs ingest their own results, priority samples included, and only the project job reports"""
+  samples = copy.deepcopy(testdata[:2])
+  samples[1]['priority'] = 'priority'
+  indir = project_input(tmp_path, samples)
+  #Sample information has to be in place when samples ingest their results
+  order = tool_stubs(['trimmomatic', 'bwa', 'samtools', 'picard', 'activate', 'microSALT'], {'microSALT': '[ -f "$3" ] || exit 1'})
+
+  config['folders']['log_file'] = str(tmp_path / 'microsalt.log')
+  config['regex']['mail_recipient'] = 'lab@example.com'
+  jc = Job_Creator(config=config, log=logger, sampleinfo=samples, run_settings={'input':str(indir), 'qc_only':True, 'incremental':True, 'executor':'local'})
+  jc.project_job()
+
+  calls = [call for call in order.read_text().splitlines() if call.startswith(('microSALT', 'bwa'))]
+  finish = 'microSALT utils finish {0}/sampleinfo.json --input {0}'.format(jc.finishdir)
+  ingests = [call for call in calls if '--samples' in call]
+  assert sorted(ingests) == sorted('{} --samples {} --skip_update --scrape_only'.format(finish, sample['CG_ID_sample']) for sample in samples)
+  #One local worker runs each sample, then its ingestion, then the project report
+  assert [call.split()[0] for call in calls] == ['bwa', 'microSALT', 'bwa', 'microSALT', 'microSALT']
+  assert calls[-1].startswith(finish) and '--samples' not in calls[-1]
+
+def test_incremental_steps(testdata, tmp_path, sbatch_calls, config):
+  indir = project_input(tmp_path, testdata[:1])
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1], run_settings={'input':str(indir / testdata[0]['CG_ID_sample']), 'steps':True, 'incremental':True})
+  jc.project_job(single_sample=True)
+
+  submitted = sbatch_calls.read_text().splitlines()
+  assert '_ingest ' in submitted[4] and '--dependency=afterok:4002:4004 ' in submitted[4]
+  ingest = open('{}/runfile_ingest.sbatch'.format(jc.finishdir)).read()
+  assert 'microSALT utils finish {0}/sampleinfo.json --input {0} --samples {1} '.format(jc.finishdir, jc.name) in ingest
+
+def test_step_jobs(testdata, tmp_path, sbatch_calls, config):
+  indir = project_input(tmp_path, testdata[:1])
+  config['slurm_header']['steps'] = {'alignment': {'threads': '4', 'mem': '16G'}, 'blast': {'threads': '2', 'time': '01:00:00'}}
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1], run_settings={'input':str(indir / testdata[0]['CG_ID_sample']), 'steps':True})
+  jc.project_job(single_sample=True)
+
+  submitted = sbatch_calls.read_text().splitlines()
+  steps = [re.search(r'-J \w+_{}_(\w+)'.format(jc.name), line).group(1) for line in submitted[:-1]]
+  assert steps == ['preproc', 'alignment', 'assembly', 'blast']
+  assert 'dependency' not in submitted[0]
+  assert '-n 4 ' in submitted[1] and '--mem 16G' in submitted[1] and '--dependency=afterok:4001 ' in submitted[1]
+  assert '--dependency=afterok:4001 ' in submitted[2]
+  assert '-n 2 -t 01:00:00' in submitted[3] and '--dependency=afterok:4003 ' in submitted[3]
+  assert 'MAILJOB' in submitted[4] and '--dependency=afterany:4001:4002:4003:4004' in submitted[4]
+
+  alignment = open('{}/runfile_alignment.sbatch'.format(jc.finishdir)).read()
+  assert alignment.startswith('#!/bin/bash\n\nset -e\n')
+  assert 'bwa mem -M -t 4 ' in alignment and 'trimmomatic' not in alignment
+  assembly = open('{}/runfile_assembly.sbatch'.format(jc.finishdir)).read()
+  assert 'spades.py --threads {} '.format(config['slurm_header']['threads']) in assembly and 'bwa mem' not in assembly
+
+def test_compressed_pipefail(testdata, tmp_path, sbatch_calls, config):
+  #Compressed outputs are piped, so a failing tool must fail the pipeline
+  indir = project_input(tmp_path, testdata[:1])
+  for steps in [False, True]:
+    jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1], run_settings={'input':str(indir / testdata[0]['CG_ID_sample']), 'steps':steps, 'compress':'gzip'})
+    jc.project_job(single_sample=True)
+    runfile = open('{}/{}'.format(jc.finishdir, 'runfile_alignment.sbatch' if steps else 'runfile.sbatch')).read()
+    assert 'set -o pipefail\n' in runfile and '| gzip -c > ' in runfile
+
+def parallel_script(tmp_path, failing=''):
+  """Two sections that each wait for the other to start, so they only finish when run side by side"""
+  stubs = tmp_path / 'bin'
+  stubs.mkdir()
+  for mine, other in [('a', 'b'), ('b', 'a')]:
+    (stubs / 'stub_{}'.format(mine)).write_text('#!/bin/bash\ntouch {0}/{1}.started\nfor i in $(seq 100); do [ -f {0}/{2}.started ] && break; sleep 0.05; done\n[ -f {0}/{2}.started ] || exit 3\n{3}\ntouch {0}/{1}.done\n'.format(
+      tmp_path, mine, other, 'exit 7' if mine == failing else ''))
+    os.chmod(str(stubs / 'stub_{}'.format(mine)), 0o755)
+
+  jc = Job_Creator(config=preset_config, log=logger, sampleinfo=[{'CG_ID_sample':'AAA1234A1'}], run_settings={'finishdir':str(tmp_path)})
+  jc.batchfile = str(tmp_path / 'runfile.sbatch')
+  with open(jc.batchfile, 'w') as fh:
+    fh.write('#!/bin/bash\nexport PATH={}:$PATH\n'.format(stubs))
+  def writer(line):
+    def write():
+      with open(jc.batchfile, 'a') as fh:
+        fh.write('{}\n'.format(line))
+    return write
+  jc.create_parallel_sections([('first', [writer('stub_a')], 2), ('second', [writer('stub_b')], 6)])
+  with open(jc.batchfile, 'a') as fh:
+    fh.write('touch {}/barrier.passed\n'.format(tmp_path))
+  return jc.batchfile
+
+def test_parallel_sections(tmp_path):
+  runfile = parallel_script(tmp_path)
+  assert subprocess.run(['bash', runfile]).returncode == 0
+  assert all((tmp_path / name).exists() for name in ['a.done', 'b.done', 'barrier.passed'])
+  assert '# Section second runs in the background on 6 threads' in open(runfile).read()
+
+def test_parallel_section_failure(tmp_path):
+  runfile = parallel_script(tmp_path, failing='b')
+  finished = subprocess.run(['bash', runfile], stderr=subprocess.PIPE)
+  assert finished.returncode == 7
+  assert b'Section second failed with status 7' in finished.stderr
+  assert (tmp_path / 'a.done').exists()
+  assert not (tmp_path / 'b.done').exists() and not (tmp_path / 'barrier.passed').exists()
+
+def test_parallel_sample_job(testdata, tmp_path):
+  indir = project_input(tmp_path, testdata[:1]) / testdata[0]['CG_ID_sample']
+  jc = Job_Creator(config=preset_config, log=logger, sampleinfo=testdata[:1], run_settings={'input':str(indir), 'finishdir':str(tmp_path / 'out'), 'parallel':True})
+  jc.sample_job()
+  runfile = open(jc.get_sbatch()).read()
+  assert runfile.index('trimmomatic') < runfile.index('(\nset -e\n')
+  assert 'bwa mem -M -t 2 ' in runfile and 'spades.py --threads 6 ' in runfile
+  assert runfile.index('ALIGNMENT_PID=$!') < runfile.index('spades.py') < runfile.index('ASSEMBLY_PID=$!') < runfile.index('wait $ALIGNMENT_PID')
+  assert subprocess.run(['bash', '-n', jc.get_sbatch()]).returncode == 0
+
+def test_local_parallel_sample_job(testdata, tmp_path, tool_stubs, config):
+  """The parallel sections run under set -e, also when rerun on existing folders"""
+  indir = project_input(tmp_path, testdata[:1]) / testdata[0]['CG_ID_sample']
+  calls = tool_stubs(['trimmomatic', 'bwa', 'samtools', 'picard', 'spades.py', 'quast.py'])
+  jc = Job_Creator(config=config, log=logger, sampleinfo=testdata[:1],
+                   run_settings={'input':str(indir), 'finishdir':str(tmp_path / 'out'), 'parallel':True, 'executor':'local'})
+  jc.sample_job()
+  for attempt in range(2):
+    finished = subprocess.run(['bash', jc.get_sbatch()], stderr=subprocess.PIPE)
+    assert finished.returncode == 0, finished.stderr.decode()
+  assert 'failed with status' not in finished.stderr.decode()
+  assert all(tool in calls.read_text() for tool in ['bwa mem', 'spades.py', 'quast.py'])
+
 def test_create_collection():
   pass
 
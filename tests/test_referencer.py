@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import copy
+import os
+import pytest
+import re
+
+from microSALT import preset_config, logger
+from microSALT.utils.referencer import MERGED_DB, Referencer, load_sources, merged_db
+
+def legacy_organism2reference(folder, normal_organism_name):
+  """Word by word matching as done before resolutions were cached"""
+  organism = re.split(r"\W+", normal_organism_name.lower())
+  for target in os.listdir(folder):
+    hit = 0
+    for piece in organism:
+      if len(piece) == 1:
+        if target.startswith(piece):
+          hit += 1
+      else:
+        if piece in target:
+          hit += 1
+        elif piece == "pneumonsiae" and "pneumoniae" in target:
+          hit += 1
+        else:
+          break
+    if hit == len(organism):
+      return target
+
+@pytest.fixture
+def references(tmp_path):
+  for organism in ['staphylococcus_aureus', 'streptococcus_pneumoniae', 'escherichia_coli', 'klebsiella_pneumoniae', 'enterococcus_faecalis']:
+    (tmp_path / organism).mkdir()
+  config = copy.deepcopy(preset_config)
+  config['folders']['references'] = str(tmp_path)
+  return config
+
+def test_organism2reference(references):
+  ref_obj = Referencer(config=references, log=logger)
+  for organism in ['Staphylococcus aureus', 'S. aureus', 'E.coli', 'Escherichia coli', 'Streptococcus pneumonsiae',
+                   'Klebsiella pneumoniae', 'k pneumoniae', 'Enterococcus faecium', 'pneumoniae', 'Unknown']:
+    assert ref_obj.organism2reference(organism) == legacy_organism2reference(references['folders']['references'], organism)
+  assert ref_obj.organism2reference('S. aureus') == 'staphylococcus_aureus'
+  assert ref_obj.organism2reference('Enterococcus faecium') is None
+
+def test_organism2reference_invalidation(references):
+  ref_obj = Referencer(config=references, log=logger)
+  assert ref_obj.organism2reference('Enterococcus faecium') is None
+  os.mkdir('{}/enterococcus_faecium'.format(references['folders']['references']))
+  #Folder mtime granularity differs between file systems
+  os.utime(references['folders']['references'], ns=(0, 1))
+  assert ref_obj.organism2reference('Enterococcus faecium') == 'enterococcus_faecium'
+
+def test_organism_aliases(references):
+  references['regex']['organism_aliases'] = {'areus': 'aureus'}
+  ref_obj = Referencer(config=references, log=logger)
+  assert ref_obj.organism2reference('Staphylococcus areus') == 'staphylococcus_aureus'
+  assert ref_obj.organism2reference('Streptococcus pneumonsiae') is None
+
+def test_merged_database(tmp_path, monkeypatch):
+  stubs = tmp_path / 'bin'
+  stubs.mkdir()
+  (stubs / 'makeblastdb').write_text('#!/bin/bash\nwhile [ $# -gt 0 ]; do [ "$1" == "-out" ] && touch "$2.nsq"; shift; done\n')
+  os.chmod(str(stubs / 'makeblastdb'), 0o755)
+  monkeypatch.setenv('PATH', '{}:{}'.format(stubs, os.environ['PATH']))
+  folder = tmp_path / 'resistances'
+  folder.mkdir()
+  (folder / 'aminoglycoside.fsa').write_text('>ant(6)-Ia_1_AF330699\nACGT\nACGT\n>aph(3)-III_1_M26832\nGGGG\n')
+  (folder / 'beta-lactam.fsa').write_text('>ant(6)-Ia_1_AF330699\nACGTACGT\n>blaZ_1_X\nTTTT\n')
+
+  ref_obj = Referencer(config=preset_config, log=logger)
+  ref_obj.index_db(str(folder), '.fsa')
+  assert merged_db(str(folder), '.fsa') == '{}/{}'.format(folder, MERGED_DB)
+  with open(str(folder / '.merged.fsa')) as fh:
+    assert fh.read().count('>') == 3
+  assert load_sources(str(folder), '.fsa') == {'ant(6)-Ia_1_AF330699': ['aminoglycoside', 'beta-lactam'],
+                                               'aph(3)-III_1_M26832': ['aminoglycoside'], 'blaZ_1_X': ['beta-lactam']}
+
+  #Changed sources invalidate the merged database until it is rebuilt
+  os.utime(str(folder / 'merged.nsq'), (0, 0))
+  assert merged_db(str(folder), '.fsa') is None
+  ref_obj.index_db(str(folder), '.fsa')
+  assert merged_db(str(folder), '.fsa') is not None
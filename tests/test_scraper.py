@@ -1,18 +1,29 @@
 #!/usr/bin/env python
 
+import copy
 import glob
+import gzip
 import json
+import numpy as np
 import logging
 import os
 import pathlib
 import pdb
 import pytest
+import random
+import shutil
+import time
 
 from distutils.sysconfig import get_python_lib
 
 from microSALT import preset_config, logger
-from microSALT.utils.scraper import Scraper
-from microSALT.utils.referencer import Referencer
+from microSALT.utils.scraper import Prefix_Index, ScrapeContext, Scraper, coverage_metrics, remove_overlaps
+from microSALT.utils.referencer import Referencer, load_lengths
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
 
 @pytest.fixture
 def testdata_prefix():
@@ -58,3 +69,443 @@ def test_blast_scraping(scraper, testdata_prefix, caplog):
 
 def test_alignment_scraping(scraper, init_references, testdata_prefix):
   scraper.scrape_alignment(file_list=glob.glob("{}/*.stats.*".format(testdata_prefix)))
+
+def legacy_coverage(cov_file, ref_len):
+  """Pure python coverage fractions and mean as computed before the histogram was vectorised"""
+  cov_dict = dict()
+  with open(cov_file) as fh:
+    for line in fh:
+      lsplit = line.rstrip().split("\t")
+      cov_dict[lsplit[1]] = int(lsplit[2])
+  sumz, plus = 0, {10: 0, 30: 0, 50: 0, 100: 0}
+  for k, v in cov_dict.items():
+    sumz += int(k) * v
+    for depth in plus:
+      if int(k) > depth:
+        plus[depth] += v
+  return sumz / float(ref_len), {depth: v / float(ref_len) for depth, v in plus.items()}
+
+def test_coverage_metrics(scraper, testdata_prefix):
+  ref_len = 2878977 + 30991
+  histogram = np.loadtxt('{}/alignment.stats.cov'.format(testdata_prefix), usecols=(1, 2), dtype=np.int64)
+  metrics = coverage_metrics(histogram[:, 0], histogram[:, 1], ref_len, [10, 30, 50, 100])
+  average, fractions = legacy_coverage('{}/alignment.stats.cov'.format(testdata_prefix), ref_len)
+  assert metrics['average'] == pytest.approx(average)
+  assert metrics['depths'] == pytest.approx(fractions)
+
+  #Percentiles and fold-80 against per-base depths
+  bases = np.repeat(histogram[:, 0], histogram[:, 1])
+  bases = np.concatenate([np.zeros(ref_len - len(bases), dtype=np.int64), bases])
+  for percentile in [10, 50, 90]:
+    rank = int(np.ceil(percentile / 100.0 * ref_len))
+    assert metrics['percentiles'][percentile] == np.sort(bases)[rank - 1]
+  covered = np.sort(bases[bases > 0])
+  p20 = covered[int(np.ceil(0.2 * len(covered))) - 1]
+  assert metrics['fold_80'] == pytest.approx(covered.mean() / p20)
+
+  #Nothing aligned
+  empty = coverage_metrics([], [], ref_len)
+  assert empty['average'] == 0.0 and empty['fold_80'] == 0.0
+
+def test_alignment_metrics(scraper, testdata_prefix):
+  config = copy.deepcopy(preset_config)
+  config['threshold']['coverage_depths'] = [1, 200]
+  scraper.config = config
+  align = scraper.parse_alignment(file_list=glob.glob("{}/alignment.stats.*".format(testdata_prefix)))
+  assert align['total_reads'] == 4809492
+  assert 0 < align['coverage_100x'] <= align['coverage_10x'] <= 1
+  assert align['coverage_p10'] <= align['median_coverage'] <= align['coverage_p90']
+  assert align['fold_80'] >= 1
+  depths = json.loads(align['coverage_depths'])
+  assert set(depths) == {'1', '200'}
+  assert depths['1'] >= align['coverage_10x'] >= depths['200']
+
+@pytest.fixture
+def loci_folder(tmp_path):
+  with open(str(tmp_path / 'arcC.tfa'), 'w') as fh:
+    fh.write('>arcC_1\nACGTACGTAC\nGTA\n>arcC_2\nACGT\n')
+  with open(str(tmp_path / 'aroE.tfa'), 'w') as fh:
+    fh.write('>aroE_1\nACGTACGTACGTACGT\n')
+  return str(tmp_path)
+
+def test_locilengths_index(scraper, loci_folder):
+  expected = {'>arcC_1': 13, '>arcC_2': 4, '>aroE_1': 16}
+  assert load_lengths(loci_folder, 'tfa') is None
+  assert scraper.get_locilengths(loci_folder, 'tfa') == expected
+
+  ref_obj = Referencer(config=preset_config, log=logger)
+  ref_obj.index_lengths(loci_folder, '.tfa')
+  assert load_lengths(loci_folder, 'tfa') == expected
+
+  #Stale sidecar is ignored and cached lengths are refreshed
+  with open('{}/aroE.tfa'.format(loci_folder), 'a') as fh:
+    fh.write('>aroE_2\nAC\n')
+  os.utime('{}/aroE.tfa'.format(loci_folder), (1, 1))
+  assert load_lengths(loci_folder, 'tfa') is None
+  assert scraper.get_locilengths(loci_folder, 'tfa')['>aroE_2'] == 2
+
+def test_prefix_index():
+  random.seed(7)
+  keys = list(set('>{}_{}'.format(random.choice(['arcC', 'aroE', 'glpF', 'gmk', 'aph(3\')-III', 'blaTEM']), random.randint(1, 400)) for _ in range(2000)))
+  random.shuffle(keys)
+  index = Prefix_Index(keys)
+  prefixes = ['>', '>arcC_1', '>arcC_12', '>aroE_3', '>gmk_40', '>aph(3\')-III_1', '>blaTEM', '>blaTEM_99', '>missing', '>arcC_9999', '']
+  for prefix in prefixes:
+    legacy = [x for x in keys if x.startswith(prefix)]
+    assert index.first(prefix) == (legacy[0] if legacy else None)
+  assert Prefix_Index([]).first('>arcC') is None
+
+def legacy_overlaps(hypo, identifier):
+  """Reference implementation of the original nested overlap cleanup"""
+  hypo = list(hypo)
+  score = lambda h: float(h.get("identity")) * (1 - abs(1 - h.get("span")))
+  ind = 0
+  while ind < len(hypo) - 1:
+    targ = ind + 1
+    while targ < len(hypo):
+      ignore = False
+      a, b = hypo[ind], hypo[targ]
+      if a["contig_name"] == b["contig_name"] or a[identifier] == b[identifier]:
+        if (b["contig_start"] <= a["contig_start"] <= b["contig_end"]) or (b["contig_start"] <= a["contig_end"] <= b["contig_end"]) or a[identifier] == b[identifier]:
+          if score(a) > score(b) or (score(a) == score(b) and float(a["contig_coverage"]) >= float(b["contig_coverage"])):
+            del hypo[targ]
+          else:
+            del hypo[ind]
+            targ = ind + 1
+          ignore = True
+      if not ignore:
+        targ += 1
+    ind += 1
+  return hypo
+
+def recorded_hits(filename, identifier):
+  """Parses a recorded BLAST output into scraper style hits, spans relative to the longest subject hit"""
+  hits = list()
+  with open(filename) as fh:
+    for line in fh:
+      if line.startswith('#'):
+        continue
+      elem = line.rstrip().split('\t')
+      node = elem[2].split('_')
+      name = elem[3].rsplit('_', 1)[0]
+      if identifier == 'gene':
+        name = name.rsplit('_', 1)[0]
+      hits.append({'identity': elem[4], 'subject': elem[3], identifier: name,
+                   'contig_start': min(int(elem[7]), int(elem[8])), 'contig_end': max(int(elem[7]), int(elem[8])),
+                   'subject_length': int(elem[11]), 'contig_name': '{}_{}'.format(node[0], node[1]), 'contig_coverage': node[5]})
+  longest = dict()
+  for hit in hits:
+    longest[hit['subject']] = max(longest.get(hit['subject'], 0), hit['subject_length'])
+  for hit in hits:
+    #Offset keeps spans from all being 1.0
+    hit['span'] = hit['subject_length'] / float(longest[hit['subject']] + hit['subject_length'] % 3)
+  return hits
+
+def test_overlaps_match_legacy(testdata_prefix):
+  for filename, identifier in [('blast_single_loci.txt', 'loci'), ('blast_single_resistance.txt', 'gene')]:
+    hits = recorded_hits('{}/{}'.format(testdata_prefix, filename), identifier)
+    assert len(hits) > 0
+    kept = remove_overlaps(hits, identifier)
+    assert kept == legacy_overlaps(hits, identifier)
+    assert len(kept) < len(hits)
+
+def overlap_hit(name, start, end, identity=99.0, span=1.0, coverage=10.0, contig='NODE_1', loci=None):
+  return {'name': name, 'loci': loci or name, 'contig_name': contig, 'contig_start': start, 'contig_end': end,
+          'identity': str(identity), 'span': span, 'contig_coverage': str(coverage)}
+
+def test_overlaps_chain():
+  #Each hit loses to the next, so only the last of the chain is kept
+  hits = [overlap_hit('a', 0, 10, identity=97), overlap_hit('b', 5, 15, identity=98), overlap_hit('c', 12, 20, identity=99)]
+  assert [h['name'] for h in remove_overlaps(hits, 'loci')] == ['c']
+  assert remove_overlaps(hits, 'loci') == legacy_overlaps(hits, 'loci')
+
+def test_overlaps_containment():
+  #Only the earlier hit starting or ending within the later one counts as overlap
+  outer, inner = overlap_hit('a', 0, 100, identity=99), overlap_hit('b', 10, 20, identity=98)
+  assert [h['name'] for h in remove_overlaps([outer, inner], 'loci')] == ['a', 'b']
+  assert [h['name'] for h in remove_overlaps([inner, outer], 'loci')] == ['a']
+
+def test_overlaps_ties():
+  #Equal scores fall back to contig coverage, then the earlier hit wins
+  hits = [overlap_hit('a', 0, 10, coverage=5), overlap_hit('b', 5, 15, coverage=8)]
+  assert [h['name'] for h in remove_overlaps(hits, 'loci')] == ['b']
+  hits = [overlap_hit('a', 0, 10), overlap_hit('b', 5, 15)]
+  assert [h['name'] for h in remove_overlaps(hits, 'loci')] == ['a']
+
+def test_overlaps_shared_identifier():
+  #Hits of one identifier compete across contigs, regardless of position
+  hits = [overlap_hit('a', 0, 10, contig='NODE_1', loci='arcC', identity=98),
+          overlap_hit('b', 500, 600, contig='NODE_2', loci='arcC', identity=99),
+          overlap_hit('c', 0, 10, contig='NODE_2', loci='aroE')]
+  assert [h['name'] for h in remove_overlaps(hits, 'loci')] == ['b', 'c']
+
+def test_overlaps_random_equivalence():
+  random.seed(3)
+  for trial in range(3000):
+    hits = list()
+    for i in range(random.randint(1, 20)):
+      start = random.randint(0, 40)
+      hits.append(overlap_hit(str(i), start, start + random.randint(0, 15), identity=random.choice([97, 98, 99]),
+                              span=random.choice([0.9, 1.0, 1.1]), coverage=random.choice([5, 10]),
+                              contig=random.choice(['NODE_1', 'NODE_2']), loci=random.choice(['arcC', 'aroE', 'glpF', 'gmk'])))
+    assert remove_overlaps(hits, 'loci') == legacy_overlaps(hits, 'loci')
+
+def test_overlaps_scaling():
+  #All hits on one contig, where comparing every pair is quadratic
+  random.seed(11)
+  hits = list()
+  for i in range(20000):
+    start = random.randint(1, 2000000)
+    hits.append({'identity': str(random.uniform(90, 100)), 'span': random.uniform(0.8, 1.2), 'loci': 'locus{}'.format(random.randint(1, 6000)),
+                 'contig_name': 'NODE_1', 'contig_start': start, 'contig_end': start + random.randint(100, 2000),
+                 'contig_coverage': str(random.uniform(10, 100))})
+  begin = time.time()
+  kept = remove_overlaps(hits, 'loci')
+  elapsed = time.time() - begin
+  logger.info("Resolved overlaps of {} hits in {:.3f}s".format(len(hits), elapsed))
+  assert 0 < len(kept) < len(hits)
+  assert len(set(h['loci'] for h in kept)) == len(kept)
+  assert elapsed < 3
+
+@pytest.fixture
+def reference_config(tmp_path, testdata_prefix):
+  """Config with references matching the subjects of the recorded BLAST outputs"""
+  config = copy.deepcopy(preset_config)
+  folders = {'references': tmp_path / 'references', 'resistances': tmp_path / 'resistances'}
+  for entry, folder in folders.items():
+    folder.mkdir()
+    config['folders'][entry] = str(folder)
+  (folders['references'] / 'staphylococcus_aureus').mkdir()
+  (folders['references'] / 'escherichia_coli').mkdir()
+  targets = {'blast_single_loci.txt': folders['references'] / 'staphylococcus_aureus' / 'arcC.tfa',
+             'blast_single_resistance.txt': folders['resistances'] / 'aminoglycoside.fsa'}
+  for source, target in targets.items():
+    lengths = dict()
+    with open('{}/{}'.format(testdata_prefix, source)) as fh:
+      for line in fh:
+        if not line.startswith('#'):
+          elem = line.rstrip().split('\t')
+          lengths[elem[3]] = max(lengths.get(elem[3], 0), int(elem[11]))
+    with open(str(target), 'w') as fh:
+      for name, length in lengths.items():
+        fh.write('>{}\n{}\n'.format(name, 'A' * length))
+  with open(str(folders['resistances'] / 'notes.txt'), 'w') as fh:
+    fh.write("# Aminoglycoside\naph(3')-III:Aminoglycoside resistance:\n")
+  return config
+
+@pytest.fixture
+def project_folder(tmp_path, testdata_prefix, testdata):
+  """Finished analysis of two samples built from the recorded outputs"""
+  project = tmp_path / 'AAA1234_2000.1.2_3.4.5'
+  for entry in testdata[:2]:
+    sampledir = project / entry['CG_ID_sample']
+    for sub in ['blast_search/mlst', 'blast_search/resistance', 'alignment', 'assembly/quast']:
+      (sampledir / sub).mkdir(parents=True)
+    shutil.copy('{}/blast_single_loci.txt'.format(testdata_prefix), str(sampledir / 'blast_search/mlst/loci_query_arcC.txt'))
+    shutil.copy('{}/blast_single_resistance.txt'.format(testdata_prefix), str(sampledir / 'blast_search/resistance/aminoglycoside.txt'))
+    shutil.copy('{}/quast_results.tsv'.format(testdata_prefix), str(sampledir / 'assembly/quast/report.tsv'))
+    for stats in glob.glob('{}/alignment.stats.*'.format(testdata_prefix)):
+      shutil.copy(stats, str(sampledir / 'alignment' / '{}_ref{}'.format(entry['CG_ID_sample'], os.path.basename(stats)[9:])))
+  return str(project)
+
+def stored_results(dbm, samples):
+  results = dict()
+  for sample in samples:
+    rows = dbm.query_rec('Samples', {'CG_ID_sample': sample})
+    results[sample] = {
+      'Samples': [(r.organism, r.n50, r.total_reads, r.average_coverage, r.coverage_10x) for r in rows],
+      'Seq_types': sorted((r.loci, r.allele, r.contig_name, r.span) for r in dbm.query_rec('Seq_types', {'CG_ID_sample': sample})),
+      'Resistances': sorted((r.gene, r.instance, r.resistance, r.span) for r in dbm.query_rec('Resistances', {'CG_ID_sample': sample})),
+    }
+  return results
+
+def test_parallel_project_scraping(reference_config, project_folder, testdata):
+  samples = [entry['CG_ID_sample'] for entry in testdata[:2]]
+  serial = Scraper(config=reference_config, log=logger, sampleinfo=testdata[:2], input=project_folder)
+  serial.scrape_project()
+  expected = stored_results(serial.db_pusher, samples)
+  assert expected[samples[0]]['Samples'][0][0] == 'staphylococcus_aureus'
+  assert expected[samples[0]]['Samples'][0][2] == 4809492
+  assert len(expected[samples[0]]['Seq_types']) == 1
+  assert len(expected[samples[0]]['Resistances']) == 2
+  #Staphylococcus loci do not resolve for the Escherichia coli sample
+  assert expected[samples[1]]['Seq_types'] == []
+  assert len(expected[samples[1]]['Resistances']) == 2
+
+  parallel = Scraper(config=reference_config, log=logger, sampleinfo=testdata[:2], input=project_folder)
+  parallel.scrape_project(workers=2, force=True)
+  assert stored_results(parallel.db_pusher, samples) == expected
+
+def test_shared_context(reference_config, project_folder, testdata, monkeypatch):
+  loads = list()
+  load_resistances = ScrapeContext.load_resistances
+  def counted(self):
+    loads.append(self)
+    return load_resistances(self)
+  monkeypatch.setattr(ScrapeContext, 'load_resistances', counted)
+
+  scraper = Scraper(config=reference_config, log=logger, sampleinfo=testdata[:2], input=project_folder)
+  scraper.scrape_project(force=True)
+  assert len(loads) == 1
+  assert scraper.gene2resistance["aph(3')-III"] == 'Aminoglycoside'
+  assert len(scraper.context.locilengths) == 3
+
+  sample = Scraper(config=reference_config, log=logger, sampleinfo=testdata[0], input=project_folder, context=scraper.context)
+  assert sample.db_pusher is scraper.db_pusher
+  assert len(loads) == 1
+
+def test_incremental_scraping(reference_config, project_folder, testdata, caplog):
+  caplog.set_level(logging.INFO)
+  samples = [entry['CG_ID_sample'] for entry in testdata[:2]]
+  scraper = Scraper(config=reference_config, log=logger, sampleinfo=testdata[:2], input=project_folder)
+  scraper.scrape_project(force=True)
+  expected = stored_results(scraper.db_pusher, samples)
+  assert scraper.db_pusher.get_fingerprint(samples[0]) is not None
+
+  caplog.clear()
+  scraper.scrape_project()
+  assert "Scraping 0 of 2 samples" in caplog.text
+  assert stored_results(scraper.db_pusher, samples) == expected
+
+  #Re-running one sample only re-scrapes that sample
+  blastfile = '{}/{}/blast_search/resistance/aminoglycoside.txt'.format(project_folder, samples[1])
+  with open(blastfile) as fh:
+    kept = [line for line in fh if 'ant(6)' not in line]
+  with open(blastfile, 'w') as fh:
+    fh.writelines(kept)
+  caplog.clear()
+  scraper.scrape_project()
+  assert "Scraping 1 of 2 samples" in caplog.text
+  assert "Sample {} unchanged".format(samples[0]) in caplog.text
+  changed = stored_results(scraper.db_pusher, samples)
+  assert changed[samples[0]] == expected[samples[0]]
+  assert len(changed[samples[1]]['Resistances']) < len(expected[samples[1]]['Resistances'])
+
+  caplog.clear()
+  scraper.scrape_project(samples=[samples[0]])
+  assert "Scraping 1 of 1 samples" in caplog.text
+  caplog.clear()
+  scraper.scrape_project(force=True)
+  assert "Scraping 2 of 2 samples" in caplog.text
+  assert stored_results(scraper.db_pusher, samples) == changed
+
+def test_novel_alleles(reference_config, testdata, tmp_path):
+  sampledir = tmp_path / testdata[0]['CG_ID_sample']
+  (sampledir / 'assembly').mkdir(parents=True)
+  with open(str(sampledir / 'assembly' / '{}_contigs.fasta'.format(testdata[0]['CG_ID_sample'])), 'w') as fh:
+    fh.write('>NODE_1_length_12_cov_20.5\nACGTA\nCGTAC\nGT\n>NODE_2_length_7_cov_3.0\nTTTTT\nGG\n')
+  scraper = Scraper(config=reference_config, log=logger, sampleinfo=testdata[0], input=str(sampledir))
+  scraper.sampledir = scraper.infolder
+  threshold = reference_config['threshold']['mlst_id']
+  hits = [{'loci': 'arcC', 'allele': 6, 'identity': threshold - 1, 'contig_name': 'NODE_1', 'contig_start': 4, 'contig_end': 9},
+          {'loci': 'aroE', 'allele': 57, 'identity': 100.0, 'contig_name': 'NODE_1', 'contig_start': 1, 'contig_end': 12},
+          {'loci': 'gmk', 'allele': 2, 'identity': threshold - 2, 'contig_name': 'NODE_2', 'contig_start': 6, 'contig_end': 7}]
+  scraper.write_novel_alleles(hits)
+  written = (sampledir / 'assembly' / '{}_novel_alleles.fasta'.format(testdata[0]['CG_ID_sample'])).read_text()
+  #Only alleles below the identity threshold, cut from their contig region
+  assert written == '>arcC_6 NODE_1_length_12_cov_20.5:4-9\nTACGTA\n>gmk_2 NODE_2_length_7_cov_3.0:6-7\nGG\n'
+
+def test_sample_transaction(reference_config, project_folder, testdata, monkeypatch):
+  samples = [entry['CG_ID_sample'] for entry in testdata[:2]]
+  scraper = Scraper(config=reference_config, log=logger, sampleinfo=testdata[:2], input=project_folder)
+  scraper.scrape_project(force=True)
+  expected = stored_results(scraper.db_pusher, samples)
+  fingerprints = [scraper.db_pusher.get_fingerprint(sample) for sample in samples]
+
+  #A sample failing halfway through storing keeps its previous records and manifest
+  blastfile = '{}/{}/blast_search/resistance/aminoglycoside.txt'.format(project_folder, samples[0])
+  with open(blastfile) as fh:
+    kept = [line for line in fh if 'ant(6)' not in line]
+  with open(blastfile, 'w') as fh:
+    fh.writelines(kept)
+  add_recs = scraper.db_pusher.add_recs
+  def failing(data_dicts, tablename):
+    if tablename == 'Resistances':
+      raise IOError('disk full')
+    return add_recs(data_dicts, tablename)
+  monkeypatch.setattr(scraper.db_pusher, 'add_recs', failing)
+  with pytest.raises(IOError):
+    scraper.scrape_project(samples=[samples[0]])
+  assert stored_results(scraper.db_pusher, samples) == expected
+  assert [scraper.db_pusher.get_fingerprint(sample) for sample in samples] == fingerprints
+
+  monkeypatch.undo()
+  scraper.scrape_project()
+  assert len(stored_results(scraper.db_pusher, samples)[samples[0]]['Resistances']) < len(expected[samples[0]]['Resistances'])
+  assert scraper.db_pusher.get_fingerprint(samples[0]) != fingerprints[0]
+
+def compress_outputs(folder, method):
+  """Compresses BLAST and alignment statistics the way the runfile does. Returns bytes before and after"""
+  before, after = 0, 0
+  suffix = {'gzip': '.gz', 'zstd': '.zst'}[method]
+  for file in glob.glob('{}/*/blast_search/*/*'.format(folder)) + glob.glob('{}/*/alignment/*.stats.*'.format(folder)):
+    with open(file, 'rb') as fh:
+      data = fh.read()
+    if method == 'gzip':
+      packed = gzip.compress(data)
+    else:
+      packed = zstandard.ZstdCompressor().compress(data)
+    with open(file + suffix, 'wb') as fh:
+      fh.write(packed)
+    os.remove(file)
+    before, after = before + len(data), after + len(packed)
+  return before, after
+
+@pytest.mark.parametrize('method', ['gzip', 'zstd'])
+def test_compressed_project_scraping(reference_config, project_folder, testdata, method):
+  if method == 'zstd' and zstandard is None:
+    pytest.skip('zstandard is not installed')
+  samples = [entry['CG_ID_sample'] for entry in testdata[:2]]
+  plain = Scraper(config=reference_config, log=logger, sampleinfo=testdata[:2], input=project_folder)
+  plain.scrape_project()
+  expected = stored_results(plain.db_pusher, samples)
+
+  before, after = compress_outputs(project_folder, method)
+  logger.info("{} stores test outputs in {} of {} bytes ({:.1f}%)".format(method, after, before, 100.0 * after / before))
+  assert after < before
+  packed = Scraper(config=reference_config, log=logger, sampleinfo=testdata[:2], input=project_folder)
+  packed.scrape_project()
+  assert stored_results(packed.db_pusher, samples) == expected
+
+def test_merged_blast_scraping(reference_config, project_folder, testdata, caplog, monkeypatch):
+  """Hits of one merged search are split back by source file and type like per-file searches"""
+  samples = [entry['CG_ID_sample'] for entry in testdata[:2]]
+  resistances = reference_config['folders']['resistances']
+  #ant(6) genes are listed in two resistance classes
+  with open('{}/aminoglycoside.fsa'.format(resistances)) as fh:
+    shared = fh.read().split('>')
+  with open('{}/beta-lactam.fsa'.format(resistances), 'w') as fh:
+    fh.writelines('>' + record for record in shared if record.startswith('ant(6)'))
+  for sample in samples:
+    search = '{}/{}/blast_search'.format(project_folder, sample)
+    with open('{}/resistance/aminoglycoside.txt'.format(search)) as fh:
+      lines = fh.readlines()
+    with open('{}/resistance/beta-lactam.txt'.format(search), 'w') as fh:
+      fh.writelines(line for line in lines if line.startswith('#') or 'ant(6)' in line)
+  perfile = Scraper(config=reference_config, log=logger, sampleinfo=testdata[:2], input=project_folder)
+  perfile.scrape_project(force=True)
+  expected = stored_results(perfile.db_pusher, samples)
+  assert ('ant(6)-Ia', 'aminoglycoside') in [hit[:2] for hit in expected[samples[0]]['Resistances']]
+
+  #The merged database stores shared records once, so every hit is reported once
+  for sample in samples:
+    search = '{}/{}/blast_search'.format(project_folder, sample)
+    os.remove('{}/resistance/beta-lactam.txt'.format(search))
+    os.rename('{}/resistance/aminoglycoside.txt'.format(search), '{}/resistance/merged.txt'.format(search))
+    os.rename('{}/mlst/loci_query_arcC.txt'.format(search), '{}/mlst/merged.txt'.format(search))
+  for sidecar in [False, True]:
+    if sidecar:
+      Referencer(config=reference_config, log=logger).index_lengths(resistances, '.fsa')
+    merged = Scraper(config=reference_config, log=logger, sampleinfo=testdata[:2], input=project_folder)
+    merged.scrape_project(force=True)
+    assert stored_results(merged.db_pusher, samples) == expected
+
+  #Subjects missing from a stale source index are kept under the merged search
+  caplog.set_level(logging.WARNING)
+  stale = Scraper(config=reference_config, log=logger, sampleinfo=testdata[:2], input=project_folder)
+  sources = stale.context.get_sources(resistances, 'fsa')
+  monkeypatch.setattr(stale.context, 'get_sources', lambda folder, suffix: {k: v for k, v in sources.items() if not k.startswith('ant(6)')})
+  stale.scrape_project(force=True)
+  kept = stored_results(stale.db_pusher, samples)[samples[0]]['Resistances']
+  assert [hit[:2] for hit in kept if hit[0].startswith('ant(6)')] == [('ant(6)-Ia', 'merged')]
+  assert "has no source file in the index" in caplog.text
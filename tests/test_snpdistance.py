@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import gzip
+import random
+import time
+
+import numpy as np
+
+from microSALT.utils.snpdistance import pairwise_distances, read_sites, sample_name, site_bits, snp_distances
+
+def random_samples(count, sites, genome=100000, seed=1):
+  rng = random.Random(seed)
+  chroms = ['contig1', 'contig2']
+  return [set((rng.choice(chroms), rng.randint(1, genome)) for _ in range(sites)) for _ in range(count)]
+
+def write_sites(path, sites):
+  path.write_text(''.join('{}\t{}\n'.format(chrom, pos) for chrom, pos in sorted(sites)))
+  return str(path)
+
+def test_read_sites(tmp_path):
+  vcf = tmp_path / 'AAA1234A1.vcf.gz'
+  with gzip.open(str(vcf), 'wt') as fh:
+    fh.write('##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\n')
+    fh.write('contig1\t100\t.\tA\tG\ncontig1\t100\t.\tA\tT\ncontig2\t7\t.\tC\tA\n')
+  #Records at one position count once, whatever their alleles
+  assert read_sites(str(vcf)) == {('contig1', 100), ('contig2', 7)}
+  assert sample_name(str(vcf)) == 'AAA1234A1'
+
+def test_pairwise_distances():
+  samples = random_samples(12, 300, genome=2000)
+  bits, sites = site_bits(samples)
+  assert sites == sorted(set.union(*samples))
+  distances = pairwise_distances(bits, block_bytes=16)
+  for one in range(len(samples)):
+    for two in range(len(samples)):
+      assert distances[one, two] == len(samples[one] ^ samples[two])
+
+def test_snp_distances(tmp_path):
+  samples = [{('contig1', 5), ('contig1', 9)}, {('contig1', 9)}, set()]
+  files = [write_sites(tmp_path / '{}.snps.tsv'.format(name), sites) for name, sites in zip(['A1', 'A2', 'A3'], samples)]
+  names, distances = snp_distances(files, str(tmp_path))
+  assert names == ['A1', 'A2', 'A3']
+  assert (tmp_path / 'stats.out').read_text() == 'A1_A2 1\nA1_A3 2\nA2_A3 1\n'
+  matrix = (tmp_path / 'distances.tsv').read_text().splitlines()
+  assert matrix[0] == '\tA1\tA2\tA3'
+  assert matrix[1:] == ['A1\t0\t1\t2', 'A2\t1\t0\t1', 'A3\t2\t1\t0']
+
+def test_benchmark_500_samples():
+  samples = random_samples(500, 3000)
+  start = time.time()
+  bits, _ = site_bits(samples)
+  distances = pairwise_distances(bits)
+  elapsed = time.time() - start
+  #124750 pairs, formerly four bcftools processes each
+  assert elapsed < 60
+  rng = random.Random(2)
+  for _ in range(50):
+    one, two = rng.randrange(500), rng.randrange(500)
+    assert distances[one, two] == len(samples[one] ^ samples[two])
+  assert np.array_equal(distances, distances.T)